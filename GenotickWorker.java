@@ -0,0 +1,155 @@
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.Field;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+
+import com.alphatica.genotick.genotick.Main;
+import com.alphatica.genotick.reversal.Reversal;
+
+/**
+ * Runs genotick commands one after another in a single JVM, see genotick_worker.py.
+ *
+ * Request is one line with tab separated genotick arguments, leading
+ * "ENV:NAME=value" fields set environment variables for this command only
+ * (genotick reads GENOTICK_LOG_FILE on every run). Output of the
+ * command is streamed back line by line as "O <length>" frames followed by
+ * length bytes, the response ends with "E <status>" line.
+ * Genotick calls System.exit() on errors, the worker dies then and the
+ * caller falls back to a separate JVM.
+ *
+ * Run: java --add-opens java.base/java.util=ALL-UNNAMED -cp genotick.jar GenotickWorker.java
+ */
+public class GenotickWorker {
+
+    private static final String ENV_PREFIX = "ENV:";
+
+    /** Sends every complete line written by genotick as a frame. */
+    private static class FrameStream extends OutputStream {
+        private final PrintStream out;
+        private final ByteArrayOutputStream line = new ByteArrayOutputStream();
+
+        FrameStream(PrintStream out) {
+            this.out = out;
+        }
+
+        @Override
+        public synchronized void write(int b) {
+            line.write(b);
+            if (b == '\n') {
+                flushLine();
+            }
+        }
+
+        @Override
+        public synchronized void write(byte[] b, int off, int len) {
+            for (int i = off; i < off + len; i++) {
+                write(b[i]);
+            }
+        }
+
+        synchronized void flushLine() {
+            if (line.size() == 0) {
+                return;
+            }
+            out.print("O " + line.size() + "\n");
+            out.write(line.toByteArray(), 0, line.size());
+            out.flush();
+            line.reset();
+        }
+    }
+
+    public static void main(String[] args) throws IOException {
+        PrintStream out = System.out;
+        PrintStream err = System.err;
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        out.print("READY\n");
+        out.flush();
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.isEmpty()) {
+                continue;
+            }
+            FrameStream frames = new FrameStream(out);
+            PrintStream capture = new PrintStream(frames, true, "UTF-8");
+            int status = 0;
+            List<String> command = new ArrayList<>();
+            Map<String, String> env = new HashMap<>();
+            for (String field : line.split("\t")) {
+                if (command.isEmpty() && field.startsWith(ENV_PREFIX) && field.indexOf('=') > 0) {
+                    int split = field.indexOf('=');
+                    env.put(field.substring(ENV_PREFIX.length(), split), field.substring(split + 1));
+                } else {
+                    command.add(field);
+                }
+            }
+            Map<String, String> previous = null;
+            System.setOut(capture);
+            System.setErr(capture);
+            try {
+                previous = setEnv(env);
+                run(command.toArray(new String[0]));
+            } catch (Throwable t) {
+                t.printStackTrace(capture);
+                status = 1;
+            } finally {
+                if (previous != null) {
+                    try {
+                        setEnv(previous);
+                    } catch (ReflectiveOperationException e) {
+                        e.printStackTrace(capture);
+                        status = 1;
+                    }
+                }
+                capture.flush();
+                frames.flushLine();
+                System.setOut(out);
+                System.setErr(err);
+            }
+            out.print("E " + status + "\n");
+            out.flush();
+        }
+    }
+
+    /**
+     * Puts values into the environment System.getenv() returns and gives
+     * back the replaced ones, null values remove variables. Needs
+     * java.util opened to the worker on Java 16 and newer.
+     */
+    @SuppressWarnings("unchecked")
+    private static Map<String, String> setEnv(Map<String, String> values) throws ReflectiveOperationException {
+        Map<String, String> previous = new HashMap<>();
+        if (values.isEmpty()) {
+            return previous;
+        }
+        Map<String, String> view = System.getenv();
+        Field field = view.getClass().getDeclaredField("m");
+        field.setAccessible(true);
+        Map<String, String> env = (Map<String, String>) field.get(view);
+        for (Map.Entry<String, String> entry : values.entrySet()) {
+            previous.put(entry.getKey(), view.get(entry.getKey()));
+            if (entry.getValue() == null) {
+                env.remove(entry.getKey());
+            } else {
+                env.put(entry.getKey(), entry.getValue());
+            }
+        }
+        return previous;
+    }
+
+    private static void run(String[] args) throws Exception {
+        // Main.main() exits the JVM after reversing, so call it directly
+        if (args.length == 1 && args[0].startsWith("reverse=")) {
+            new Reversal(args[0].substring("reverse=".length())).reverse();
+            return;
+        }
+        Main.main(args);
+    }
+}
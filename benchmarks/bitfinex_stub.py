@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import base64
+import struct
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HOUR_MS = 60 * 60 * 1000
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# Candles sent in a subscription snapshot
+SNAPSHOT_SIZE = 240
+
+
+def _ws_frame(text, opcode=0x1):
+    data = text.encode() if isinstance(text, str) else text
+    if len(data) < 126:
+        header = struct.pack("!BB", 0x80 | opcode, len(data))
+    elif len(data) < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, len(data))
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, len(data))
+    return header + data
+
+
+def _read_ws_frame(rfile):
+    # Returns (opcode, payload), client frames are always masked
+    header = rfile.read(2)
+    if len(header) < 2:
+        return (0x8, b"")
+    opcode = header[0] & 0x0f
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", rfile.read(8))[0]
+    mask = rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+    payload = bytearray(rfile.read(length))
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return (opcode, bytes(payload))
+
+
+class BitfinexStub:
+    """Local stand-in for Bitfinex candles REST endpoint and candle channel
+    of WebSocket API v2, for tests and benchmarks.
+
+    Candles are [time, open, close, high, low, volume] lists. push() stores
+    a candle and sends it to subscribed clients, drop_connections() closes
+    all of them to test reconnects.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._lock = threading.Lock()
+        # market symbol -> dict: time -> candle
+        self._candles = dict()
+        # client -> dict: chanId -> market symbol
+        self._clients = dict()
+        self._next_channel = 1
+        self.rest_requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if self.headers.get("Upgrade", "").lower() == "websocket":
+                    stub._serve_websocket(self)
+                else:
+                    stub._serve_rest(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bitfinex_stub", daemon=True)
+
+    @property
+    def rest_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v2"
+
+    @property
+    def ws_url(self):
+        host, port = self._server.server_address[:2]
+        return f"ws://{host}:{port}/ws/2"
+
+    @property
+    def subscriptions(self):
+        # Candle channels subscribed over all connections
+        with self._lock:
+            return sum(len(channels) for channels in self._clients.values())
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.drop_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def set_candles(self, market_symbol, candles):
+        with self._lock:
+            self._candles[market_symbol] = {int(c[0]): list(c) for c in candles}
+
+    def push(self, market_symbol, candle):
+        with self._lock:
+            self._candles.setdefault(market_symbol, dict())[int(candle[0])] = list(candle)
+            clients = [(client, channel) for client, channels in self._clients.items()
+                       for channel, symbol in channels.items() if symbol == market_symbol]
+        for client, channel in clients:
+            self._send(client, [channel, list(candle)])
+
+    def drop_connections(self):
+        with self._lock:
+            clients = list(self._clients)
+            self._clients = dict()
+        for client in clients:
+            try:
+                client.wfile.write(_ws_frame(b"", 0x8))
+                client.connection.close()
+            except OSError:
+                pass
+
+    def _send(self, client, message):
+        try:
+            with client.send_lock:
+                client.wfile.write(_ws_frame(json.dumps(message)))
+                client.wfile.flush()
+        except OSError:
+            pass
+
+    def _serve_rest(self, request):
+        # /v2/candles/trade:1h:<symbol>/hist?start=&end=&limit=&sort=
+        url = urlparse(request.path)
+        parts = url.path.split("/")
+        query = parse_qs(url.query)
+        if len(parts) < 4 or parts[2] != "candles":
+            request.send_error(404)
+            return
+        market_symbol = parts[3].split(":")[-1]
+        start = int(query.get("start", [0])[0])
+        end = int(query.get("end", [2 ** 62])[0])
+        limit = int(query.get("limit", [120])[0])
+        with self._lock:
+            self.rest_requests += 1
+            candles = sorted(c for t, c in self._candles.get(market_symbol, dict()).items() if start <= t <= end)
+        if query.get("sort", ["-1"])[0] == "-1":
+            candles = candles[::-1]
+        body = json.dumps(candles[:limit]).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _serve_websocket(self, request):
+        accept = base64.b64encode(hashlib.sha1((request.headers["Sec-WebSocket-Key"] + WS_GUID).encode()).digest())
+        request.send_response(101, "Switching Protocols")
+        request.send_header("Upgrade", "websocket")
+        request.send_header("Connection", "Upgrade")
+        request.send_header("Sec-WebSocket-Accept", accept.decode())
+        request.end_headers()
+        request.wfile.flush()
+        request.send_lock = threading.Lock()
+        with self._lock:
+            self._clients[request] = dict()
+        self._send(request, {'event': 'info', 'version': 2, 'platform': {'status': 1}})
+        try:
+            while True:
+                opcode, payload = _read_ws_frame(request.rfile)
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    with request.send_lock:
+                        request.wfile.write(_ws_frame(payload, 0xA))
+                    continue
+                if opcode == 0x1:
+                    self._handle_message(request, json.loads(payload.decode()))
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._clients.pop(request, None)
+            request.close_connection = True
+
+    def _handle_message(self, client, message):
+        if message.get('event') != 'subscribe' or message.get('channel') != 'candles':
+            self._send(client, {'event': 'error', 'msg': 'unsupported', 'code': 10000})
+            return
+        market_symbol = message['key'].split(":")[-1]
+        with self._lock:
+            channel = self._next_channel
+            self._next_channel += 1
+            if client in self._clients:
+                self._clients[client][channel] = market_symbol
+            candles = sorted(self._candles.get(market_symbol, dict()).values(), reverse=True)[:SNAPSHOT_SIZE]
+        self._send(client, {'event': 'subscribed', 'channel': 'candles', 'chanId': channel, 'key': message['key']})
+        self._send(client, [channel, candles])
+
+
+def synthetic_candles(start, hours, price=100.0):
+    # Deterministic random walk, one candle per hour from start (ms)
+    candles = []
+    for i in range(hours):
+        step = ((i * 7919) % 13 - 6) / 1000.0
+        close = price * (1 + step)
+        candles.append([start + i * HOUR_MS, price, close, max(price, close) * 1.002, min(price, close) * 0.998, 10.0])
+        price = close
+    return candles
+
+
+def main(argv):
+    usage = "usage: {} port market_symbol [market_symbol ...]".format(argv[0])
+    if len(argv) < 3:
+        print(usage)
+        sys.exit(1)
+    # Serves 30 days of synthetic history and updates candles of the
+    # current hour every few seconds
+    stub = BitfinexStub(port=int(argv[1])).start()
+    now = int(time.time() * 1000) // HOUR_MS * HOUR_MS
+    for market_symbol in argv[2:]:
+        stub.set_candles(market_symbol, synthetic_candles(now - 30 * 24 * HOUR_MS, 30 * 24 + 1))
+    print(f"REST {stub.rest_url}, WebSocket {stub.ws_url}")
+    try:
+        while True:
+            time.sleep(5)
+            hour = int(time.time() * 1000) // HOUR_MS * HOUR_MS
+            for market_symbol in argv[2:]:
+                stub.push(market_symbol, synthetic_candles(hour, 1, 100.0 + time.time() % 10)[0])
+    except KeyboardInterrupt:
+        stub.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
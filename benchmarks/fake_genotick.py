@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from population import read_config
+
+# Stand-in for "java" running genotick.jar, set GENOTICK_JAVA to
+# "python3 benchmarks/fake_genotick.py" to use it. Serves both one-off runs
+# (-jar genotick.jar args) and the worker protocol of GenotickWorker.java
+# (-cp genotick.jar GenotickWorker.java). Costs are set by environment:
+# Seconds to start, like JVM startup
+START_SECONDS = float(os.environ.get("FAKE_GENOTICK_START_SECONDS", "0.5"))
+# Seconds per predicted candle
+PREDICT_SECONDS = float(os.environ.get("FAKE_GENOTICK_PREDICT_SECONDS", "0.05"))
+# Seconds per training run
+TRAIN_SECONDS = float(os.environ.get("FAKE_GENOTICK_TRAIN_SECONDS", "2"))
+# Memory held by the process, like JVM heap with a loaded population
+MEMORY_MB = int(os.environ.get("FAKE_GENOTICK_MEMORY_MB", "0"))
+HOUR_MS = 60 * 60 * 1000
+PREDICTIONS = ("DOWN", "OUT", "UP")
+
+
+def predict(config, write):
+    # Prints a line for every candle after startTimePoint of every data
+    # file, same format as genotick so Market parses it
+    data_path = config['dataDirectory']
+    start = int(config.get('startTimePoint', 0))
+    for name in sorted(os.listdir(data_path)):
+        if not name.endswith(".csv"):
+            continue
+        with open(os.path.join(data_path, name)) as f:
+            times = [int(line.split(",", 1)[0]) for line in f if line.strip()]
+        for ts in times:
+            if ts < start:
+                continue
+            time.sleep(PREDICT_SECONDS)
+            prediction = PREDICTIONS[(ts // HOUR_MS * 7919) % len(PREDICTIONS)]
+            write(f"{data_path}/{name} for {ts} prediction: {prediction}\n")
+
+
+def train(config, write):
+    # New robots go into the population copy, or to savedPopulation_<pid>
+    # when the run starts without one
+    time.sleep(TRAIN_SECONDS)
+    population = config.get('populationDAO')
+    if population is None or not os.path.isdir(population):
+        population = os.path.join(os.getcwd(), f"savedPopulation_{os.getpid()}")
+        os.makedirs(population, exist_ok=True)
+    with open(os.path.join(population, "robots.txt"), 'a') as f:
+        f.write(f"{time.time()}\n")
+    write(f"Saved population to {population}\n")
+
+
+def run(args, write):
+    # Returns exit status of genotick called with args
+    log_file = os.environ.get("GENOTICK_LOG_FILE")
+    if log_file is not None:
+        with open(log_file, 'a') as f:
+            f.write(f"{args}\n")
+    for arg in args:
+        if arg.startswith("reverse="):
+            return 0
+        if arg.startswith("input=file:"):
+            config = read_config(arg[len("input=file:"):])
+            if config.get('performTraining') == 'true':
+                train(config, write)
+            else:
+                predict(config, write)
+            return 0
+    write(f"Unknown arguments: {args}\n")
+    return 1
+
+
+def serve(stdin, stdout):
+    # Worker protocol, see GenotickWorker.java
+    def write(line):
+        data = line.encode()
+        stdout.write(f"O {len(data)}\n".encode() + data)
+        stdout.flush()
+
+    stdout.write(b"READY\n")
+    stdout.flush()
+    for line in stdin:
+        line = line.decode().rstrip("\r\n")
+        if len(line) == 0:
+            continue
+        fields = line.split("\t")
+        # Environment of this run only
+        env = dict(f[len("ENV:"):].split("=", 1) for f in fields if f.startswith("ENV:"))
+        previous = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            status = run([f for f in fields if not f.startswith("ENV:")], write)
+        except Exception as error:
+            write(f"{error!r}\n")
+            status = 1
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name)
+                else:
+                    os.environ[name] = value
+        stdout.write(f"E {status}\n".encode())
+        stdout.flush()
+
+
+def main(argv):
+    usage = "usage: {} [option...] -jar genotick.jar argument... | {} [option...] -cp genotick.jar GenotickWorker.java".format(
+        argv[0], argv[0])
+    # JVM options of the profile, see jvm_profile.py, and of the worker
+    while len(argv) > 1 and argv[1] not in ("-jar", "-cp"):
+        del argv[1]
+    if len(argv) < 4 or argv[1] not in ("-jar", "-cp"):
+        print(usage)
+        sys.exit(1)
+    # Held until exit
+    ballast = b"\1" * (MEMORY_MB * 1024 * 1024)
+    time.sleep(START_SECONDS)
+    if argv[1] == "-cp":
+        serve(sys.stdin.buffer, sys.stdout.buffer)
+    else:
+        sys.exit(run(argv[3:], lambda line: print(line, end="", flush=True)))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from genotick_worker import run_genotick, close_workers
+from population import PopulationStore, render_config
+
+HOUR_MS = 60 * 60 * 1000
+# Hours predicted by every run, same as a bot that missed a few cycles
+PREDICTED_HOURS = 3
+
+
+def make_markets(path, symbol, markets, tmp_path):
+    # Copies data of one onboarded market into markets directories, all of
+    # them share its current population. Returns list of config paths.
+    population = PopulationStore(os.path.join(path, symbol)).current()
+    if population is None:
+        raise RuntimeError(f"Market {symbol} does not have trained population.")
+    with open(os.path.join(path, symbol, "data", f"{symbol}.csv")) as f:
+        last_ts = int(f.read().splitlines()[-1].split(",")[0])
+    configs = []
+    for m in range(markets):
+        market_path = os.path.join(tmp_path, f"market_{m}")
+        data_path = os.path.join(market_path, "data")
+        os.makedirs(data_path)
+        shutil.copyfile(os.path.join(path, symbol, "data", f"{symbol}.csv"), os.path.join(data_path, f"{symbol}.csv"))
+        config_path = os.path.join(market_path, "config.txt")
+        render_config(os.path.join(path, symbol, "config.txt"), config_path, {
+            'dataDirectory': data_path,
+            'populationDAO': population,
+            'performTraining': 'false',
+            'startTimePoint': last_ts - (PREDICTED_HOURS - 1) * HOUR_MS,
+            'endTimePoint': None,
+        })
+        configs.append((data_path, symbol, config_path))
+    return configs
+
+
+def hourly_cycle(genotick_path, configs, use_worker):
+    # Same genotick calls as Market.genotick_predict() does for every market
+    started = time.perf_counter()
+    for data_path, symbol, config_path in configs:
+        reverse_path = os.path.join(data_path, f"reverse_{symbol}.csv")
+        if os.path.exists(reverse_path):
+            os.remove(reverse_path)
+        for args in ([f"reverse={os.path.join(data_path, symbol + '.csv')}"], [f"input=file:{config_path}"]):
+            returncode, stdout, stderr = run_genotick(genotick_path, args, cwd=data_path, use_worker=use_worker)
+            if returncode != 0:
+                raise RuntimeError(f"Genotick failed on {args}.", stdout, stderr)
+    return time.perf_counter() - started
+
+
+def main(argv):
+    usage = "usage: {} market_path market_symbol [markets] [cycles]".format(argv[0])
+    if len(argv) < 3 or len(argv) > 5:
+        print(usage)
+        sys.exit(1)
+    path = os.path.abspath(argv[1])
+    markets = int(argv[3]) if len(argv) > 3 else 10
+    cycles = int(argv[4]) if len(argv) > 4 else 3
+    genotick_path = os.path.join(path, "genotick", "genotick.jar")
+    tmp_path = tempfile.mkdtemp(prefix="genotick_benchmark_")
+    try:
+        configs = make_markets(path, argv[2], markets, tmp_path)
+        for name, use_worker in (("subprocess", False), ("worker", True)):
+            times = [hourly_cycle(genotick_path, configs, use_worker) for _ in range(cycles)]
+            print(f"{name:>10}: first cycle {times[0]:8.2f} s, "
+                  f"best {min(times):8.2f} s, per market {min(times) / markets:6.2f} s")
+    finally:
+        close_workers()
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(sys.argv)
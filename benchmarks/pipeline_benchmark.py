@@ -0,0 +1,359 @@
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import shutil
+import zipfile
+import datetime
+import resource
+import tempfile
+import threading
+import subprocess as sp
+import numpy as np
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(BENCHMARKS_PATH)
+sys.path.insert(0, ROOT_PATH)
+from bitfinex_stub import BitfinexStub, synthetic_candles
+from telegram_stub import TelegramStub
+
+HOUR_MS = 60 * 60 * 1000
+# Seconds every Telegram send takes in the stub
+TELEGRAM_SEND_DELAY = 0.05
+# Seconds to wait for digest of one cycle in all chats, more than the
+# digest window of a market that failed
+CYCLE_TIMEOUT = 600
+# Seconds to wait for the bot to see all chats and for background jobs
+SETUP_TIMEOUT = 120
+# Seconds between RSS samples of the bot process tree
+RSS_INTERVAL = 0.2
+PERCENTILES = (50, 95, 99)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _pg_command(name):
+    # PG_BIN points to PostgreSQL binaries, Debian keeps them off PATH
+    if os.environ.get("PG_BIN"):
+        return os.path.join(os.environ["PG_BIN"], name)
+    found = shutil.which(name) or (sorted(glob.glob(f"/usr/lib/postgresql/*/bin/{name}")) or [None])[-1]
+    if found is None:
+        raise RuntimeError(f"PostgreSQL {name} not found, set PG_BIN.")
+    return found
+
+
+class ThrowawayPostgres:
+    """Temporary PostgreSQL cluster with markets database, reachable only
+    through a unix socket in its directory. Bot processes find it by PGHOST
+    and PGPORT environment variables.
+    """
+
+    def __init__(self, path, port):
+        self._path = path
+        self._data_path = os.path.join(path, "data")
+        self._port = port
+
+    def start(self):
+        os.makedirs(self._path)
+        sp.run([_pg_command("initdb"), "-D", self._data_path, "--auth=trust", "-E", "UTF8", "-N"],
+               check=True, stdout=sp.DEVNULL)
+        sp.run([_pg_command("pg_ctl"), "-D", self._data_path, "-l", os.path.join(self._path, "postgres.log"), "-w",
+                "-o", f"-k {self._path} -p {self._port} -c listen_addresses=''", "start"],
+               check=True, stdout=sp.DEVNULL)
+        os.environ.update(PGHOST=self._path, PGPORT=str(self._port))
+        sp.run([_pg_command("createdb"), "markets"], check=True)
+        return self
+
+    def stop(self):
+        sp.run([_pg_command("pg_ctl"), "-D", self._data_path, "-m", "immediate", "stop"], stdout=sp.DEVNULL)
+
+
+class RssSampler:
+    """Peak resident memory of this process with all its descendants:
+    market workers, genotick runs and the shared state manager."""
+
+    def __init__(self, interval=RSS_INTERVAL):
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss_sampler", daemon=True)
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self.peak_bytes = 0
+        self.peak_processes = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _tree(self):
+        children = dict()
+        for stat_path in glob.glob("/proc/[0-9]*/stat"):
+            try:
+                with open(stat_path) as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            # Process name may hold spaces, fields after it are fixed
+            pid = int(stat.split(" ", 1)[0])
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+            children.setdefault(ppid, []).append(pid)
+        result = []
+        pending = [os.getpid()]
+        while pending:
+            pid = pending.pop()
+            result.append(pid)
+            pending.extend(children.get(pid, []))
+        return result
+
+    def _rss(self, pid):
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def _run(self):
+        while not self._stopped.is_set():
+            pids = self._tree()
+            self.peak_bytes = max(self.peak_bytes, sum(self._rss(pid) for pid in pids))
+            self.peak_processes = max(self.peak_processes, len(pids))
+            self._stopped.wait(self._interval)
+
+
+def percentiles(samples):
+    if len(samples) == 0:
+        return {f"p{q}": None for q in PERCENTILES}
+    return {f"p{q}": float(np.percentile(samples, q)) for q in PERCENTILES}
+
+
+def histogram_percentile(buckets, q):
+    # buckets - dict: upper bound -> count from /metrics.json, value is
+    # interpolated inside the bucket it falls into
+    counts = list(buckets.values())
+    target = sum(counts) * q / 100.0
+    cumulative = 0
+    lower = 0.0
+    for bound, count in buckets.items():
+        if count > 0 and cumulative + count >= target:
+            if bound == '+Inf':
+                return lower
+            return lower + (float(bound) - lower) * (target - cumulative) / count
+        cumulative += count
+        if bound != '+Inf':
+            lower = float(bound)
+    return lower
+
+
+def stage_latencies(metrics_dump):
+    # Histograms of /metrics.json summed over markets and statuses
+    stages = dict()
+    for h in metrics_dump['histograms']:
+        labels = {k: v for k, v in h['labels'].items() if k not in ('market', 'status')}
+        name = h['name'] + "".join(f" {k}={v}" for k, v in sorted(labels.items()))
+        stage = stages.setdefault(name, {'count': 0, 'sum': 0.0, 'buckets': dict()})
+        stage['count'] += h['count']
+        stage['sum'] += h['sum']
+        for bound, count in h['buckets'].items():
+            stage['buckets'][bound] = stage['buckets'].get(bound, 0) + count
+    result = dict()
+    for name, stage in sorted(stages.items()):
+        result[name] = {'count': stage['count'], 'mean': stage['sum'] / stage['count'] if stage['count'] else 0.0}
+        result[name].update({f"p{q}": histogram_percentile(stage['buckets'], q) for q in PERCENTILES})
+    return result
+
+
+def prepare_path(path):
+    # Genotick directory with the example config, fake genotick does not
+    # read the jar
+    with zipfile.ZipFile(os.path.join(ROOT_PATH, "genotick.zip")) as z:
+        z.extract("genotick/exampleConfigFile.txt", path)
+    open(os.path.join(path, "genotick", "genotick.jar"), 'w').close()
+
+
+def digest_hour(candle_time):
+    # Digest lists predictions under close time of the candle
+    return datetime.datetime.utcfromtimestamp(candle_time // 1000 + 3600).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def run_cycles(manager, bitfinex, telegram, candles, history_hours, chats, cycles, streaming):
+    # Every cycle closes one more candle of every market and waits until
+    # its digest is in all chats. Returns list of cycle reports.
+    reports = []
+    for i in range(cycles):
+        since = len(telegram.deliveries())
+        started = time.time()
+        for market_symbol, market_candles in candles.items():
+            # Candles are in the past, stream closes them at once and cron
+            # job fetches them
+            bitfinex.push(market_symbol, market_candles[history_hours + i])
+        if not streaming:
+            manager._predictions_job()
+        hour = digest_hour(next(iter(candles.values()))[history_hours + i][0])
+
+        def delivered(deliveries):
+            return {d[1]: d[0] for d in deliveries[since:] if d[3] is not None and hour in d[3]}
+
+        if not telegram.wait_for(lambda d: len(delivered(d)) >= chats, CYCLE_TIMEOUT):
+            raise RuntimeError(f"Digest of cycle {i + 1} was not delivered in {CYCLE_TIMEOUT} s.")
+        latencies = [t - started for t in telegram.wait_for(delivered, 0).values()]
+        reports.append({'latency': max(latencies), 'delivery_latencies': latencies})
+        print(f"Cycle {i + 1}: digest in {chats} chats after {max(latencies):.2f} s")
+        # Training goes behind predictions as the half-hour cron job does
+        manager._training_job()
+    return reports
+
+
+def wait_for_jobs(manager, timeout=SETUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = manager.job_stats()
+        if stats['running'] == 0 and stats['queued'] == 0:
+            return
+        time.sleep(0.5)
+
+
+def run(path, bitfinex, telegram, markets, chats, history_hours, cycles, streaming):
+    # Project modules read stand-in addresses from environment on import
+    import requests
+    import bitfinex_api
+    import metrics
+    import onboard
+    from dbmanager import DatabaseManager, get_pool
+    from migrate import migrate
+    from market_manager import MarketManager
+    migrate(get_pool())
+    db = DatabaseManager()
+    prepare_path(path)
+    symbols = [f"tM{m:03d}USD" for m in range(markets)]
+    # Last candle of the history closes a few hours before now, cycles
+    # close the next ones
+    start = (int(time.time() * 1000) // HOUR_MS - history_hours - cycles - 2) * HOUR_MS
+    candles = {s: synthetic_candles(start, history_hours + cycles, 100.0 + m) for m, s in enumerate(symbols)}
+    for market_symbol, market_candles in candles.items():
+        bitfinex.set_candles(market_symbol, market_candles[:history_hours])
+
+    print(f"Onboarding {markets} markets with {history_hours} hours of history...")
+    started = time.perf_counter()
+    # Setup is not measured, it does not wait for the rate limiter
+    bitfinex_api.configure_fetcher(rate_limit=60000, burst=1000)
+    onboard.onboard(path, start, start + history_hours * HOUR_MS, symbols, db)
+    onboard_seconds = time.perf_counter() - started
+    metrics.get_metrics().reset()
+
+    sampler = RssSampler().start()
+    telegram.add_chats(range(1, chats + 1))
+    manager = MarketManager(path, "benchmark", streaming=streaming)
+    manager.start()
+    stopped = threading.Event()
+
+    def process_messages():
+        while not stopped.is_set():
+            manager.process_market_message()
+
+    threading.Thread(target=process_messages, name="market_messages", daemon=True).start()
+    try:
+        deadline = time.monotonic() + SETUP_TIMEOUT
+        while len(db.get_chat_list()) < chats or (streaming and bitfinex.subscriptions < markets):
+            if time.monotonic() > deadline:
+                raise RuntimeError("Bot did not see all chats or did not subscribe to all markets.")
+            time.sleep(0.2)
+        started = time.perf_counter()
+        delivered_before = len(telegram.deliveries())
+        reports = run_cycles(manager, bitfinex, telegram, candles, history_hours, chats, cycles, streaming)
+        cycles_seconds = time.perf_counter() - started
+        delivered = len(telegram.deliveries()) - delivered_before
+        wait_for_jobs(manager)
+        metrics_dump = requests.get(f"http://{metrics.METRICS_ADDRESS}/metrics.json", timeout=10).json()
+        job_stats = manager.job_stats()
+    finally:
+        stopped.set()
+        manager.stop()
+        sampler.stop()
+
+    # First cycle starts worker processes and genotick workers
+    warm = reports[1:] or reports
+    deliveries = [latency for r in warm for latency in r['delivery_latencies']]
+    return {
+        'markets': markets, 'chats': chats, 'history_hours': history_hours, 'cycles': cycles,
+        'mode': 'stream' if streaming else 'cron',
+        'onboard_seconds': onboard_seconds,
+        'first_cycle_seconds': reports[0]['latency'],
+        'cycle_seconds': percentiles([r['latency'] for r in warm]),
+        'delivery_seconds': percentiles(deliveries),
+        'predictions_per_second': markets * cycles / cycles_seconds,
+        'deliveries_per_second': delivered / cycles_seconds,
+        'peak_rss_mb': {
+            'process_tree': sampler.peak_bytes / 2 ** 20,
+            'bot': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'largest_child': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        },
+        'peak_processes': sampler.peak_processes,
+        'jobs': job_stats,
+        'stages': stage_latencies(metrics_dump),
+    }
+
+
+def _format_seconds(values):
+    return "  ".join(f"{k} {'-' if v is None else f'{v:8.3f}'}" for k, v in values.items())
+
+
+def print_report(report):
+    print(f"\n{report['markets']} markets, {report['chats']} chats, {report['history_hours']} hours of history, "
+          f"{report['cycles']} cycles, {report['mode']} mode")
+    print(f"Onboarding           {report['onboard_seconds']:8.2f} s")
+    print(f"First cycle          {report['first_cycle_seconds']:8.2f} s")
+    print(f"Cycle                {_format_seconds(report['cycle_seconds'])} s")
+    print(f"Delivery to chat     {_format_seconds(report['delivery_seconds'])} s")
+    print(f"Throughput           {report['predictions_per_second']:8.2f} predictions/s  "
+          f"{report['deliveries_per_second']:8.2f} deliveries/s")
+    rss = report['peak_rss_mb']
+    print(f"Peak RSS             {rss['process_tree']:8.1f} MB in {report['peak_processes']} processes, "
+          f"bot {rss['bot']:.1f} MB, largest child {rss['largest_child']:.1f} MB")
+    print("Stages (seconds, estimated from histogram buckets):")
+    for name, stage in report['stages'].items():
+        values = {f"p{q}": stage[f"p{q}"] for q in PERCENTILES}
+        print(f"  {name:60} n {stage['count']:6}  mean {stage['mean']:8.3f}  {_format_seconds(values)}")
+
+
+def main(argv):
+    usage = "usage: {} [markets] [chats] [history_hours] [cycles] [cron|stream] [report.json]".format(argv[0])
+    if len(argv) > 7 or (len(argv) > 5 and argv[5] not in ("cron", "stream")):
+        print(usage)
+        sys.exit(1)
+    markets = int(argv[1]) if len(argv) > 1 else 10
+    chats = int(argv[2]) if len(argv) > 2 else 100
+    history_hours = int(argv[3]) if len(argv) > 3 else 2000
+    cycles = int(argv[4]) if len(argv) > 4 else 5
+    streaming = len(argv) > 5 and argv[5] == "stream"
+    tmp_path = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    bitfinex = BitfinexStub().start()
+    telegram = TelegramStub(send_delay=TELEGRAM_SEND_DELAY).start()
+    postgres = ThrowawayPostgres(os.path.join(tmp_path, "postgres"), free_port())
+    os.environ.update(
+        BITFINEX_API_URL=bitfinex.rest_url, BITFINEX_WS_URL=bitfinex.ws_url, TELEGRAM_API_URL=telegram.api_url,
+        GENOTICK_JAVA=f"{sys.executable} {os.path.join(BENCHMARKS_PATH, 'fake_genotick.py')}",
+        METRICS_ADDRESS=f"127.0.0.1:{free_port()}")
+    try:
+        postgres.start()
+        report = run(os.path.join(tmp_path, "markets"), bitfinex, telegram, markets, chats, history_hours, cycles,
+                     streaming)
+    finally:
+        postgres.stop()
+        telegram.close()
+        bitfinex.close()
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print_report(report)
+    if len(argv) > 6:
+        with open(argv[6], 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dbmanager import DatabaseManager, configure_pool, binary_copy_buffer
+from migrate import migrate, get_version
+
+HOUR_MS = 60 * 60 * 1000
+REPEATS = 50
+
+# Hot queries as they were issued before the time series layout
+LEGACY_QUERIES = {
+    'last_history_ts': """SELECT extract(epoch from max(time_stamp))::integer
+        FROM "public".market_history
+        WHERE market_id=(SELECT id FROM "public".market_info
+        WHERE bitfinex_api_symbol=%s);""",
+    'last_predictions_ts': """SELECT extract(epoch from max(time_stamp))::integer
+        FROM "public".market_predictions
+        WHERE market_id=(SELECT id FROM "public".market_info
+        WHERE bitfinex_api_symbol=%s);""",
+    '24h_plot_data': r"""SELECT h.time_stamp, h.close, p.genotick_prediction
+        FROM market_history h
+        INNER JOIN market_predictions p
+        ON h.market_id = p.market_id AND h.time_stamp = p.time_stamp
+        WHERE h.market_id=(SELECT id FROM market_info WHERE bitfinex_api_symbol=%s)
+        AND
+        h.time_stamp >= ((now() at time zone 'utc') - interval '24 hours') at time zone 'utc'
+        ORDER BY h.time_stamp ASC;""",
+}
+
+
+def load_synthetic_data(pool, years, markets):
+    rng = np.random.default_rng(1)
+    stop = (int(time.time() * 1000) // HOUR_MS) * HOUR_MS
+    ts = np.arange(stop - years * 365 * 24 * HOUR_MS, stop + HOUR_MS, HOUR_MS, dtype=np.int64)
+    for m in range(markets):
+        symbol = f"tM{m:03d}USD"
+        with pool.connection() as connection, connection:
+            with connection.cursor() as c:
+                c.execute("""INSERT INTO "public".market_info(name, bitfinex_api_symbol)
+                VALUES(%s, %s) RETURNING id;""", (symbol[1:], symbol))
+                market_id = c.fetchone()[0]
+                close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(ts))))
+                open_ = np.roll(close, 1)
+                open_[0] = close[0]
+                high = np.maximum(open_, close) * 1.002
+                low = np.minimum(open_, close) * 0.998
+                ids = np.full(len(ts), market_id, dtype=np.int32)
+                c.copy_expert("""COPY "public".market_history(market_id, open, high, low, close, time_stamp)
+                FROM STDIN WITH (FORMAT binary);""", binary_copy_buffer([
+                    (ids, 'int4'), (open_, 'float8'), (high, 'float8'),
+                    (low, 'float8'), (close, 'float8'), (ts, 'timestamp')]))
+                predictions = rng.integers(-1, 2, len(ts)).astype(np.int32)
+                c.copy_expert("""COPY "public".market_predictions(market_id, time_stamp, genotick_prediction)
+                FROM STDIN WITH (FORMAT binary);""", binary_copy_buffer([
+                    (ids, 'int4'), (ts, 'timestamp'), (predictions, 'int4')]))
+        print(f"Loaded {len(ts)} candles for {symbol}")
+    with pool.connection() as connection:
+        connection.autocommit = True
+        with connection.cursor() as c:
+            c.execute("VACUUM ANALYZE;")
+        connection.autocommit = False
+
+
+def percentiles(samples):
+    samples = np.array(samples) * 1000
+    return f"p50 {np.percentile(samples, 50):8.3f} ms  p95 {np.percentile(samples, 95):8.3f} ms"
+
+
+def time_calls(call, symbols):
+    samples = []
+    for i in range(REPEATS):
+        started = time.perf_counter()
+        call(symbols[i % len(symbols)])
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_legacy(pool, symbols):
+    def run(query):
+        def call(symbol):
+            with pool.connection() as connection, connection.cursor() as c:
+                c.execute(query, (symbol,))
+                c.fetchall()
+        return call
+    for name, query in LEGACY_QUERIES.items():
+        print(f"  {name:20} {percentiles(time_calls(run(query), symbols))}")
+
+
+def bench_current(db, symbols):
+    calls = {
+        'last_history_ts': db.get_last_history_ts,
+        'last_predictions_ts': db.get_last_predictions_ts,
+        '24h_plot_data': db.get_24h_plot_data,
+    }
+    for name, call in calls.items():
+        print(f"  {name:20} {percentiles(time_calls(call, symbols))}")
+
+
+def main(argv):
+    usage = "usage: {} empty_database [years] [markets]".format(argv[0])
+    if len(argv) < 2 or len(argv) > 4:
+        print(usage)
+        sys.exit(1)
+    years = int(argv[2]) if len(argv) > 2 else 10
+    markets = int(argv[3]) if len(argv) > 3 else 100
+    pool = configure_pool(database=argv[1])
+    with pool.connection() as connection, connection:
+        if get_version(connection) != 0:
+            print(f"Database {argv[1]} is not empty, create a throwaway database for benchmark.")
+            sys.exit(1)
+    migrate(pool, target=1)
+    print(f"Loading {years} years of hourly candles for {markets} markets...")
+    load_synthetic_data(pool, years, markets)
+    symbols = [f"tM{m:03d}USD" for m in np.random.default_rng(2).integers(0, markets, REPEATS)]
+    print("Legacy layout:")
+    bench_legacy(pool, symbols)
+    started = time.perf_counter()
+    migrate(pool)
+    print(f"Migration took {time.perf_counter() - started:.1f} s")
+    with pool.connection() as connection:
+        connection.autocommit = True
+        with connection.cursor() as c:
+            c.execute("VACUUM ANALYZE;")
+        connection.autocommit = False
+    print("Time series layout:")
+    bench_current(DatabaseManager(pool), symbols)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,153 @@
+import sys
+import json
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class TelegramStub:
+    """Local stand-in for the parts of Telegram Bot API the bot uses:
+    getUpdates, sendMessage and sendPhoto, for tests and benchmarks.
+
+    add_chats() makes chats write to the bot. Every delivered message is
+    recorded as (time, chat id, method, text) and can be waited for.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, send_delay=0.0):
+        # send_delay - seconds every send request takes, like Telegram
+        # round trip
+        self._send_delay = send_delay
+        self._cond = threading.Condition()
+        self._updates = []
+        self._deliveries = []
+        self._closed = False
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub._serve(self, parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                # Photo uploads are multipart, only chat_id is needed
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = parse_qs(urlparse(self.path).query)
+                if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+                    marker = b'name="chat_id"\r\n\r\n'
+                    start = body.find(marker) + len(marker)
+                    params['chat_id'] = [body[start:body.find(b"\r\n", start)].decode()]
+                else:
+                    params.update(parse_qs(body.decode()))
+                stub._serve(self, params)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="telegram_stub", daemon=True)
+
+    @property
+    def api_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_chats(self, chat_ids, text="/start"):
+        with self._cond:
+            for chat_id in chat_ids:
+                self._updates.append({'update_id': len(self._updates) + 1,
+                                      'message': {'chat': {'id': chat_id}, 'text': text}})
+            self._cond.notify_all()
+
+    def deliveries(self, since=0.0):
+        with self._cond:
+            return [d for d in self._deliveries if d[0] >= since]
+
+    def wait_for(self, predicate, timeout):
+        # Waits until predicate(deliveries) is true, returns its last result
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                result = predicate(self._deliveries)
+                remaining = deadline - time.monotonic()
+                if result or remaining <= 0:
+                    return result
+                self._cond.wait(remaining)
+
+    def _serve(self, request, params):
+        method = urlparse(request.path).path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in params.items()}
+        if method == "getUpdates":
+            result = self._get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        elif method in ("sendMessage", "sendPhoto"):
+            time.sleep(self._send_delay)
+            result = self._record(int(params['chat_id']), method, params.get('text'))
+        else:
+            self._respond(request, {'ok': False, 'error_code': 404, 'description': "Not Found"})
+            return
+        self._respond(request, {'ok': True, 'result': result})
+
+    def _get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                updates = [u for u in self._updates if u['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if len(updates) > 0 or remaining <= 0 or self._closed:
+                    return updates
+                self._cond.wait(remaining)
+
+    def _record(self, chat_id, method, text):
+        with self._cond:
+            self._deliveries.append((time.time(), chat_id, method, text))
+            message_id = len(self._deliveries)
+            self._cond.notify_all()
+        result = {'message_id': message_id, 'chat': {'id': chat_id}}
+        if method == "sendPhoto":
+            result['photo'] = [{'file_id': f"photo{message_id}"}]
+        return result
+
+    def _respond(self, request, payload):
+        body = json.dumps(payload).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def main(argv):
+    usage = "usage: {} port [chats]".format(argv[0])
+    if len(argv) not in (2, 3):
+        print(usage)
+        sys.exit(1)
+    # Prints every message the bot sends
+    stub = TelegramStub(port=int(argv[1])).start()
+    stub.add_chats(range(1, int(argv[2]) + 1 if len(argv) == 3 else 2))
+    print(f"Bot API {stub.api_url}")
+    seen = 0
+    try:
+        while True:
+            deliveries = stub.deliveries()
+            for sent_at, chat_id, method, text in deliveries[seen:]:
+                print(f"{method} to {chat_id}: {text}")
+            seen = len(deliveries)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stub.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,79 +1,225 @@
-
+import os
 import sys
 import requests
+import requests.adapters
 import json
 import pandas as pd
-import numpy as np
 import datetime
 import calendar
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import TokenBucket
+import metrics
 
-def fetch_data(start, stop, symbol, interval, tick_limit):    
-    td = (datetime.datetime.fromtimestamp(stop / 1000) - datetime.datetime.fromtimestamp(start / 1000))  
-    total_hours = td.days * 24 + td.seconds // 3600
-    data = []
-    while(total_hours):
-        bucket_size = total_hours if tick_limit > total_hours else tick_limit
-        total_hours -= bucket_size
-        end = start + bucket_size * 3600 * 1000
-        query = (f"https://api.bitfinex.com/v2/candles/trade:{interval}:"
-        f"{symbol}/hist?limit={tick_limit}&start={start}&end={end}&sort=-1")        
-        res = requests.get(query).json()
-        data.extend(res)
-        print('Retrieving data from {} to {} for {}'.format(pd.to_datetime(start, unit='ms'), pd.to_datetime(end, unit='ms'), symbol))
-        start = end                                                            
-        time.sleep(1.5)
-    
-    return data
+API_URL = os.environ.get("BITFINEX_API_URL", "https://api.bitfinex.com/v2")
+# Candles endpoint allows 30 requests per minute. Bucket starts with a small
+# burst and refills the rest, so any 60 seconds window stays within quota.
+RATE_LIMIT = 30
+RATE_BURST = 5
+MAX_WORKERS = 8
+MAX_RETRIES = 5
+RATE_LIMIT_PAUSE = 60
+CANDLE_COLUMNS = ['time', 'open', 'close', 'high', 'low', 'volume']
+HOUR_MS = 60 * 60 * 1000
 
-def append_1h_history(start, symbol, file_path):
-    t_stop = calendar.timegm(datetime.datetime.utcnow().timetuple()) * 1000 # s -> ms   
-    bin_size = '1h'
-    limit = 5000
-    pair_data = fetch_data(start=start, stop=t_stop, symbol=symbol, interval=bin_size, tick_limit=limit)        
-    # Remove error messages
-    ind = [np.ndim(x) != 0 for x in pair_data]
-    pair_data = [i for (i, v) in zip(pair_data, ind) if v]
+
+class BitfinexError(Exception):
+    def __init__(self, msg, original_exception=None):
+        if(msg is None):
+            msg = "Bitfinex API error:"
+        if(original_exception is None):
+            super(BitfinexError, self).__init__(msg)
+        else:
+            super(BitfinexError, self).__init__(msg + f": {original_exception}")
+
+
+def _is_error_payload(payload):
+    # Bitfinex reports errors as ["error", code, message] or {"error": ...}
+    if isinstance(payload, dict):
+        return 'error' in payload
+    return isinstance(payload, list) and len(payload) > 0 and payload[0] == "error"
+
+
+def _is_rate_limit_payload(payload):
+    return "ratelimit" in json.dumps(payload).lower()
+
+
+def limiter_settings(rate_limit=RATE_LIMIT, burst=RATE_BURST):
+    # Returns (rate, capacity) of token bucket for the candles endpoint
+    return ((rate_limit - burst) / 60.0, burst)
+
+
+class BitfinexFetcher:
+
+    def __init__(self, api_url=API_URL, rate_limit=RATE_LIMIT, burst=RATE_BURST,
+                 max_workers=MAX_WORKERS, max_retries=MAX_RETRIES, pause=RATE_LIMIT_PAUSE, limiter=None):
+        # limiter - token bucket shared with other processes, created from
+        # rate_limit and burst if not given
+        self._api_url = api_url.rstrip('/')
+        self._max_retries = max_retries
+        self._pause = pause
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._limiter = limiter if limiter is not None else TokenBucket(*limiter_settings(rate_limit, burst))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bitfinex")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._session.close()
+
+    def _windows(self, start, stop, tick_limit):
+        td = (datetime.datetime.fromtimestamp(stop / 1000) - datetime.datetime.fromtimestamp(start / 1000))
+        total_hours = td.days * 24 + td.seconds // 3600
+        windows = []
+        while(total_hours > 0):
+            bucket_size = total_hours if tick_limit > total_hours else tick_limit
+            total_hours -= bucket_size
+            end = start + bucket_size * 3600 * 1000
+            windows.append((start, end))
+            start = end
+        return windows
+
+    def _get_candles(self, symbol, interval, start, end, tick_limit):
+        url = f"{self._api_url}/candles/trade:{interval}:{symbol}/hist"
+        params = {'limit': tick_limit, 'start': start, 'end': end, 'sort': -1}
+        delay = 1.0
+        last_error = None
+        for _ in range(self._max_retries + 1):
+            waited = time.perf_counter()
+            self._limiter.acquire()
+            started = time.perf_counter()
+            metrics.observe("bitfinex_rate_limit_wait_seconds", started - waited, market=symbol)
+            try:
+                response = self._session.get(url, params=params, timeout=30)
+                payload = response.json()
+            except (ValueError, requests.RequestException) as error:
+                last_error = error
+                result = "error"
+            else:
+                if response.status_code == 429 or (_is_error_payload(payload) and _is_rate_limit_payload(payload)):
+                    # Rate limit is global for our IP, hold back every thread
+                    self._limiter.pause(self._pause)
+                    last_error = f"HTTP {response.status_code} {payload}"
+                    result = "rate_limited"
+                elif response.status_code >= 500 or _is_error_payload(payload):
+                    last_error = f"HTTP {response.status_code} {payload}"
+                    result = "error"
+                elif not response.ok:
+                    metrics.inc("bitfinex_requests_total", market=symbol, result="failed")
+                    raise BitfinexError(f"Request for {symbol} candles failed", f"HTTP {response.status_code} {payload}")
+                else:
+                    metrics.observe("bitfinex_request_seconds", time.perf_counter() - started, market=symbol)
+                    metrics.inc("bitfinex_requests_total", market=symbol, result="ok")
+                    metrics.inc("bitfinex_candles_total", len(payload), market=symbol)
+                    print('Retrieved data from {} to {} for {}'.format(pd.to_datetime(start, unit='ms'), pd.to_datetime(end, unit='ms'), symbol))
+                    return payload
+            metrics.inc("bitfinex_requests_total", market=symbol, result=result)
+            time.sleep(delay)
+            delay = min(delay * 2, self._pause)
+        raise BitfinexError(f"Failed to retrieve {symbol} candles from {start} to {end}", last_error)
+
+    def fetch_many(self, jobs, interval='1h', tick_limit=5000):
+        # jobs - iterable of (symbol, start, stop), all page requests of all
+        # markets run in parallel and are paced by the shared rate limiter.
+        # Returns dict: symbol -> list of candles
+        futures = dict()
+        for symbol, start, stop in jobs:
+            futures[symbol] = [self._executor.submit(self._get_candles, symbol, interval, s, e, tick_limit)
+                               for (s, e) in self._windows(start, stop, tick_limit)]
+        result = dict()
+        for symbol, pages in futures.items():
+            data = []
+            for page in pages:
+                data.extend(page.result())
+            result[symbol] = data
+        return result
+
+    def fetch(self, symbol, start, stop, interval='1h', tick_limit=5000):
+        return self.fetch_many([(symbol, start, stop)], interval, tick_limit)[symbol]
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher():
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = BitfinexFetcher()
+        return _fetcher
+
+
+def configure_fetcher(**kwargs):
+    # Replace process-wide fetcher, f.e. to point it to a local stub server
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is not None:
+            _fetcher.close()
+        _fetcher = BitfinexFetcher(**kwargs)
+        return _fetcher
+
+
+def fetch_data(start, stop, symbol, interval, tick_limit):
+    return get_fetcher().fetch(symbol, start, stop, interval, tick_limit)
+
+
+def candles_to_frame(candles):
     # Create pandas data frame and clean data
-    names = ['time', 'open', 'close', 'high', 'low', 'volume']
-    df = pd.DataFrame(pair_data, columns=names)
-    df.drop_duplicates(inplace=True)
+    df = pd.DataFrame(candles, columns=CANDLE_COLUMNS)
+    df.drop_duplicates(subset='time', keep='last', inplace=True)
     df.set_index('time', inplace=True, drop=False)
     df.sort_index(inplace=True)
+    return df
+
+
+def get_1h_history(start, symbol):
+    t_stop = calendar.timegm(datetime.datetime.utcnow().timetuple()) * 1000 # s -> ms
+    bin_size = '1h'
+    limit = 5000
+    pair_data = fetch_data(start=start, stop=t_stop, symbol=symbol, interval=bin_size, tick_limit=limit)
+    df = candles_to_frame(pair_data)
+    # Candle of the current hour is not closed yet, it is stored once closed
+    return df[df['time'] + HOUR_MS <= t_stop]
+
+
+def append_1h_history(start, symbol, file_path):
+    df = get_1h_history(start, symbol)
     # Append to history file
-    with open(file_path, 'a') as f:        
-        df.to_csv(f, header=False, index=False) 
-    # Return data 
-    return df  
+    with open(file_path, 'a') as f:
+        df.to_csv(f, header=False, index=False)
+    # Return data
+    return df
 
 
 def main(argv):
-    usage = "usage: {} start_date end_date market_symbol csv_file_path".format(argv[0])    
+    usage = "usage: {} start_date end_date market_symbol csv_file_path".format(argv[0])
     if len(argv) != 5:
         print(usage)
         sys.exit(1)
     format = "%Y-%m-%d"
-    t_start = calendar.timegm(datetime.datetime.strptime(argv[1], format).timetuple()) * 1000 # s-> ms 
-    t_stop = calendar.timegm(datetime.datetime.strptime(argv[2], format).timetuple()) * 1000 # s -> ms   
+    t_start = calendar.timegm(datetime.datetime.strptime(argv[1], format).timetuple()) * 1000 # s-> ms
+    t_stop = calendar.timegm(datetime.datetime.strptime(argv[2], format).timetuple()) * 1000 # s -> ms
     bin_size = '1h'
-    limit = 5000                
-    
-    pair_data = fetch_data(start=t_start, stop=t_stop, symbol=argv[3], interval=bin_size, tick_limit=limit)        
-    # Remove error messages
-    ind = [np.ndim(x) != 0 for x in pair_data]
-    pair_data = [i for (i, v) in zip(pair_data, ind) if v]
+    limit = 5000
+
+    try:
+        pair_data = fetch_data(start=t_start, stop=t_stop, symbol=argv[3], interval=bin_size, tick_limit=limit)
+    except BitfinexError as error:
+        print(error)
+        sys.exit(1)
     if(len(pair_data) == 0):
         print("Failed to download history data.")
         sys.exit(1)
-    # Create pandas data frame and clean data
-    names = ['time', 'open', 'close', 'high', 'low', 'volume']
-    df = pd.DataFrame(pair_data, columns=names)
-    df.drop_duplicates(inplace=True)
+    df = candles_to_frame(pair_data)
     # df['time'] = pd.to_datetime(df['time'], unit='ms')
-    df.set_index('time', inplace=True)
-    df.sort_index(inplace=True)
-    df.to_csv(argv[4], header=False)     
+    del df['time']
+    df.to_csv(argv[4], header=False)
     print('Done retrieving data.')
+    get_fetcher().close()
 
 if __name__== "__main__":
     main(sys.argv)
@@ -0,0 +1,159 @@
+import os
+import sys
+import numpy as np
+from reverse_data import reverse_values, format_rows, default_reverse_path
+
+# Same column order as in bitfinex_api.CANDLE_COLUMNS and data CSV files
+CANDLE_DTYPE = np.dtype([('time', '<i8'), ('open', '<f8'), ('close', '<f8'),
+                         ('high', '<f8'), ('low', '<f8'), ('volume', '<f8')])
+VALUE_COLUMNS = list(CANDLE_DTYPE.names[1:])
+# Candles written before the first bar genotick may look back to
+WINDOW_MARGIN = 24
+HOUR_MS = 60 * 60 * 1000
+
+
+def _values(records):
+    return np.stack([records[name] for name in VALUE_COLUMNS], axis=1)
+
+
+def _to_records(values, times):
+    records = np.empty(len(times), dtype=CANDLE_DTYPE)
+    records['time'] = times
+    for i, name in enumerate(VALUE_COLUMNS):
+        records[name] = values[:, i]
+    return records
+
+
+def _dedupe(records):
+    # Sorted by time, last record wins for duplicated timestamps
+    reverse_order = records[::-1]
+    _, index = np.unique(reverse_order['time'], return_index=True)
+    return reverse_order[index]
+
+
+class CandleStore:
+    """Hourly candles of one market in memory mapped binary files.
+
+    candles.bin keeps fixed size records sorted by time, reverse.bin keeps
+    genotick reverse data of the whole history in the same layout. New
+    candles are appended, any other change rewrites files atomically, so
+    readers in other processes always see a consistent prefix.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._candles_path = os.path.join(path, "candles.bin")
+        self._reverse_path = os.path.join(path, "reverse.bin")
+        os.makedirs(path, exist_ok=True)
+        if len(self._map(self._reverse_path)) != len(self.candles()):
+            # Interrupted append, reverse data is derived so rebuild it
+            self._rewrite(self.candles())
+
+    def _map(self, path):
+        try:
+            count = os.path.getsize(path) // CANDLE_DTYPE.itemsize
+        except FileNotFoundError:
+            count = 0
+        if count == 0:
+            return np.empty(0, dtype=CANDLE_DTYPE)
+        return np.memmap(path, dtype=CANDLE_DTYPE, mode='r', shape=(count,))
+
+    def candles(self):
+        return self._map(self._candles_path)
+
+    def reverse(self):
+        return self._map(self._reverse_path)
+
+    def __len__(self):
+        return len(self.candles())
+
+    def last_time(self):
+        candles = self.candles()
+        return None if len(candles) == 0 else int(candles['time'][-1])
+
+    def _rewrite(self, records):
+        reverse = np.empty(0, dtype=CANDLE_DTYPE)
+        if len(records) > 0:
+            reverse = _to_records(reverse_values(_values(records)), records['time'])
+        for path, data in ((self._candles_path, records), (self._reverse_path, reverse)):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(np.ascontiguousarray(data).tobytes())
+            os.replace(tmp_path, path)
+
+    def append(self, df):
+        # Adds candles from data frame with bitfinex_api.CANDLE_COLUMNS,
+        # returns number of candles stored
+        if len(df) == 0:
+            return 0
+        records = _to_records(df[VALUE_COLUMNS].to_numpy(dtype=np.float64),
+                              df['time'].to_numpy(dtype=np.int64))
+        records = _dedupe(records)
+        candles = self.candles()
+        if len(candles) > 0 and records['time'][0] <= candles['time'][-1]:
+            # Updated or missing candles inside history
+            self._rewrite(_dedupe(np.concatenate((np.array(candles), records))))
+            return len(records)
+        if len(candles) == 0:
+            reverse = reverse_values(_values(records))
+        else:
+            last = self.reverse()[-1]
+            reverse = reverse_values(_values(records), candles['open'][-1], last['open'])
+        with open(self._candles_path, 'ab') as f:
+            f.write(records.tobytes())
+        with open(self._reverse_path, 'ab') as f:
+            f.write(_to_records(reverse, records['time']).tobytes())
+        return len(records)
+
+    def gaps(self, interval=HOUR_MS):
+        # Returns list of (first missing, last missing) candle times in ms
+        times = self.candles()['time']
+        index = np.nonzero(np.diff(times) > interval)[0]
+        return [(int(times[i]) + interval, int(times[i + 1]) - interval) for i in index]
+
+    def import_csv(self, csv_path):
+        # Loads history CSV written before the store existed
+        import pandas as pd
+        from bitfinex_api import CANDLE_COLUMNS
+        # Same values as genotick parses, default parser may be 1 ulp off
+        df = pd.read_csv(csv_path, header=None, names=CANDLE_COLUMNS, float_precision='round_trip')
+        return self.append(df)
+
+    def window(self, start, offset):
+        # Index range of candles from offset + WINDOW_MARGIN bars before start
+        candles = self.candles()
+        first = np.searchsorted(candles['time'], start)
+        return (max(0, first - offset - WINDOW_MARGIN), len(candles))
+
+    def write_csv(self, data_path, start, offset):
+        # Writes data and reverse data files genotick needs for a run that
+        # starts at start (ms). Returns number of candles written.
+        begin, end = self.window(start, offset)
+        reverse = self.reverse()
+        # Another process may be appending, reverse data is written second
+        end = min(end, len(reverse))
+        candles = self.candles()[begin:end]
+        reverse = reverse[begin:end]
+        data_lines = [f"{int(c['time'])}," + ",".join(repr(float(c[name])) for name in VALUE_COLUMNS)
+                      for c in candles]
+        reverse_lines = [",".join(line) for line in format_rows(reverse['time'], _values(reverse))]
+        for path, lines in ((data_path, data_lines), (default_reverse_path(data_path), reverse_lines)):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write("".join(line + "\n" for line in lines))
+            os.replace(tmp_path, path)
+        return len(candles)
+
+
+def main(argv):
+    usage = "usage: {} store_path import csv_file | {} store_path export csv_file start_ms offset".format(argv[0], argv[0])
+    if len(argv) == 4 and argv[2] == "import":
+        print(f"Imported {CandleStore(argv[1]).import_csv(argv[3])} candles.")
+    elif len(argv) == 6 and argv[2] == "export":
+        print(f"Exported {CandleStore(argv[1]).write_csv(argv[3], int(argv[4]), int(argv[5]))} candles.")
+    else:
+        print(usage)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import calendar
+import datetime
+import threading
+import logging
+import logging.handlers
+import pandas as pd
+import bitfinex_api
+import metrics
+
+WS_URL = os.environ.get("BITFINEX_WS_URL", "wss://api-pub.bitfinex.com/ws/2")
+HOUR_MS = 60 * 60 * 1000
+# Seconds after the end of an hour when its candle is closed even if no
+# trade opened the next one
+CLOSE_GRACE = 10
+# Bitfinex sends heartbeats every 15 seconds, connection without any
+# message for this long is dead
+RECEIVE_TIMEOUT = 60
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+# Seconds between checks for added markets
+MARKETS_REFRESH = 300
+# Info event codes which ask to reconnect
+RECONNECT_CODES = (20051, 20060)
+
+
+def _now_ms():
+    return calendar.timegm(datetime.datetime.utcnow().timetuple()) * 1000
+
+
+class CandleStream:
+    """Hourly candles of all markets from one Bitfinex WebSocket connection.
+
+    Candle of an hour is closed when a candle of a later hour arrives or
+    CLOSE_GRACE seconds after the hour ends. Closed candles are passed to
+    on_candles(market_symbol, data_frame) in the stream thread. After every
+    (re)connect candles missed while disconnected are fetched over REST.
+    """
+
+    def __init__(self, get_markets, last_time, on_candles, url=WS_URL):
+        # get_markets() - list of market symbols to subscribe
+        # last_time(market_symbol) - time of the last stored candle in ms
+        self._get_markets = get_markets
+        self._last_time = last_time
+        self._on_candles = on_candles
+        self._url = url
+        self._logger = logging.getLogger('CandleStreamLogger')
+        self._logger.setLevel(logging.ERROR)
+        handler = logging.handlers.SysLogHandler(address='/dev/log')
+        self._logger.addHandler(handler)
+        self._ws = None
+        self._stopped = threading.Event()
+        self._thread = None
+        # chanId -> market symbol
+        self._channels = dict()
+        self._subscribed = set()
+        # market symbol -> latest candle of the current hour
+        self._current = dict()
+        # market symbol -> time of the last closed candle passed on
+        self._closed = dict()
+        self._markets_checked = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="candle_stream", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            ws.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while not self._stopped.is_set():
+            connected = time.monotonic()
+            try:
+                self._connect()
+                self._receive()
+            except Exception:
+                if not self._stopped.is_set():
+                    self._logger.exception("Candle stream disconnected.")
+            finally:
+                self._disconnect()
+            if self._stopped.is_set():
+                break
+            metrics.inc("candle_stream_reconnects_total")
+            # Connection which worked for a while reconnects at once
+            if time.monotonic() - connected > MAX_RECONNECT_DELAY:
+                delay = RECONNECT_DELAY
+            self._stopped.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _connect(self):
+        import websocket
+        self._ws = websocket.create_connection(self._url, timeout=RECEIVE_TIMEOUT)
+        self._channels = dict()
+        self._subscribed = set()
+        self._current = dict()
+        self._subscribe_markets()
+        # Candles closed while there was no connection
+        self._gap_fill(self._subscribed)
+
+    def _disconnect(self):
+        ws, self._ws = self._ws, None
+        if ws is not None:
+            ws.close()
+
+    def _subscribe_markets(self):
+        self._markets_checked = time.monotonic()
+        for market_symbol in self._get_markets():
+            if market_symbol not in self._subscribed:
+                self._ws.send(json.dumps({'event': 'subscribe', 'channel': 'candles',
+                                          'key': f"trade:1h:{market_symbol}"}))
+                self._subscribed.add(market_symbol)
+
+    def _gap_fill(self, market_symbols):
+        # Only closed candles come from get_1h_history
+        for market_symbol in market_symbols:
+            last = self._closed.get(market_symbol)
+            if last is None:
+                last = self._last_time(market_symbol)
+            if last is None:
+                continue
+            df = bitfinex_api.get_1h_history(last + HOUR_MS, market_symbol)
+            if len(df) > 0:
+                metrics.inc("candle_stream_gap_fill_candles_total", len(df), market=market_symbol)
+                self._emit(market_symbol, df)
+
+    def _receive(self):
+        import websocket
+        self._ws.settimeout(1)
+        last_message = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                message = self._ws.recv()
+            except websocket.WebSocketTimeoutException:
+                message = None
+            now = time.monotonic()
+            if message:
+                last_message = now
+                self._handle(json.loads(message))
+            elif now - last_message > RECEIVE_TIMEOUT:
+                raise ConnectionError("No messages from Bitfinex, reconnecting.")
+            elif message is not None:
+                raise ConnectionError("Bitfinex closed connection.")
+            self._close_expired(_now_ms())
+            if now - self._markets_checked > MARKETS_REFRESH:
+                before = set(self._subscribed)
+                self._subscribe_markets()
+                self._gap_fill(self._subscribed - before)
+
+    def _handle(self, message):
+        if isinstance(message, dict):
+            event = message.get('event')
+            if event == 'subscribed':
+                self._channels[message['chanId']] = message['key'].split(':')[-1]
+            elif event == 'info' and message.get('code') in RECONNECT_CODES:
+                raise ConnectionError(f"Bitfinex asks to reconnect: {message}")
+            elif event == 'error':
+                self._logger.error(f"Bitfinex stream error: {message}")
+            return
+        market_symbol = self._channels.get(message[0])
+        if market_symbol is None or message[1] == "hb":
+            return
+        candles = message[1]
+        if len(candles) > 0 and not isinstance(candles[0], list):
+            candles = [candles]
+        # Snapshot is sorted newest first, only its newest candle may be open
+        for candle in sorted(candles, key=lambda c: c[0])[-1:]:
+            self._update(market_symbol, candle)
+
+    def _update(self, market_symbol, candle):
+        current = self._current.get(market_symbol)
+        if current is not None and candle[0] > current[0]:
+            self._close(market_symbol, current)
+        if current is None or candle[0] >= current[0]:
+            self._current[market_symbol] = list(candle)
+
+    def _close_expired(self, now):
+        for market_symbol, candle in list(self._current.items()):
+            if candle[0] + HOUR_MS + CLOSE_GRACE * 1000 <= now:
+                self._close(market_symbol, candle)
+                del self._current[market_symbol]
+
+    def _close(self, market_symbol, candle):
+        if candle[0] <= self._closed.get(market_symbol, -1):
+            return
+        last = self._closed.get(market_symbol)
+        if last is None:
+            last = self._last_time(market_symbol)
+        if last is not None and candle[0] <= last:
+            # Newest candle of the snapshot may be stored already
+            return
+        if last is not None and candle[0] > last + HOUR_MS:
+            # Missed candles or hours without trades, REST returns both
+            # the missed ones and this one
+            self._gap_fill([market_symbol])
+            return
+        metrics.observe("candle_stream_close_delay_seconds", max(0, _now_ms() - candle[0] - HOUR_MS) / 1000,
+                        market=market_symbol)
+        self._emit(market_symbol, pd.DataFrame([candle], columns=bitfinex_api.CANDLE_COLUMNS))
+
+    def _emit(self, market_symbol, df):
+        try:
+            self._on_candles(market_symbol, df)
+        except Exception:
+            # The next close sees a gap before these candles and fetches
+            # them again, handling them twice is harmless
+            self._closed[market_symbol] = int(df['time'].min()) - HOUR_MS
+            self._logger.exception(f"Failed to handle closed candles of market {market_symbol}.")
+            return
+        self._closed[market_symbol] = int(df['time'].max())
+
+
+def main(argv):
+    usage = "usage: {} market_symbol [market_symbol ...]".format(argv[0])
+    if len(argv) < 2:
+        print(usage)
+        sys.exit(1)
+    # Prints closed candles, f.e. to check connection to a stand-in server
+    stream = CandleStream(lambda: argv[1:], lambda market_symbol: None,
+                          lambda market_symbol, df: print(market_symbol, df.to_dict('records')))
+    stream.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stream.stop()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,10 +1,33 @@
 import sys
 import os
 import pwd
+import time
+import threading
+import contextlib
 import psycopg2
+import psycopg2.extensions
+import struct
 import pandas as pd
 import numpy as np
-from io import StringIO
+import metrics
+from io import BytesIO
+
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 30
+# Connections idle for longer than this are checked before checkout
+POOL_HEALTH_CHECK_AGE = 30
+# 2000-01-01 00:00:00 UTC in unix milliseconds, binary COPY timestamps
+# are microseconds since this date
+PG_EPOCH_MS = 946684800000
+PREDICTION_VALUES = {'UP': 1, 'OUT': 0, 'DOWN': -1}
+PREDICTION_NAMES = {value: name for name, value in PREDICTION_VALUES.items()}
+# Channel notified with market symbol when its history or predictions are
+# committed
+MARKET_DATA_CHANNEL = 'market_data'
+# Rows returned by one predictions range query
+MAX_RANGE_ROWS = 10000
 
 class DMError(Exception):
     def __init__(self, msg, original_exception=None):
@@ -15,33 +38,300 @@ class DMError(Exception):
         else:
             super(DMError, self).__init__(msg + f": {original_exception}")
 
-class DatabaseManager:
+def binary_copy_buffer(columns):
+    # Build PostgreSQL binary COPY stream straight from numpy arrays.
+    # columns - list of (array, type) where type is int4, float8 or timestamp,
+    # timestamp arrays hold unix milliseconds. NULLs are not supported.
+    types = {'int4': '>i4', 'float8': '>f8', 'timestamp': '>i8'}
+    fields = [('count', '>i2')]
+    for i, (_, kind) in enumerate(columns):
+        fields.extend([(f'len{i}', '>i4'), (f'value{i}', types[kind])])
+    rows = np.empty(len(columns[0][0]) if columns else 0, dtype=np.dtype(fields))
+    rows['count'] = len(columns)
+    for i, (values, kind) in enumerate(columns):
+        rows[f'len{i}'] = np.dtype(types[kind]).itemsize
+        if kind == 'timestamp':
+            values = (np.asarray(values, dtype=np.int64) - PG_EPOCH_MS) * 1000
+        rows[f'value{i}'] = values
+    buffer = BytesIO()
+    buffer.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0))
+    buffer.write(rows.tobytes())
+    buffer.write(struct.pack('!h', -1))
+    buffer.seek(0)
+    return buffer
+
+
+def _history_copy_buffer(frames, ids):
+    # frames - dict: market symbol -> candles data frame, ids - dict: market
+    # symbol -> id. Returns binary COPY stream of history_staging rows.
+    parts = []
+    for market_symbol, df in frames.items():
+        df = df.drop_duplicates(subset='time', keep='last')
+        parts.append((np.full(len(df), ids[market_symbol], dtype=np.int32), df))
+    return binary_copy_buffer([
+        (np.concatenate([p[0] for p in parts]), 'int4'),
+        (np.concatenate([p[1]['open'].to_numpy(dtype=np.float64) for p in parts]), 'float8'),
+        (np.concatenate([p[1]['high'].to_numpy(dtype=np.float64) for p in parts]), 'float8'),
+        (np.concatenate([p[1]['low'].to_numpy(dtype=np.float64) for p in parts]), 'float8'),
+        (np.concatenate([p[1]['close'].to_numpy(dtype=np.float64) for p in parts]), 'float8'),
+        (np.concatenate([p[1]['time'].to_numpy(dtype=np.int64) for p in parts]), 'timestamp')])
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections shared by the whole process."""
 
-    def __init__(self): 
+    def __init__(self, minconn=POOL_MIN_SIZE, maxconn=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_age=POOL_HEALTH_CHECK_AGE, **connect_kwargs):
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._timeout = timeout
+        self._health_check_age = health_check_age
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        # Idle connections with the time they were returned, used as a stack
+        # so the most recently used connections are reused first
+        self._idle = []
+        self._open = 0
+        self._checkouts = 0
+        self._discarded = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._closed = False
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._open += 1
+
+    def _connect(self):
         try:
-            user = pwd.getpwuid(os.getuid())[0]
-            self._connection = psycopg2.connect(user=user, password="", 
-            database="markets")
+            return psycopg2.connect(**self._connect_kwargs)
         except (Exception, psycopg2.Error) as error :
-            raise DMError(None, error)
+            raise DMError("Failed to connect to database. ", error)
+
+    def dedicated_connection(self):
+        # Connection outside of the pool with the same parameters, f.e. to
+        # LISTEN for notifications. Caller closes it.
+        return self._connect()
+
+    def _is_healthy(self, connection, idle_since):
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self._health_check_age:
+            return True
+        try:
+            with connection.cursor() as c:
+                c.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self._timeout
+        while True:
+            connection = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise DMError("Connection pool is closed.")
+                    if len(self._idle) > 0:
+                        connection, idle_since = self._idle.pop()
+                        break
+                    if self._open < self._maxconn:
+                        self._open += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise DMError(f"Timed out waiting for database connection, pool size {self._maxconn}.")
+                    self._cond.wait(remaining)
+            if create:
+                try:
+                    connection = self._connect()
+                except DMError:
+                    with self._cond:
+                        self._open -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(connection, idle_since):
+                self._discard(connection)
+                continue
+            waited = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._wait_time_total += waited
+                self._wait_time_max = max(self._wait_time_max, waited)
+            return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._open -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def putconn(self, connection, discard=False):
+        if not discard and not connection.closed:
+            try:
+                # Do not leave transactions open on idle connections
+                if connection.status != psycopg2.extensions.STATUS_READY:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or connection.closed or self._closed:
+            self._discard(connection)
+            return
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.getconn()
+        discard = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(connection, discard)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'max_size': self._maxconn,
+                'checkouts': self._checkouts,
+                'discarded': self._discarded,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_max': self._wait_time_max,
+                'wait_time_avg': (self._wait_time_total / self._checkouts) if self._checkouts else 0.0,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for connection, _ in idle:
+            connection.close()
+
+
+def pool_gauges(stats):
+    # ConnectionPool.stats() as metrics gauges, f.e. for a collector of
+    # metrics.add_collector()
+    return [
+        ("db_pool_connections", {'state': 'in_use'}, stats['in_use']),
+        ("db_pool_connections", {'state': 'idle'}, stats['idle']),
+        ("db_pool_max_size", {}, stats['max_size']),
+        ("db_pool_checkouts", {}, stats['checkouts']),
+        ("db_pool_discarded", {}, stats['discarded']),
+        ("db_pool_wait_seconds_total", {}, stats['wait_time_total']),
+        ("db_pool_wait_seconds_max", {}, stats['wait_time_max']),
+    ]
+
+
+_pool = None
+_pool_lock = threading.Lock()
 
-    def __del__(self):
-        if getattr(self, '_connection', None):       
-            self._connection.close()
+
+def _default_connect_kwargs():
+    user = pwd.getpwuid(os.getuid())[0]
+    return {'user': user, 'password': "", 'database': "markets"}
+
+
+def configure_pool(minconn=POOL_MIN_SIZE, maxconn=POOL_MAX_SIZE, timeout=POOL_TIMEOUT, **connect_kwargs):
+    # Replace process-wide pool, connect_kwargs override default connection
+    # parameters, f.e. database name
+    global _pool
+    kwargs = _default_connect_kwargs()
+    kwargs.update(connect_kwargs)
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(minconn, maxconn, timeout, **kwargs)
+        return _pool
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(**_default_connect_kwargs())
+        return _pool
+
+
+class DatabaseManager:
+
+    def __init__(self, pool=None):
+        self._pool = pool if pool is not None else get_pool()
+
+    def pool_stats(self):
+        return self._pool.stats()
 
     def add_chat(self, chat_id):
         try:
             query = "INSERT INTO \"public\".chats(id) VALUES(%s) ON CONFLICT (id) DO NOTHING;"
-            with self._connection:
-                with self._connection.cursor() as c:
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
                     c.execute(query, (chat_id,))
         except (Exception, psycopg2.Error) as error :
             raise DMError("Failed to add bot chat id. ", error)
 
+    def add_chats(self, chat_ids, update_offset=None):
+        # Inserts chats in one statement, Telegram updates offset is stored
+        # in the same transaction so confirmed updates never lose chats.
+        # Returns number of new chats.
+        try:
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    count = 0
+                    if len(chat_ids) > 0:
+                        c.execute("""INSERT INTO "public".chats(id) SELECT unnest(%s::varchar[])
+                        ON CONFLICT (id) DO NOTHING;""", ([str(id) for id in chat_ids],))
+                        count = c.rowcount
+                    if update_offset is not None:
+                        c.execute("""INSERT INTO "public".bot_state(name, value) VALUES('update_offset', %s)
+                        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;""", (update_offset,))
+                    return count
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to add bot chats. ", error)
+
+    def get_update_offset(self):
+        # Next Telegram update id to fetch, None if nothing was fetched yet
+        try:
+            query = "SELECT value FROM \"public\".bot_state WHERE name = 'update_offset';"
+            with self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query)
+                row = c.fetchone()
+                return None if row is None else row[0]
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to get bot updates offset. ", error)
+
+    def remove_chats(self, chat_ids):
+        if len(chat_ids) == 0:
+            return
+        try:
+            query = "DELETE FROM \"public\".chats WHERE id = ANY(%s);"
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query, ([str(id) for id in chat_ids],))
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to remove bot chats. ", error)
+
     def get_chat_list(self):
         try:
             query = "SELECT id FROM \"public\".chats;"
-            with self._connection.cursor() as c:
+            with self._pool.connection() as connection, connection.cursor() as c:
                 c.execute(query)
                 return [item[0] for item in c.fetchall()]
         except (Exception, psycopg2.Error) as error :
@@ -50,7 +340,7 @@ class DatabaseManager:
     def get_markets(self):
         try:
             query = "SELECT bitfinex_api_symbol FROM \"public\".market_info;"
-            with self._connection.cursor() as c:
+            with self._pool.connection() as connection, connection.cursor() as c:
                 c.execute(query)
                 return [item[0] for item in c.fetchall()]
         except (Exception, psycopg2.Error) as error :
@@ -59,7 +349,7 @@ class DatabaseManager:
     def get_market_id(self, market_symbol):
         try:
             query = "SELECT id FROM \"public\".market_info WHERE bitfinex_api_symbol=%s;"
-            with self._connection.cursor() as c:
+            with self._pool.connection() as connection, connection.cursor() as c:
                 c.execute(query, (market_symbol,))
                 record = c.fetchone()
                 if(record[0] is None):
@@ -71,76 +361,159 @@ class DatabaseManager:
 
     def get_last_predictions_ts(self, market_symbol):
         try:
-            query = """SELECT extract(epoch from max(time_stamp))::integer 
-            FROM "public".market_predictions 
-            WHERE market_id=(SELECT id FROM "public".market_info 
-            WHERE bitfinex_api_symbol=%s);"""
-            with self._connection.cursor() as c:
+            query = """SELECT extract(epoch from l.predictions_ts)::integer
+            FROM "public".market_last_ts l
+            INNER JOIN "public".market_info i ON i.id = l.market_id
+            WHERE i.bitfinex_api_symbol=%s;"""
+            with self._pool.connection() as connection, connection.cursor() as c:
                 c.execute(query, (market_symbol,))
-                return c.fetchone()[0]
+                record = c.fetchone()
+                return None if record is None else record[0]
         except (Exception, psycopg2.Error) as error :
             raise DMError(f"Failed to get last predictions timestamp for market {market_symbol}", error)       
 
     def get_last_history_ts(self, market_symbol):
         try:
-            query = """SELECT extract(epoch from max(time_stamp))::integer 
-            FROM "public".market_history 
-            WHERE market_id=(SELECT id FROM "public".market_info 
-            WHERE bitfinex_api_symbol=%s);"""
-            with self._connection.cursor() as c:
+            query = """SELECT extract(epoch from l.history_ts)::integer
+            FROM "public".market_last_ts l
+            INNER JOIN "public".market_info i ON i.id = l.market_id
+            WHERE i.bitfinex_api_symbol=%s;"""
+            with self._pool.connection() as connection, connection.cursor() as c:
                 c.execute(query, (market_symbol,))
                 record = c.fetchone()
-                if(record[0] is None):
+                if(record is None or record[0] is None):
                     raise RuntimeError("no data.")    
                 else:
                     return record[0]
         except (Exception, psycopg2.Error) as error :
             raise DMError(f"Failed to get last history timestamp for market {market_symbol}", error)       
 
+    def add_market(self, market_symbol):
+        # Bot starts predictions for the market on the next hour
+        try:
+            query = """INSERT INTO "public".market_info(name, bitfinex_api_symbol) VALUES(%s, %s)
+            ON CONFLICT (bitfinex_api_symbol) DO NOTHING;"""
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query, (market_symbol[1:], market_symbol))
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to add market {market_symbol}. ", error)
+
+    def _add_markets(self, cursor, market_symbols):
+        # Returns dict: market symbol -> id
+        cursor.execute("""INSERT INTO "public".market_info(name, bitfinex_api_symbol)
+        SELECT substr(s, 2), s FROM unnest(%s::text[]) AS s
+        ON CONFLICT (bitfinex_api_symbol) DO NOTHING;""", (list(market_symbols),))
+        cursor.execute("SELECT bitfinex_api_symbol, id FROM \"public\".market_info WHERE bitfinex_api_symbol = ANY(%s);",
+                       (list(market_symbols),))
+        return dict(cursor.fetchall())
+
+    def get_market_ids(self, market_symbols):
+        try:
+            query = "SELECT bitfinex_api_symbol, id FROM \"public\".market_info WHERE bitfinex_api_symbol = ANY(%s);"
+            with self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query, (list(market_symbols),))
+                ids = dict(c.fetchall())
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to get market ids. ", error)
+        missing = set(market_symbols) - set(ids)
+        if len(missing) > 0:
+            raise DMError(f"Unknown markets: {', '.join(sorted(missing))}")
+        return ids
+
+    def bulk_upsert_history(self, frames, add_markets=False):
+        with metrics.timer("db_query_seconds", operation="upsert_history"):
+            count = self._bulk_upsert_history(frames, add_markets)
+        metrics.inc("db_rows_total", count, operation="upsert_history")
+        return count
+
+    def _bulk_upsert_history(self, frames, add_markets):
+        # frames - dict: market symbol -> candles data frame with time (ms),
+        # open, close, high and low columns. Rows go through a staging table
+        # with binary COPY and are merged, so overlapping candles update
+        # existing rows and replays are safe. add_markets - new markets are
+        # added in the same transaction, so the bot never sees them without
+        # history.
+        frames = {m: df for m, df in frames.items() if len(df) > 0}
+        if len(frames) == 0:
+            return 0
+        try:
+            ids = None if add_markets else self.get_market_ids(frames.keys())
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    if add_markets:
+                        ids = self._add_markets(c, frames.keys())
+                    buffer = _history_copy_buffer(frames, ids)
+                    c.execute("""CREATE TEMP TABLE history_staging (
+                    market_id integer, open double precision, high double precision,
+                    low double precision, close double precision, time_stamp timestamp
+                    ) ON COMMIT DROP;""")
+                    c.copy_expert("COPY history_staging FROM STDIN WITH (FORMAT binary);", buffer)
+                    c.execute("""SELECT "public".create_monthly_partitions('market_history', min(time_stamp), max(time_stamp))
+                    FROM history_staging;""")
+                    c.execute("""INSERT INTO "public".market_history(market_id, open, high, low, close, time_stamp)
+                    SELECT market_id, open, high, low, close, time_stamp FROM history_staging
+                    ON CONFLICT (market_id, time_stamp) DO UPDATE
+                    SET open = EXCLUDED.open, high = EXCLUDED.high, low = EXCLUDED.low, close = EXCLUDED.close;""")
+                    count = c.rowcount
+                    c.execute("""INSERT INTO "public".market_last_ts(market_id, history_ts)
+                    SELECT market_id, max(time_stamp) FROM history_staging GROUP BY market_id
+                    ON CONFLICT (market_id) DO UPDATE
+                    SET history_ts = GREATEST(market_last_ts.history_ts, EXCLUDED.history_ts);""")
+                    c.execute("SELECT pg_notify(%s, market_symbol) FROM unnest(%s::text[]) AS market_symbol;",
+                              (MARKET_DATA_CHANNEL, list(frames)))
+                    return count
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to upsert history for markets {', '.join(frames.keys())}", error)
+
+    def bulk_upsert_predictions(self, predictions):
+        with metrics.timer("db_query_seconds", operation="upsert_predictions"):
+            count = self._bulk_upsert_predictions(predictions)
+        metrics.inc("db_rows_total", count, operation="upsert_predictions")
+        return count
+
+    def _bulk_upsert_predictions(self, predictions):
+        # predictions - dict: market symbol -> list of (timestamp in seconds,
+        # UP/DOWN/OUT). Already stored predictions are kept as they are.
+        predictions = {m: p for m, p in predictions.items() if len(p) > 0}
+        if len(predictions) == 0:
+            return 0
+        try:
+            ids = self.get_market_ids(predictions.keys())
+            market_ids = np.concatenate([np.full(len(p), ids[m], dtype=np.int32) for m, p in predictions.items()])
+            ts = np.array([int(item[0]) * 1000 for p in predictions.values() for item in p], dtype=np.int64)
+            values = np.array([PREDICTION_VALUES[item[1]] for p in predictions.values() for item in p], dtype=np.int32)
+            buffer = binary_copy_buffer([(market_ids, 'int4'), (ts, 'timestamp'), (values, 'int4')])
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute("""CREATE TEMP TABLE predictions_staging (
+                    market_id integer, time_stamp timestamp, genotick_prediction integer
+                    ) ON COMMIT DROP;""")
+                    c.copy_expert("COPY predictions_staging FROM STDIN WITH (FORMAT binary);", buffer)
+                    c.execute("""SELECT "public".create_monthly_partitions('market_predictions', min(time_stamp), max(time_stamp))
+                    FROM predictions_staging;""")
+                    c.execute("""INSERT INTO "public".market_predictions(market_id, time_stamp, genotick_prediction)
+                    SELECT DISTINCT ON (market_id, time_stamp) market_id, time_stamp, genotick_prediction
+                    FROM predictions_staging
+                    ON CONFLICT (market_id, time_stamp) DO NOTHING;""")
+                    count = c.rowcount
+                    c.execute("""INSERT INTO "public".market_last_ts(market_id, predictions_ts)
+                    SELECT market_id, max(time_stamp) FROM predictions_staging GROUP BY market_id
+                    ON CONFLICT (market_id) DO UPDATE
+                    SET predictions_ts = GREATEST(market_last_ts.predictions_ts, EXCLUDED.predictions_ts);""")
+                    c.execute("SELECT pg_notify(%s, market_symbol) FROM unnest(%s::text[]) AS market_symbol;",
+                              (MARKET_DATA_CHANNEL, list(predictions)))
+                    return count
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to upsert predictions for markets {', '.join(predictions.keys())}", error)
+
     def append_market_history(self, df, market_symbol):
-        try:            
-            id = self.get_market_id(market_symbol)
-            del df['volume']
-            df["market_id"] = id
-            df["time"]=(pd.to_datetime(df["time"], unit='ms', utc=True)) 
-            df.rename(columns={'time': 'time_stamp'}, inplace=True)
-            # Initialize a string buffer
-            sio = StringIO()
-            sio.write(df.to_csv(index=None, header=None))  # Write the Pandas DataFrame as a csv to the buffer
-            sio.seek(0)  # Be sure to reset the position to the start of the stream
-            with self._connection:
-                with self._connection.cursor() as c:
-                    c.copy_from(sio, "public.market_history", columns=df.columns, sep=',')                
-        except (Exception, psycopg2.Error) as error :
-            raise DMError(f"Failed to append history for market {market_symbol}", error)                         
-
-    def update_predictions(self, predictions, market_symbol):  
-        # As predictions are for next hours, one prediction will not have a 
-        # record in history     
-        """WITH m AS (SELECT id FROM "public".market_info WHERE name = 'BTCUSD')
-        INSERT INTO "public".market_predictions(time_stamp, market_id, genotick_prediction)
-        SELECT to_timestamp(tmp.ts/1000) AT TIME ZONE 'UTC', (SELECT id FROM m), tmp.pred FROM (VALUES 
-        (1565010000000, 0)
-        ) AS tmp(ts, pred) """
-        try:           
-            query = r"""WITH m AS (SELECT id FROM "public".market_info WHERE name = %s)
-            INSERT INTO "public".market_predictions(time_stamp, market_id, genotick_prediction)
-            SELECT to_timestamp(tmp.ts) AT TIME ZONE 'UTC', (SELECT id FROM m), tmp.pred FROM (VALUES 
-            """
-            query_params = [market_symbol[1:]]
-            for p in predictions:
-                query += "(%s, %s),"
-                # Prediction for next hour
-                val = (0 if p[1] == "OUT" else (-1 if p[1] == "DOWN" else 1))                
-                print("TS:", int(p[0]), "VAL:", val, p[1])
-                query_params.extend([int(p[0]), val])            
-            query = query[:-1]
-            query += r""" ) AS tmp(ts, pred);"""
-            with self._connection:
-                with self._connection.cursor() as c:
-                    c.execute(query, query_params)       
-        except (Exception, psycopg2.Error) as error :
-            raise DMError(f"Failed to update predictions for market {market_symbol}", error)                         
+        self.bulk_upsert_history({market_symbol: df})
+
+    def update_predictions(self, predictions, market_symbol):
+        # As predictions are for next hours, one prediction will not have a
+        # record in history
+        self.bulk_upsert_predictions({market_symbol: predictions})
 
     def get_24h_plot_data(self, market_symbol):
         try:
@@ -153,11 +526,148 @@ class DatabaseManager:
             h.time_stamp >= ((now() at time zone 'utc') - interval '24 hours') at time zone 'utc'
             ORDER BY h.time_stamp ASC;
             """
-            with self._connection.cursor() as c:
+            with self._pool.connection() as connection, connection.cursor() as c:
                 c.execute(query, (market_symbol,))
                 return np.array(c.fetchall())
         except (Exception, psycopg2.Error) as error :
             raise DMError(f"Failed to get data for 24h plot for market {market_symbol}", error)                         
+
+    def get_latest_predictions(self, market_symbols=None):
+        # Newest prediction of given markets (all by default). Returns list
+        # of (market symbol, timestamp in seconds, UP/DOWN/OUT).
+        try:
+            query = """SELECT i.bitfinex_api_symbol, extract(epoch from p.time_stamp)::bigint, p.genotick_prediction
+            FROM "public".market_info i
+            INNER JOIN "public".market_last_ts l ON l.market_id = i.id
+            INNER JOIN "public".market_predictions p
+            ON p.market_id = l.market_id AND p.time_stamp = l.predictions_ts
+            WHERE %s::text[] IS NULL OR i.bitfinex_api_symbol = ANY(%s::text[])
+            ORDER BY i.bitfinex_api_symbol;"""
+            symbols = None if market_symbols is None else list(market_symbols)
+            with metrics.timer("db_query_seconds", operation="latest_predictions"), \
+                    self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query, (symbols, symbols))
+                return [(m, ts, PREDICTION_NAMES.get(p)) for m, ts, p in c.fetchall()]
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to get latest predictions", error)
+
+    def get_predictions_range(self, market_symbol, start, end=None, limit=MAX_RANGE_ROWS):
+        # Predictions with start <= timestamp < end (seconds, end is open by
+        # default) and close of the candle they apply to, if it is stored.
+        # Returns list of (timestamp in seconds, UP/DOWN/OUT, close or None).
+        try:
+            query = """SELECT extract(epoch from p.time_stamp)::bigint, p.genotick_prediction, h.close
+            FROM "public".market_predictions p
+            LEFT JOIN "public".market_history h
+            ON h.market_id = p.market_id AND h.time_stamp = p.time_stamp
+            WHERE p.market_id = (SELECT id FROM "public".market_info WHERE bitfinex_api_symbol = %s)
+            AND p.time_stamp >= to_timestamp(%s) at time zone 'utc'
+            AND p.time_stamp < coalesce(to_timestamp(%s) at time zone 'utc', 'infinity')
+            ORDER BY p.time_stamp ASC
+            LIMIT %s;"""
+            with metrics.timer("db_query_seconds", operation="predictions_range"), \
+                    self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query, (market_symbol, start, end, limit))
+                return [(ts, PREDICTION_NAMES.get(p), close) for ts, p, close in c.fetchall()]
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to get predictions of market {market_symbol}", error)
+
+    def get_prediction_series(self, market_symbol, after_ts=None):
+        # Predictions joined with closed candles they apply to, newer than
+        # after_ts (seconds). Open candle of the current hour is stored in
+        # cron mode, it is evaluated only once closed. Whole series comes
+        # as arrays in one row. Returns dict of numpy arrays: time
+        # (seconds), open, close, prediction.
+        try:
+            query = """SELECT array_agg(extract(epoch from h.time_stamp)::bigint ORDER BY h.time_stamp),
+                array_agg(h.open ORDER BY h.time_stamp),
+                array_agg(h.close ORDER BY h.time_stamp),
+                array_agg(p.genotick_prediction ORDER BY h.time_stamp)
+            FROM "public".market_history h
+            INNER JOIN "public".market_predictions p
+            ON h.market_id = p.market_id AND h.time_stamp = p.time_stamp
+            WHERE h.market_id = (SELECT id FROM "public".market_info WHERE bitfinex_api_symbol = %s)
+            AND p.genotick_prediction IS NOT NULL
+            AND h.time_stamp + interval '1 hour' <= now() at time zone 'utc'
+            AND h.time_stamp > coalesce(to_timestamp(%s) at time zone 'utc', '-infinity');"""
+            with metrics.timer("db_query_seconds", operation="prediction_series"), \
+                    self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query, (market_symbol, after_ts))
+                record = c.fetchone()
+            types = (np.int64, np.float64, np.float64, np.int8)
+            names = ('time', 'open', 'close', 'prediction')
+            return {name: np.array(values or [], dtype=dtype) for name, values, dtype in zip(names, record, types)}
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to get prediction series for market {market_symbol}", error)
+
+    def get_accuracy_state(self, market_symbol):
+        # Returns dict with columns of market_accuracy, None if market was
+        # not evaluated yet
+        try:
+            query = """SELECT extract(epoch from a.evaluated_ts)::bigint, a.predictions, a.directional, a.hits,
+                a.pnl, a.equity, a.peak_equity, a.max_drawdown, a.recent_hits
+            FROM "public".market_accuracy a
+            INNER JOIN "public".market_info i ON i.id = a.market_id
+            WHERE i.bitfinex_api_symbol = %s;"""
+            with self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query, (market_symbol,))
+                record = c.fetchone()
+            if record is None:
+                return None
+            names = ('evaluated_ts', 'predictions', 'directional', 'hits', 'pnl', 'equity', 'peak_equity',
+                     'max_drawdown', 'recent_hits')
+            return dict(zip(names, record))
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to get accuracy of market {market_symbol}", error)
+
+    def save_accuracy_state(self, market_symbol, state):
+        # Older state never replaces a newer one written by another process
+        try:
+            query = """INSERT INTO "public".market_accuracy(market_id, evaluated_ts, predictions, directional,
+                hits, pnl, equity, peak_equity, max_drawdown, recent_hits)
+            SELECT id, to_timestamp(%s) at time zone 'utc', %s, %s, %s, %s, %s, %s, %s, %s::smallint[]
+            FROM "public".market_info WHERE bitfinex_api_symbol = %s
+            ON CONFLICT (market_id) DO UPDATE
+            SET evaluated_ts = EXCLUDED.evaluated_ts, predictions = EXCLUDED.predictions,
+                directional = EXCLUDED.directional, hits = EXCLUDED.hits, pnl = EXCLUDED.pnl,
+                equity = EXCLUDED.equity, peak_equity = EXCLUDED.peak_equity,
+                max_drawdown = EXCLUDED.max_drawdown, recent_hits = EXCLUDED.recent_hits
+            WHERE market_accuracy.evaluated_ts IS NULL OR market_accuracy.evaluated_ts < EXCLUDED.evaluated_ts;"""
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query, (state['evaluated_ts'], state['predictions'], state['directional'],
+                                      state['hits'], state['pnl'], state['equity'], state['peak_equity'],
+                                      state['max_drawdown'], list(state['recent_hits']), market_symbol))
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to save accuracy of market {market_symbol}", error)
+
+    def get_24h_plot_data_all(self):
+        # Same as get_24h_plot_data for every market in one query, returns
+        # dict: market symbol -> data, markets without data are included
+        try:
+            query = r"""SELECT i.bitfinex_api_symbol, d.time_stamp, d.close, d.genotick_prediction
+            FROM market_info i
+            LEFT JOIN (
+                SELECT h.market_id, h.time_stamp, h.close, p.genotick_prediction
+                FROM market_history h
+                INNER JOIN market_predictions p
+                ON h.market_id = p.market_id AND h.time_stamp = p.time_stamp
+                WHERE h.time_stamp >= ((now() at time zone 'utc') - interval '24 hours') at time zone 'utc'
+            ) d
+            ON d.market_id = i.id
+            ORDER BY i.bitfinex_api_symbol, d.time_stamp ASC;
+            """
+            with metrics.timer("db_query_seconds", operation="plot_data_all"), \
+                    self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query)
+                rows = dict()
+                for record in c.fetchall():
+                    market_rows = rows.setdefault(record[0], [])
+                    if record[1] is not None:
+                        market_rows.append(record[1:])
+            return {market: np.array(data) for market, data in rows.items()}
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to get data for 24h plots", error)
               
           
 
@@ -0,0 +1,158 @@
+import sys
+import datetime
+import numpy as np
+from dbmanager import DatabaseManager
+
+# Directional predictions in rolling accuracy
+ROLLING_WINDOW = 168
+# Rolling accuracy below this retrains market before it collects the usual
+# number of new candles
+MIN_ROLLING_ACCURACY = 0.5
+# Directional predictions needed before rolling accuracy is trusted
+MIN_ROLLING_PREDICTIONS = 48
+
+
+def empty_state():
+    return {'evaluated_ts': None, 'predictions': 0, 'directional': 0, 'hits': 0, 'pnl': 0.0,
+            'equity': 1.0, 'peak_equity': 1.0, 'max_drawdown': 0.0, 'recent_hits': []}
+
+
+def step_returns(series):
+    # Return of every candle and of following its prediction: UP holds
+    # the market for the hour, DOWN shorts it, OUT stays aside
+    returns = series['close'] / series['open'] - 1.0
+    return returns, series['prediction'] * returns
+
+
+def hits(series):
+    # Boolean arrays: prediction was directional, direction was right
+    directional = series['prediction'] != 0
+    returns = series['close'] - series['open']
+    return directional, directional & (np.sign(returns) == series['prediction'])
+
+
+def update_state(state, series):
+    # Adds new evaluated candles to state, work is proportional to the
+    # number of new candles only. Returns new state.
+    if len(series['time']) == 0:
+        return state
+    directional, hit = hits(series)
+    _, strategy = step_returns(series)
+    equity = state['equity'] * np.cumprod(1.0 + strategy)
+    peak = np.maximum.accumulate(np.concatenate(([state['peak_equity']], equity)))[1:]
+    drawdown = 1.0 - equity / peak
+    recent = np.concatenate((np.asarray(state['recent_hits'], dtype=np.int8),
+                             hit[directional].astype(np.int8)))[-ROLLING_WINDOW:]
+    return {
+        'evaluated_ts': int(series['time'][-1]),
+        'predictions': state['predictions'] + len(series['time']),
+        'directional': state['directional'] + int(directional.sum()),
+        'hits': state['hits'] + int(hit.sum()),
+        'pnl': state['pnl'] + float(strategy.sum()),
+        'equity': float(equity[-1]),
+        'peak_equity': float(peak[-1]),
+        'max_drawdown': max(state['max_drawdown'], float(drawdown.max())),
+        'recent_hits': recent.tolist(),
+    }
+
+
+def summary(state):
+    # Derived numbers of a state, rates are None without directional calls
+    recent = state['recent_hits']
+    return {
+        'evaluated_ts': state['evaluated_ts'],
+        'predictions': state['predictions'],
+        'directional': state['directional'],
+        'hit_rate': state['hits'] / state['directional'] if state['directional'] else None,
+        'rolling_accuracy': sum(recent) / len(recent) if len(recent) else None,
+        'rolling_predictions': len(recent),
+        'pnl': state['pnl'],
+        'return': state['equity'] - 1.0,
+        'max_drawdown': state['max_drawdown'],
+    }
+
+
+def backtest(series, window=ROLLING_WINDOW):
+    # Full evaluation of a series at once, adds per candle arrays: equity,
+    # drawdown and rolling accuracy over last window directional calls
+    state = update_state(empty_state(), series)
+    directional, hit = hits(series)
+    _, strategy = step_returns(series)
+    equity = np.cumprod(1.0 + strategy)
+    drawdown = 1.0 - equity / np.maximum.accumulate(equity)
+    calls = np.cumsum(directional)
+    right = np.cumsum(hit)
+    # Number of directional calls and hits within the window ending at
+    # every candle
+    index = np.searchsorted(calls, calls - window, side='right') - 1
+    calls_before = np.where(index >= 0, calls[np.maximum(index, 0)], 0)
+    right_before = np.where(index >= 0, right[np.maximum(index, 0)], 0)
+    in_window = calls - calls_before
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rolling = np.where(in_window > 0, (right - right_before) / in_window, np.nan)
+    result = summary(state)
+    result.update(time=series['time'], equity=equity, drawdown=drawdown, rolling_accuracy_series=rolling)
+    return result
+
+
+class Evaluator:
+    """Keeps running accuracy of every market in the database.
+
+    update() evaluates only predictions whose candles closed since the
+    last update, so every hour costs the same regardless of history size.
+    """
+
+    def __init__(self, db=None):
+        self._db = db if db is not None else DatabaseManager()
+
+    def update(self, market_symbol, rebuild=False):
+        # Returns summary of the market after the update
+        state = None if rebuild else self._db.get_accuracy_state(market_symbol)
+        if state is None:
+            state = empty_state()
+        series = self._db.get_prediction_series(market_symbol, state['evaluated_ts'])
+        if len(series['time']) > 0:
+            state = update_state(state, series)
+            self._db.save_accuracy_state(market_symbol, state)
+        return summary(state)
+
+    def backtest(self, market_symbol, window=ROLLING_WINDOW):
+        return backtest(self._db.get_prediction_series(market_symbol), window)
+
+    def needs_training(self, market_symbol):
+        # True if recent predictions are worse than a coin flip
+        result = self.update(market_symbol)
+        return (result['rolling_predictions'] >= MIN_ROLLING_PREDICTIONS
+                and result['rolling_accuracy'] < MIN_ROLLING_ACCURACY)
+
+
+def _percent(value):
+    return "-" if value is None else f"{value * 100:.1f}%"
+
+
+def format_summary(market_symbol, result):
+    if result['evaluated_ts'] is None:
+        return f"{market_symbol[1:]}: no evaluated predictions"
+    evaluated = datetime.datetime.utcfromtimestamp(result['evaluated_ts']).strftime('%Y-%m-%d %H:%M')
+    return (f"{market_symbol[1:]}: hit rate {_percent(result['hit_rate'])} of {result['directional']}, "
+            f"last {result['rolling_predictions']} {_percent(result['rolling_accuracy'])}, "
+            f"return {_percent(result['return'])}, max drawdown {_percent(result['max_drawdown'])} "
+            f"(until {evaluated})")
+
+
+def main(argv):
+    usage = "usage: {} [update|rebuild|backtest] [market_symbol ...]".format(argv[0])
+    if len(argv) < 2 or argv[1] not in ("update", "rebuild", "backtest"):
+        print(usage)
+        sys.exit(1)
+    db = DatabaseManager()
+    evaluator = Evaluator(db)
+    for market_symbol in argv[2:] or db.get_markets():
+        if argv[1] == "backtest":
+            result = evaluator.backtest(market_symbol)
+        else:
+            result = evaluator.update(market_symbol, rebuild=argv[1] == "rebuild")
+        print(format_summary(market_symbol, result))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,244 @@
+import os
+import sys
+import time
+import shutil
+import select
+import tempfile
+from collections import deque
+import subprocess as sp
+import logging
+import logging.handlers
+from jvm_profile import JvmProfile, JvmTimeout, ProcessUsage, PREDICT, run_jvm, join_cgroup, kill_group
+
+WORKER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GenotickWorker.java")
+# Worker sets environment of every run through System.getenv() map
+WORKER_JAVA_OPTIONS = ["--add-opens", "java.base/java.util=ALL-UNNAMED"]
+# Worker JVM is restarted after this number of requests to drop anything
+# genotick leaves behind between runs
+MAX_REQUESTS = 200
+START_TIMEOUT = 60
+# Output lines kept for error messages when output is streamed
+TAIL_LINES = 100
+
+_logger = logging.getLogger('GenotickWorkerLogger')
+_logger.setLevel(logging.ERROR)
+_logger.addHandler(logging.handlers.SysLogHandler(address='/dev/log'))
+
+
+class GenotickWorkerError(Exception):
+    pass
+
+
+class GenotickWorker:
+    """Long-lived JVM running genotick commands, see GenotickWorker.java.
+
+    Saves JVM startup and JIT warm-up on every run. Requests are served
+    one at a time.
+    """
+
+    def __init__(self, genotick_path, profile=None, env=None, max_requests=MAX_REQUESTS):
+        self._genotick_path = genotick_path
+        self._profile = profile if profile is not None else JvmProfile()
+        self._env = env
+        self._max_requests = max_requests
+        self._proc = None
+        self._cwd = None
+        self._requests = 0
+        # Exit status of the last run
+        self._status = None
+
+    @property
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self):
+        # Genotick writes its log files to current directory
+        self._cwd = tempfile.mkdtemp(prefix="genotick_worker_")
+        command = self._profile.command(WORKER_JAVA_OPTIONS + ["-cp", self._genotick_path, WORKER_SOURCE], PREDICT)
+        self._proc = sp.Popen(command, env=self._env, cwd=self._cwd, stdin=sp.PIPE, stdout=sp.PIPE,
+                              stderr=sp.DEVNULL, bufsize=0, start_new_session=True)
+        self._requests = 0
+        try:
+            join_cgroup(self._profile.cgroup, self._proc.pid)
+            line = self._read_line(time.monotonic() + START_TIMEOUT)
+        except (OSError, JvmTimeout) as error:
+            line = str(error).encode()
+        if line != b"READY":
+            self.close()
+            raise GenotickWorkerError(f"Genotick worker failed to start: {line!r}")
+
+    def _read(self, size, deadline):
+        timeout = deadline - time.monotonic()
+        if timeout <= 0 or not select.select([self._proc.stdout], [], [], timeout)[0]:
+            raise JvmTimeout("Genotick worker timed out.")
+        data = os.read(self._proc.stdout.fileno(), size)
+        if len(data) == 0:
+            raise GenotickWorkerError(f"Genotick worker exited with code {self._proc.wait()}.")
+        return data
+
+    def _read_line(self, deadline):
+        line = bytearray()
+        while not line.endswith(b"\n"):
+            line += self._read(1, deadline)
+        return bytes(line[:-1])
+
+    def _read_exact(self, size, deadline):
+        data = bytearray()
+        while len(data) < size:
+            data += self._read(size - len(data), deadline)
+        return bytes(data)
+
+    def run(self, args, on_line, timeout=None, env=None):
+        # Calls on_line for every output line of genotick called with args
+        # and environment variables env set for this run only, as soon as
+        # it is printed. Returns (exit status, usage), usage is
+        # the same dict as jvm_profile.run_jvm() returns. A run over
+        # timeout (prediction timeout of the profile) raises JvmTimeout.
+        if self.alive and self._requests >= self._max_requests:
+            self.close()
+        if not self.alive:
+            self.start()
+        self._requests += 1
+        started = time.monotonic()
+        deadline = started + (timeout or self._profile.predict_timeout)
+        usage = ProcessUsage(self._proc.pid)
+        usage.start()
+        finished = False
+        try:
+            self._send([f"ENV:{name}={value}" for name, value in (env or dict()).items()] + list(args))
+            while True:
+                line = self._receive(deadline)
+                if line is None:
+                    break
+                on_line(line)
+            finished = True
+        finally:
+            if not finished:
+                # Rest of the run's output is left in the pipe, next
+                # request would read it
+                self.close()
+        cpu_seconds, peak_rss_mb = usage.stop()
+        return (self._status, {'pid': self._proc.pid, 'wall_seconds': time.monotonic() - started,
+                               'cpu_seconds': cpu_seconds, 'peak_rss_mb': peak_rss_mb, 'timed_out': False})
+
+    def _send(self, args):
+        try:
+            self._proc.stdin.write(("\t".join(args) + "\n").encode())
+            self._proc.stdin.flush()
+        except OSError as error:
+            raise GenotickWorkerError(f"Genotick worker failed on {args}: {error}")
+
+    def _receive(self, deadline):
+        # Returns next output line of the run, None at its end with exit
+        # status in self._status
+        try:
+            kind, value = self._read_line(deadline).split()
+            if kind == b"E":
+                self._status = int(value)
+                return None
+            return self._read_exact(int(value), deadline).decode().rstrip("\r\n")
+        except (OSError, ValueError) as error:
+            raise GenotickWorkerError(f"Genotick worker failed: {error}")
+
+    def close(self):
+        if self._proc is not None:
+            kill_group(self._proc.pid)
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+        if self._cwd is not None:
+            shutil.rmtree(self._cwd, ignore_errors=True)
+            self._cwd = None
+
+
+_workers = dict()
+
+
+def worker_enabled():
+    return os.environ.get("GENOTICK_WORKER", "1") != "0"
+
+
+def _run_process(genotick_path, args, on_line, env, cwd, profile):
+    command = profile.command(["-jar", genotick_path] + list(args), PREDICT)
+    returncode, usage = run_jvm(command, on_line, profile.predict_timeout, env, cwd, profile.cgroup)
+    if usage['timed_out']:
+        raise JvmTimeout(f"Genotick timed out after {profile.predict_timeout} s on {args}.")
+    return (returncode, usage)
+
+
+def run_genotick(genotick_path, args, env=None, cwd=None, use_worker=None, on_line=None, profile=None,
+                 on_usage=None):
+    # Runs genotick in the warm worker of this process, a failed worker run
+    # is repeated in a separate JVM as before, so on_line may see the same
+    # lines twice. A run over the prediction timeout of profile raises
+    # JvmTimeout and is not repeated. on_usage gets resources of the run
+    # that returned. Returns (returncode, stdout, stderr), with on_line
+    # given stdout keeps only last TAIL_LINES lines for error messages.
+    if use_worker is None:
+        use_worker = worker_enabled()
+    if profile is None:
+        profile = JvmProfile()
+    output = deque(maxlen=None if on_line is None else TAIL_LINES)
+
+    def collect(line):
+        output.append(line)
+        if on_line is not None:
+            on_line(line)
+
+    if use_worker:
+        # Markets with different profiles need JVMs of their own. A process
+        # keeps one warm JVM only, job scheduler counts on that.
+        key = (genotick_path, tuple(profile.command([], PREDICT)), profile.cgroup)
+        worker = _workers.get(key)
+        if worker is None:
+            close_workers()
+            worker = _workers[key] = GenotickWorker(genotick_path, profile=profile)
+        try:
+            returncode, usage = worker.run(args, collect, env=_run_env(env, cwd))
+            if returncode == 0:
+                if on_usage is not None:
+                    on_usage(usage)
+                return (returncode, _join(output), "")
+        except GenotickWorkerError:
+            _logger.exception("Genotick worker failed, falling back to a separate JVM.")
+        output.clear()
+    returncode, usage = _run_process(genotick_path, args, collect, env, cwd, profile)
+    if on_usage is not None:
+        on_usage(usage)
+    return (returncode, _join(output), "")
+
+
+def _run_env(env, cwd):
+    # Variables of env that differ from environment of this process, the
+    # worker shared by markets sets them for one run. Worker runs in its
+    # own directory, so the log file goes to cwd of the run as in a
+    # separate JVM.
+    result = {name: value for name, value in (env or dict()).items() if os.environ.get(name) != value}
+    if cwd is not None and "GENOTICK_LOG_FILE" in result:
+        result["GENOTICK_LOG_FILE"] = os.path.join(cwd, result["GENOTICK_LOG_FILE"])
+    return result
+
+
+def _join(lines):
+    return "".join(f"{line}\n" for line in lines)
+
+
+def close_workers():
+    for worker in _workers.values():
+        worker.close()
+    _workers.clear()
+
+
+def main(argv):
+    usage = "usage: {} genotick_jar genotick_argument...".format(argv[0])
+    if len(argv) < 3:
+        print(usage)
+        sys.exit(1)
+    returncode, stdout, stderr = run_genotick(argv[1], argv[2:])
+    print(stdout, end="")
+    print(stderr, end="", file=sys.stderr)
+    close_workers()
+    sys.exit(returncode)
+
+if __name__ == "__main__":
+    main(sys.argv)
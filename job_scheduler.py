@@ -0,0 +1,233 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+import logging
+import logging.handlers
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.managers import SyncManager
+from rate_limiter import TokenBucket
+from metrics import Metrics
+from jvm_profile import JvmProfile
+from genotick_worker import worker_enabled
+
+# Job priorities, lower value runs first
+PREDICTION = 0
+TRAINING = 1
+PRIORITY_NAMES = {PREDICTION: 'prediction', TRAINING: 'training'}
+
+# Memory of a genotick JVM with default profile, markets may need more or
+# less, see jvm_profile.py
+JVM_MEMORY_MB = JvmProfile().memory_mb
+# Memory left for the bot, database and OS
+RESERVED_MEMORY_MB = 1024
+# Seconds between memory checks while jobs wait for a free slot
+MEMORY_POLL_INTERVAL = 5
+MAX_RECORDS = 1000
+
+
+class SharedStateManager(SyncManager):
+    """Serves objects shared between the bot and market worker processes."""
+
+
+SharedStateManager.register('TokenBucket', TokenBucket)
+SharedStateManager.register('Metrics', Metrics)
+
+
+def _meminfo():
+    # Returns dict: field -> value in MB
+    result = dict()
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                result[name] = int(value.split()[0]) // 1024
+    except (OSError, ValueError):
+        pass
+    return result
+
+
+class JobRecord:
+
+    def __init__(self, key, priority, fn, args, memory_mb):
+        self.key = key
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.memory_mb = memory_mb
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+
+    @property
+    def wait_time(self):
+        return None if self.started_at is None else self.started_at - self.queued_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def to_dict(self):
+        return {'key': self.key, 'priority': PRIORITY_NAMES.get(self.priority, self.priority),
+                'memory_mb': self.memory_mb, 'queued_at': self.queued_at, 'wait_time': self.wait_time,
+                'run_time': self.run_time, 'error': self.error}
+
+
+class JobScheduler:
+    """Runs market jobs in a pool of worker processes.
+
+    Prediction jobs always go ahead of training ones and training never
+    takes the last free slot. Number of concurrent jobs is limited by
+    memory available for genotick JVMs, a job starts only when memory its
+    JVM may take is not promised to running jobs or to warm worker JVMs
+    idle processes keep (one per process, see genotick_worker.py).
+    """
+
+    def __init__(self, max_workers=None, jvm_memory_mb=JVM_MEMORY_MB, reserved_memory_mb=RESERVED_MEMORY_MB,
+                 initializer=None, initargs=()):
+        self._logger = logging.getLogger('JobSchedulerLogger')
+        self._logger.setLevel(logging.ERROR)
+        handler = logging.handlers.SysLogHandler(address='/dev/log')
+        self._logger.addHandler(handler)
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._jvm_memory_mb = jvm_memory_mb
+        self._reserved_memory_mb = reserved_memory_mb
+        # Largest warm worker JVM an idle process may keep, prediction jobs
+        # leave them behind
+        self._warm_memory_mb = 0
+        self._total_memory_mb = _meminfo().get('MemTotal')
+        if self._total_memory_mb is None:
+            self._slots = self._max_workers
+        else:
+            self._slots = max(1, min(self._max_workers, (self._total_memory_mb - reserved_memory_mb) // jvm_memory_mb))
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor = self._make_executor()
+        self._cond = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._keys = set()
+        self._running = dict()
+        self._records = deque(maxlen=MAX_RECORDS)
+        self._closed = False
+        self._broken = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _make_executor(self):
+        return ProcessPoolExecutor(max_workers=self._slots, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=self._initializer, initargs=self._initargs)
+
+    def submit(self, key, priority, fn, *args, memory_mb=None):
+        # memory_mb - memory the job's JVM may take, JVM memory of default
+        # profile if not given. Returns False if job with the same key is
+        # already queued or running.
+        with self._cond:
+            if self._closed or key in self._keys:
+                return False
+            self._keys.add(key)
+            record = JobRecord(key, priority, fn, args, memory_mb or self._jvm_memory_mb)
+            heapq.heappush(self._queue, (priority, next(self._counter), record))
+            self._cond.notify()
+            return True
+
+    def _memory_available(self, record):
+        if len(self._running) == 0:
+            return True
+        # Running JVMs grow up to their heaps, what they did not take yet
+        # is already promised
+        committed = sum(r.memory_mb for r in self._running.values())
+        if worker_enabled():
+            # The job takes one of idle processes, its warm JVM included
+            idle = self._slots - len(self._running) - 1
+            committed += max(0, idle) * self._warm_memory_mb
+        if self._total_memory_mb is not None and \
+                self._total_memory_mb - self._reserved_memory_mb - committed < record.memory_mb:
+            return False
+        available = _meminfo().get('MemAvailable')
+        return available is None or available - self._reserved_memory_mb >= record.memory_mb
+
+    def _can_start(self, record):
+        if len(self._running) >= self._slots:
+            return False
+        if record.priority != PREDICTION:
+            training = sum(1 for r in self._running.values() if r.priority != PREDICTION)
+            if self._slots > 1 and training >= self._slots - 1:
+                return False
+        return self._memory_available(record)
+
+    def _dispatch(self):
+        with self._cond:
+            while not self._closed:
+                if len(self._queue) == 0 or not self._can_start(self._queue[0][2]):
+                    self._cond.wait(MEMORY_POLL_INTERVAL)
+                    continue
+                _, number, record = heapq.heappop(self._queue)
+                if record.priority == PREDICTION:
+                    self._warm_memory_mb = max(self._warm_memory_mb, record.memory_mb)
+                record.started_at = time.time()
+                self._running[number] = record
+                if self._broken:
+                    self._restart_executor()
+                try:
+                    future = self._executor.submit(record.fn, *record.args)
+                except BrokenProcessPool:
+                    self._restart_executor()
+                    future = self._executor.submit(record.fn, *record.args)
+                future.add_done_callback(lambda f, n=number: self._on_done(n, f))
+
+    def _restart_executor(self):
+        # A worker died and took the pool down, start a new one
+        self._logger.error("Worker pool is broken, restarting it.")
+        self._executor.shutdown(wait=False)
+        self._executor = self._make_executor()
+        self._broken = False
+
+    def _on_done(self, number, future):
+        with self._cond:
+            record = self._running.pop(number)
+            record.finished_at = time.time()
+            self._keys.discard(record.key)
+            error = future.exception()
+            if error is not None:
+                record.error = repr(error)
+                self._logger.error(f"Job {record.key} failed: {error!r}")
+                if isinstance(error, BrokenProcessPool):
+                    self._broken = True
+            self._records.append(record)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            result = {'slots': self._slots, 'running': len(self._running), 'queued': len(self._queue)}
+            for priority, name in PRIORITY_NAMES.items():
+                records = [r for r in self._records if r.priority == priority]
+                waits = [r.wait_time for r in records]
+                runs = [r.run_time for r in records]
+                result[name] = {
+                    'completed': len(records),
+                    'failed': sum(1 for r in records if r.error is not None),
+                    'wait_time_avg': sum(waits) / len(waits) if waits else 0.0,
+                    'wait_time_max': max(waits, default=0.0),
+                    'run_time_avg': sum(runs) / len(runs) if runs else 0.0,
+                    'run_time_max': max(runs, default=0.0),
+                }
+            return result
+
+    def recent_jobs(self):
+        with self._cond:
+            return [r.to_dict() for r in self._records]
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._closed = True
+            self._queue = []
+            self._cond.notify_all()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import signal
+import threading
+import subprocess as sp
+
+# Command starting a JVM, f.e. to run genotick under another java or a
+# stand-in for benchmarks
+JAVA_COMMAND = shlex.split(os.environ.get("GENOTICK_JAVA", "java"))
+# Profile of a market overriding defaults below, in the market directory
+PROFILE_FILE = "jvm.json"
+# Kinds of genotick runs
+PREDICT = 'predict'
+TRAIN = 'train'
+# Heap of one genotick JVM, -Xmx
+HEAP_MB = int(os.environ.get("GENOTICK_HEAP_MB", "1536"))
+# Memory a JVM takes on top of its heap: metaspace, threads, code cache
+JVM_OVERHEAD_MB = 512
+# Genotick runs are batch jobs, throughput matters more than pauses
+GC = "ParallelGC"
+# Training runs give way to predictions and to the bot
+TRAIN_NICE = 10
+PREDICT_NICE = 0
+# Level of best-effort I/O class of training runs, 7 is the lowest
+TRAIN_IONICE = 7
+TRAIN_TIMEOUT = 45 * 60
+PREDICT_TIMEOUT = 15 * 60
+DEFAULTS = {
+    'heap_mb': HEAP_MB,
+    'gc': GC,
+    # CPU list like "0-3,6" runs are pinned to, None for all CPUs
+    'cpus': None,
+    # Directory of a delegated cgroup v2 group runs join, f.e. with
+    # cpu.weight and memory.max set, None for none
+    'cgroup': None,
+    'train_nice': TRAIN_NICE,
+    'predict_nice': PREDICT_NICE,
+    'train_ionice': TRAIN_IONICE,
+    'predict_ionice': None,
+    'train_timeout': TRAIN_TIMEOUT,
+    'predict_timeout': PREDICT_TIMEOUT,
+}
+
+
+class JvmTimeout(RuntimeError):
+    pass
+
+
+def parse_cpus(value):
+    # "0-3,6" -> [0, 1, 2, 3, 6]
+    cpus = []
+    for part in str(value).split(","):
+        first, _, last = part.strip().partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class JvmProfile:
+    """Resources given to genotick JVMs of a market: heap, garbage
+    collector, CPUs, cgroup, nice and ionice levels and timeouts of
+    prediction and training runs. Defaults come from DEFAULTS, a market
+    overrides any of them in jvm.json of its directory.
+    """
+
+    def __init__(self, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown JVM profile settings: {', '.join(sorted(unknown))}")
+        for name, value in dict(DEFAULTS, **settings).items():
+            setattr(self, name, value)
+        if self.cpus is not None:
+            parse_cpus(self.cpus)
+
+    @classmethod
+    def load(cls, market_path):
+        try:
+            with open(os.path.join(market_path, PROFILE_FILE)) as f:
+                return cls(**json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in DEFAULTS}
+
+    @property
+    def memory_mb(self):
+        # Memory to reserve for one JVM of this profile
+        return self.heap_mb + JVM_OVERHEAD_MB
+
+    def java_options(self):
+        options = [f"-Xmx{self.heap_mb}m"]
+        if self.gc:
+            options.append(f"-XX:+Use{self.gc}")
+        if self.cpus is not None:
+            # JVM sizes GC and worker threads by CPUs it may use
+            options.append(f"-XX:ActiveProcessorCount={len(parse_cpus(self.cpus))}")
+        return options
+
+    def command(self, java_args, kind):
+        # Full command of a run: ionice, nice and taskset apply before the
+        # JVM starts, so all its threads inherit them
+        prefix = []
+        ionice = getattr(self, f"{kind}_ionice")
+        if ionice is not None and shutil.which("ionice"):
+            prefix += ["ionice", "-c", "2", "-n", str(ionice)]
+        nice = getattr(self, f"{kind}_nice")
+        if nice and shutil.which("nice"):
+            prefix += ["nice", "-n", str(nice)]
+        if self.cpus is not None and shutil.which("taskset"):
+            prefix += ["taskset", "-c", str(self.cpus)]
+        return prefix + JAVA_COMMAND + self.java_options() + list(java_args)
+
+
+def join_cgroup(cgroup, pid):
+    # Moves process with all its threads to the cgroup
+    if cgroup is not None:
+        with open(os.path.join(cgroup, "cgroup.procs"), 'w') as f:
+            f.write(str(pid))
+
+
+def kill_group(pid):
+    # JVMs run in their own process group, anything genotick started goes
+    # down with it
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _exit_code(status):
+    return -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+
+def run_jvm(command, on_line, timeout, env=None, cwd=None, cgroup=None):
+    # Runs command in a new process group and passes its output lines to
+    # on_line. The group is killed after timeout seconds. Returns
+    # (returncode, usage), usage - dict: pid, wall_seconds, cpu_seconds,
+    # peak_rss_mb, timed_out.
+    started = time.monotonic()
+    proc = sp.Popen(command, env=env, cwd=cwd, universal_newlines=True, stdout=sp.PIPE, stderr=sp.STDOUT,
+                    start_new_session=True)
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        kill_group(proc.pid)
+
+    timer = threading.Timer(timeout, expire)
+    timer.daemon = True
+    try:
+        join_cgroup(cgroup, proc.pid)
+        timer.start()
+        for line in proc.stdout:
+            on_line(line.rstrip("\r\n"))
+    except BaseException:
+        kill_group(proc.pid)
+        raise
+    finally:
+        proc.stdout.close()
+        # Reaped here for its resource usage, Popen gets the exit status.
+        # JVM may close its output and still hang f.e. in shutdown hooks,
+        # the timer runs until it exits.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        timer.cancel()
+        proc.returncode = _exit_code(status)
+        kill_group(proc.pid)
+    usage = {
+        'pid': proc.pid,
+        'wall_seconds': time.monotonic() - started,
+        'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+        # Kilobytes on Linux
+        'peak_rss_mb': rusage.ru_maxrss / 1024,
+        'timed_out': timed_out.is_set(),
+    }
+    return (proc.returncode, usage)
+
+
+class ProcessUsage:
+    """CPU time and peak RSS of a running process between start() and
+    stop(), from /proc, for a long-lived JVM serving many runs."""
+
+    def __init__(self, pid):
+        self._pid = pid
+        self._cpu = None
+
+    def _cpu_seconds(self):
+        with open(f"/proc/{self._pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        # utime and stime in clock ticks
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def start(self):
+        try:
+            self._cpu = self._cpu_seconds()
+            # Resets peak RSS of the process
+            with open(f"/proc/{self._pid}/clear_refs", 'w') as f:
+                f.write("5")
+        except (OSError, ValueError, IndexError):
+            pass
+
+    def stop(self):
+        # Returns (cpu seconds, peak RSS in MB), None where not known
+        cpu = peak = None
+        try:
+            if self._cpu is not None:
+                cpu = self._cpu_seconds() - self._cpu
+            with open(f"/proc/{self._pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = int(line.split()[1]) / 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return (cpu, peak)
+
+
+def main(argv):
+    usage = "usage: {} market_path".format(argv[0])
+    if len(argv) != 2:
+        print(usage)
+        sys.exit(1)
+    # Prints profile of a market with the commands it runs
+    profile = JvmProfile.load(argv[1])
+    print(json.dumps(profile.to_dict(), indent=2))
+    print(f"Reserved memory: {profile.memory_mb} MB")
+    for kind in (PREDICT, TRAIN):
+        print(f"{kind}: {shlex.join(profile.command(['-jar', 'genotick.jar'], kind))}")
+
+if __name__ == "__main__":
+    main(sys.argv)
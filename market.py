@@ -1,49 +1,82 @@
-import subprocess as sp
-import datetime
 import sys
 import re
 import os
 import pwd
+import json
+import shutil
+import time
 import logging
 import logging.handlers
+from collections import deque
 import bitfinex_api
+import genotick_worker
+import metrics
+from population import PopulationStore, render_config, read_config
+from candle_store import CandleStore
 from dbmanager import DatabaseManager
-from plot_provider import PlotProvider
-import queue
+from evaluation import Evaluator
+from jvm_profile import JvmProfile, JvmTimeout, PREDICT, TRAIN, run_jvm
+from outbox import Outbox, PREDICTIONS, IMAGE, encode_predictions
+from plot_provider import render_market_24plot
+
+HOUR_MS = 60 * 60 * 1000
+# Retrain market population after this number of new candles
+TRAINING_CANDLES = 24
+# New candles enough to retrain market with poor rolling accuracy
+MIN_RETRAIN_CANDLES = 6
 
 
 class Market:
 
-    def __init__(self, path, symbol, message_queue):
-        self._message_queue = message_queue
-        
+    def __init__(self, path, symbol):
         # Configure logger
         self._logger = logging.getLogger(f"{symbol}_MarketLogger")
         self._logger.setLevel(logging.ERROR)
         handler = logging.handlers.SysLogHandler(address='/dev/log')
         self._logger.addHandler(handler)
 
-        self._plotProvider = PlotProvider()
         # Path structure:
         # path
         #  - genotick/
         #    - genotick.jar
         #  - <market_name>/
-        #    - config.txt
+        #    - config.txt - template for configs of every run
+        #    - candles/ - full history, candles.bin and reverse.bin
         #    - data/
-        #      - <market_symbol>.csv
-        #    - robots/
-        #      - robot files  
+        #      - <market_symbol>.csv, reverse_<market_symbol>.csv - window
+        #        of history needed by the next prediction
+        #    - robots -> populations/<current generation>
+        #    - populations/
+        #      - <generation>/ - robot files
+        #    - runs/
+        #      - <run>/ - generated config.txt, training data and population
+        #    - training.json - last candle used for training
+        #    - jvm.json - optional resource profile of genotick runs, see
+        #      jvm_profile.py
         self._path = os.path.abspath(path)
         self._symbol = symbol
         self._db = DatabaseManager()
+        self._outbox = Outbox()
         self._genotick_path = fr"{self._path}/genotick/genotick.jar"
         self._data_path = fr"{self._path}/{self._symbol}/data/{self._symbol}.csv"
-        self._reverse_data_path = fr"{self._path}/{self._symbol}/data/reverse_{self._symbol}.csv"
+        self._candles = CandleStore(fr"{self._path}/{self._symbol}/candles")
+        if len(self._candles) == 0 and os.path.exists(self._data_path):
+            # Market onboarded with full history CSV
+            self._candles.import_csv(self._data_path)
         self._gen_config_path = fr"{self._path}/{self._symbol}/config.txt"
-        self._robots_path = fr"{self._path}/robots"
+        self._runs_path = fr"{self._path}/{self._symbol}/runs"
+        self._populations = PopulationStore(fr"{self._path}/{self._symbol}")
+        self._training_state_path = fr"{self._path}/{self._symbol}/training.json"
+        self._jvm_profile = JvmProfile.load(fr"{self._path}/{self._symbol}")
+        self._prediction_pattern = re.compile(
+            fr"^[\w\/\s]+\/{self._symbol}\.[\sa-z]+(\d+)[a-z\s]+\:\s(OUT|UP|DOWN)$")
+        # Predictions of the current run: timestamp -> prediction
+        self._predictions = dict()
 
-    def genotick_predict_and_train(self):
+    def genotick_predict(self, fetch_history=True):
+        # fetch_history - False if closed candles are already stored, f.e.
+        # by candle stream of the manager
+        self._predictions = dict()
         try:
             ts_prediction_start = self._db.get_last_predictions_ts(self._symbol)
             ts_history_start = self._db.get_last_history_ts(self._symbol) * 1000            
@@ -51,142 +84,289 @@ class Market:
                 ts_prediction_start = ts_history_start
             else:
                 ts_prediction_start *= 1000
-            ts_history_start += 60 * 60 * 1000
-            print("Collecting history data...")
-            history = bitfinex_api.append_1h_history(
-                ts_history_start, self._symbol, self._data_path)
-            print("Adding data to database...")
-            self._db.append_market_history(history, self._symbol)
+            ts_history_start += HOUR_MS
+            if fetch_history:
+                print("Collecting history data...")
+                with self._stage("fetch"):
+                    history = bitfinex_api.get_1h_history(ts_history_start, self._symbol)
+                with self._stage("store"):
+                    self._candles.append(history)
+                print("Adding data to database...")
+                with self._stage("db_ingest"):
+                    self._db.append_market_history(history, self._symbol)
+            print("Writing data files...")
+            with self._stage("data_files"):
+                self._write_data_files(self._data_path, ts_prediction_start)
             print("Configuring genotick for prediction...")
-            self._configure_genotick_prediction(ts_prediction_start)
-            print("Creating reverse data file...")
-            self._make_reverse_data_file()
+            with self._stage("configure"):
+                run_path = self._make_run_dir("predict")
+                self._configure_genotick_prediction(run_path, ts_prediction_start)
             print("Running genotick for prediction...")
-            predictions = self._parse_prediction_output(self._genotick_predict())
-            if len(predictions) == 0:
+            with self._stage("predict"):
+                self._genotick_predict(run_path)
+            shutil.rmtree(run_path, ignore_errors=True)
+            if len(self._predictions) == 0:
                 self._logger.info(f"No predictions for market {self._symbol}")
-                return
-            print("Queuing predictions and plot to bot queue...")
-            self._enqueue_predictions(predictions)
             #self._enqueue_market_plot()
-            print("Updating predictions in database...")
-            self._db.update_predictions(predictions, self._symbol)            
-            print("Configuring genotick for training...")
-            self._configure_genotick_training(ts_history_start)
-            print("Running genotick for training...")
-            self._genotick_train()
         except Exception:
-            self._logger.exception(f"Failed to predict and train with genotick for market {self._symbol}")
+            metrics.inc("market_job_errors_total", market=self._symbol, job="predict")
+            self._logger.exception(f"Failed to predict with genotick for market {self._symbol}")
+        finally:
+            # Predictions dispatched before a failure stay, digest gets the
+            # final message whichever step failed
+            try:
+                self._enqueue_predictions([], final=True)
+            except Exception:
+                self._logger.exception(f"Failed to send final predictions message of market {self._symbol}")
+
+    def _stage(self, stage):
+        return metrics.timer("market_stage_seconds", market=self._symbol, stage=stage)
+
+    def _read_training_state(self):
+        try:
+            with open(self._training_state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_training_state(self, trained_until):
+        tmp_path = f"{self._training_state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'trained_until': trained_until, 'trained_at': int(time.time())}, f)
+        os.replace(tmp_path, self._training_state_path)
+
+    def _get_training_range(self):
+        # Returns (first candle to train on, last candle in history), in ms
+        last_history_ts = self._db.get_last_history_ts(self._symbol) * 1000
+        state = self._read_training_state()
+        if state is None:
+            # Market was trained during onboarding, start with recent candles
+            start = last_history_ts - (TRAINING_CANDLES - 1) * HOUR_MS
+        else:
+            start = state['trained_until'] + HOUR_MS
+        return (start, last_history_ts)
+
+    def needs_training(self, min_new_candles=TRAINING_CANDLES):
+        start, last_history_ts = self._get_training_range()
+        new_candles = (last_history_ts - start) // HOUR_MS + 1
+        if new_candles >= min_new_candles:
+            return True
+        # Recent predictions are poor, retrain sooner
+        return new_candles >= MIN_RETRAIN_CANDLES and Evaluator(self._db).needs_training(self._symbol)
+
+    def genotick_train(self, force=False):
+        try:
+            if not force and not self.needs_training():
+                return
+            self._train(*self._get_training_range())
+        except Exception:
+            metrics.inc("market_job_errors_total", market=self._symbol, job="train")
+            self._logger.exception(f"Failed to train genotick for market {self._symbol}")
+
+    def genotick_initial_train(self, start):
+        # Trains first population on the whole stored history from start,
+        # errors are raised to the caller
+        self._train(start, self._candles.last_time())
+
+    def _train(self, start, last_history_ts):
+        print("Preparing training data snapshot...")
+        with self._stage("train_snapshot"):
+            run_path = self._make_run_dir("train")
+            self._make_training_snapshot(run_path, start)
+        print("Configuring genotick for training...")
+        self._configure_genotick_training(run_path, start)
+        print("Running genotick for training...")
+        with self._stage("train"):
+            self._genotick_train(run_path)
+        self._write_training_state(last_history_ts)
+        shutil.rmtree(run_path, ignore_errors=True)
+
+    def _make_run_dir(self, kind):
+        # Every genotick run gets its own directory with generated config,
+        # failed runs are left there for inspection
+        run_path = f"{self._runs_path}/{kind}_{int(time.time())}_{os.getpid()}"
+        os.makedirs(run_path)
+        return run_path
+
+    def _make_training_snapshot(self, run_path, start):
+        # Training runs on its own copy of data and population, so hourly
+        # predictions keep using current ones while training is running
+        os.makedirs(f"{run_path}/data")
+        self._write_data_files(f"{run_path}/data/{self._symbol}.csv", start)
+        current = self._populations.current()
+        if current is not None:
+            shutil.copytree(current, f"{run_path}/population")
 
     def _get_custom_env(self):
         result = os.environ.copy()
         result["GENOTICK_LOG_FILE"] = f"{self._symbol}_genotick_log.txt"
         return result
 
-    def _genotick_predict(self):
-        command = ["java",
-                   "-jar",
-                   self._genotick_path,
-                   f"input=file:{self._gen_config_path}"]
-        cp = sp.run(command, env=self._get_custom_env(), universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        if cp.returncode != 0:
-            raise RuntimeError(f"Failed to run genotick in prediction mode for market {self._symbol}.", cp.stdout, cp.stderr)
-        return cp.stdout
-
-    def _parse_prediction_output(self, output):
-        pattern = re.compile(
-            fr"^[\w\/\s]+\/{self._symbol}\.[\sa-z]+(\d+)[a-z\s]+\:\s(OUT|UP|DOWN)$", re.MULTILINE)
-        items = pattern.findall(output)
+    def _genotick_predict(self, run_path):
+        started = time.monotonic()
+        line_number = 0
+
+        def on_line(line):
+            nonlocal line_number
+            line_number += 1
+            event = {'market': self._symbol, 'line': line_number,
+                     'elapsed': round(time.monotonic() - started, 3), 'kind': 'output'}
+            prediction = self._parse_prediction_line(line)
+            if prediction is not None:
+                event.update(kind='prediction', time=prediction[0], prediction=prediction[1])
+                self._dispatch_prediction(prediction)
+            self._report_progress(event)
+
+        try:
+            returncode, stdout, stderr = genotick_worker.run_genotick(
+                self._genotick_path, [f"input=file:{run_path}/config.txt"], env=self._get_custom_env(), cwd=run_path,
+                on_line=on_line, profile=self._jvm_profile, on_usage=lambda usage: self._record_usage(PREDICT, usage))
+        except JvmTimeout:
+            metrics.inc("genotick_timeouts_total", market=self._symbol, kind=PREDICT)
+            raise
+        if returncode != 0:
+            raise RuntimeError(f"Failed to run genotick in prediction mode for market {self._symbol}.", stdout, stderr)
+
+    def _parse_prediction_line(self, line):
+        match = self._prediction_pattern.match(line)
+        if match is None:
+            return None
         # Add one hour for predictions timestamp
-        predictions = list()
-        for item in items:
-            predictions.append((int(item[0])/1000 + 60 * 60, item[1]))
-        return predictions
-
-    def _enqueue_predictions(self, predictions):
-        for p in predictions:
-            ts = datetime.datetime.utcfromtimestamp(int(p[0])).strftime('%Y-%m-%d %H:%M:%S')
-            message = f"{ts} {self._symbol[1:]} {p[1]}"
-            self._message_queue.put({'type': 'text', 'data': message})
-    
+        return (int(match.group(1))/1000 + 60 * 60, match.group(2))
+
+    def _dispatch_prediction(self, prediction):
+        # Every prediction goes to bot and database as soon as genotick
+        # prints it. Worker fallback may repeat lines, skip known ones.
+        if self._predictions.get(prediction[0]) == prediction[1]:
+            return
+        self._predictions[prediction[0]] = prediction[1]
+        # Prediction timestamp is close time of the last candle it used
+        metrics.observe("candle_to_prediction_seconds", time.time() - prediction[0], market=self._symbol)
+        metrics.inc("market_predictions_total", market=self._symbol, prediction=prediction[1])
+        self._enqueue_predictions([prediction])
+        self._db.update_predictions([prediction], self._symbol)
+
+    def _record_usage(self, kind, usage):
+        if usage['cpu_seconds'] is not None:
+            metrics.observe("genotick_cpu_seconds", usage['cpu_seconds'], market=self._symbol, kind=kind)
+        if usage['peak_rss_mb'] is not None:
+            metrics.maximum("genotick_peak_rss_mb", usage['peak_rss_mb'], market=self._symbol, kind=kind)
+        if usage['timed_out']:
+            metrics.inc("genotick_timeouts_total", market=self._symbol, kind=kind)
+        print(f"Genotick {kind} run of market {self._symbol}: {usage['wall_seconds']:.1f} s, "
+              f"CPU {usage['cpu_seconds'] or 0:.1f} s, peak RSS {usage['peak_rss_mb'] or 0:.0f} MB")
+
+    def _report_progress(self, event):
+        # Every output line is counted, predictions are printed with the
+        # rest of job progress
+        metrics.inc("genotick_output_lines_total", market=self._symbol, kind=event['kind'])
+        if event['kind'] == 'prediction':
+            print(json.dumps(event), flush=True)
+
+    def _enqueue_predictions(self, predictions, final=False):
+        # Manager merges predictions of all markets into a digest, final
+        # message tells it that the market is done for this hour
+        self._outbox.enqueue([(PREDICTIONS, encode_predictions(self._symbol, predictions, final))])
+
     def _enqueue_market_plot(self):
         data = self._db.get_24h_plot_data(self._symbol)
-        image = self._plotProvider.get_market_24plot(data, self._symbol[1:])
-        self._message_queue.put({'type': 'image', 'data': image})
-
-    def _remove_old_reverse_data_file(self):
-        command = ["rm", "-f", self._reverse_data_path]
-        cp = sp.run(command, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        if cp.returncode != 0:
-            raise RuntimeError(f"Failed to remove reverse data file for market {self._symbol}.", cp.stdout, cp.stderr)
-
-    def _make_reverse_data_file(self):
-        self._remove_old_reverse_data_file()
-        command = ["java",
-                   "-jar",
-                   self._genotick_path,
-                   f"reverse={self._data_path}"]
-        cp = sp.run(command, env=self._get_custom_env(), universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        if cp.returncode != 0:
-            raise RuntimeError(f"Genotick failed to create reverse data file for market {self._symbol}. ", cp.stdout, cp.stderr)
-
-    def _configure_genotick_prediction(self, start):
-        command = ["sed",
-                   "-i",
-                   "-e",
-                   r"s:\([#\s]*\)\(performTraining\s\+\)\(.\+\):\2false:",
-                   "-e",
-                   fr"s:\([#\s]*\)\(startTimePoint\s\+\)\(.\+\):\2{start}:",
-                   "-e",
-                   r"s/^[^#]*endTimePoint/#&/",
-                   self._gen_config_path]
-        cp = sp.run(command, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        if cp.returncode != 0:
-            raise RuntimeError(f"Failed to configure genotick for prediction for market {self._symbol}.", cp.stdout, cp.stderr)
-
-    def _configure_genotick_training(self, start):
-        command = ["sed",
-                   "-i",
-                   "-e",
-                   r"s:\([#\s]*\)\(performTraining\s\+\)\(.\+\):\2true:",
-                   "-e",
-                   fr"s:\([#\s]*\)\(startTimePoint\s\+\)\(.\+\):\2{start}:",
-                   "-e",
-                   r"s/^[^#]*endTimePoint/#&/",
-                   self._gen_config_path]
-        cp = sp.run(command, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        if cp.returncode != 0:
-            raise RuntimeError(f"Failed to configure genotick for training for market {self._symbol}.", cp.stdout, cp.stderr)
-
-    def _genotick_train(self):
-        command = ["java",
-                   "-jar",
-                   self._genotick_path,
-                   f"input=file:{self._gen_config_path}"]
-        with sp.Popen(command,  env=self._get_custom_env(), universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE) as proc:
-            pid = proc.pid
-            try:
-                outs, errs = proc.communicate(timeout=(45 * 60))
-            except TimeoutError:
-                proc.kill()
-                outs, errs = proc.communicate()
-                raise RuntimeError(f"Failed to run genotick in training mode for market {self._symbol}. Error: {outs}. {errs}")
+        image = render_market_24plot(data, self._symbol[1:])
+        self._outbox.enqueue([(IMAGE, image)])
+
+    def _write_data_files(self, data_path, start):
+        # Genotick gets only candles the run needs, not the whole history
+        offset = int(read_config(self._gen_config_path).get('dataMaximumOffset', 0))
+        candles = self._candles.write_csv(data_path, start, offset)
+        print(f"Wrote {candles} candles to {data_path}")
+
+    def _configure_genotick_prediction(self, run_path, start):
+        # Population is resolved now, so a promotion during the run does not
+        # change robots under genotick
+        current = self._populations.current()
+        if current is None:
+            raise RuntimeError(f"Market {self._symbol} does not have trained population.")
+        render_config(self._gen_config_path, f"{run_path}/config.txt", {
+            'dataDirectory': os.path.dirname(self._data_path),
+            'populationDAO': current,
+            'performTraining': 'false',
+            'startTimePoint': start,
+            'endTimePoint': None,
+        })
+
+    def _configure_genotick_training(self, run_path, start):
+        population_path = f"{run_path}/population"
+        render_config(self._gen_config_path, f"{run_path}/config.txt", {
+            'dataDirectory': f"{run_path}/data",
+            'populationDAO': population_path if os.path.isdir(population_path) else None,
+            'performTraining': 'true',
+            'startTimePoint': start,
+            'endTimePoint': None,
+        })
+
+    def _genotick_train(self, run_path):
+        profile = self._jvm_profile
+        command = profile.command(["-jar", self._genotick_path, f"input=file:{run_path}/config.txt"], TRAIN)
+        output = deque(maxlen=genotick_worker.TAIL_LINES)
+        # Warm prediction JVM of this process gives its memory to training
+        genotick_worker.close_workers()
+        returncode, usage = run_jvm(command, output.append, profile.train_timeout, env=self._get_custom_env(),
+                                    cwd=run_path, cgroup=profile.cgroup)
+        self._record_usage(TRAIN, usage)
+        outs = "\n".join(output)
+        if usage['timed_out']:
+            raise JvmTimeout(f"Genotick training for market {self._symbol} timed out after {profile.train_timeout} s.", outs)
+        if returncode != 0:
+            raise RuntimeError(f"Failed to run genotick in training mode for market {self._symbol}.", outs)
+
+        newRobotsPath = f"{run_path}/savedPopulation_{usage['pid']}"
+        if not os.path.isdir(newRobotsPath):
+            # Genotick updated the population copy in place
+            newRobotsPath = f"{run_path}/population"
+        if not os.path.isdir(newRobotsPath):
+            raise RuntimeError(f"Genotick did not save new robots for market {self._symbol}.", outs)
+        generation = self._populations.promote(newRobotsPath)
+        print(f"New population of market {self._symbol} is {generation}")
+
+
+def init_worker(bitfinex_limiter, metrics_registry=None):
+    # Runs once in every market worker process, all processes share one
+    # Bitfinex rate limiter and metrics registry which live in the bot
+    # process
+    bitfinex_api.configure_fetcher(limiter=bitfinex_limiter)
+    metrics.configure_metrics(metrics_registry)
+
+
+def run_prediction_job(path, market_symbol, fetch_history=True):
+    try:
+        m = Market(path, market_symbol)
+        m.genotick_predict(fetch_history)
+    finally:
+        metrics.flush()
+
 
-        newRobotsPath = f"savedPopulation_{pid}"
-        #print(fr"New population path for market {self._symbol} is {newRobotsPath}")
-        command = ["rm", "-f", "-r", self._robots_path, "&&", "mv", newRobotsPath, self._robots_path]
-        cp = sp.run(command, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        if cp.returncode != 0:
-            raise RuntimeError(f"Failed to move new robots for market {self._symbol}.", cp.stdout, cp.stderr)
+def run_training_job(path, market_symbol):
+    # Returns quickly if market does not have enough new candles yet
+    try:
+        m = Market(path, market_symbol)
+        m.genotick_train()
+    finally:
+        metrics.flush()
 
 
 def main(argv):
-    usage = "usage: {} market_symbol market_path".format(argv[0])
-    if len(argv) != 3:
+    usage = "usage: {} market_symbol market_path [predict|train|rollback]".format(argv[0])
+    if len(argv) not in (3, 4) or (len(argv) == 4 and argv[3] not in ("predict", "train", "rollback")):
         print(usage)
         sys.exit(1)
-    market = Market(argv[2], argv[1], queue.Queue())
-    market.genotick_predict_and_train()
+    if len(argv) == 4 and argv[3] == "rollback":
+        store = PopulationStore(os.path.join(argv[2], argv[1]))
+        print(f"Current population is {store.rollback()}")
+        return
+    market = Market(argv[2], argv[1])
+    if len(argv) == 3 or argv[3] == "predict":
+        market.genotick_predict()
+    if len(argv) == 3 or argv[3] == "train":
+        market.genotick_train(force=True)
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -1,100 +1,331 @@
-from dbmanager import DatabaseManager
-from tgbot import Bot
-from market import Market
+from dbmanager import DatabaseManager, pool_gauges
+from tgbot import Bot, LONG_POLL_TIMEOUT
+import market
+import bitfinex_api
 from plot_provider import PlotProvider
-import threading
+from prediction_digest import PredictionDigest
+from candle_stream import CandleStream
+from candle_store import CandleStore
+import evaluation
+import metrics
+import read_api
+from outbox import Outbox, PREDICTIONS, TEXT, IMAGE, decode_predictions
+from job_scheduler import JobScheduler, SharedStateManager, PREDICTION, TRAINING
+from jvm_profile import JvmProfile
 import sys
 import logging
 import logging.handlers
-import queue
+import threading
+import time
+from io import BytesIO
 from apscheduler.schedulers.background import BackgroundScheduler
 
+# Threads delivering outbox messages to chats
+OUTBOX_CONSUMERS = 4
+# Seconds to wait when outbox has nothing to do
+OUTBOX_POLL_INTERVAL = 1
+# Seconds to wait after failed Telegram updates request
+CHAT_DISCOVERY_RETRY = 10
+# Market prediction messages read at once
+PREDICTIONS_BATCH = 100
+
 
 class MarketManager:
 
-    def __init__(self, path, bot_token):
+    def __init__(self, path, bot_token, streaming=False):
+        # streaming - predictions start when candle stream sees a closed
+        # candle instead of hourly cron job
         self._bot_token = bot_token
         self._logger = logging.getLogger('MarketManagerLogger')
         self._logger.setLevel(logging.ERROR)
         handler = logging.handlers.SysLogHandler(address='/dev/log')
         self._logger.addHandler(handler)
         self._db = DatabaseManager()
+        self._bot = Bot(bot_token)
         self._path = path
         self._scheduler = BackgroundScheduler()
         self._scheduler.add_job(self._daily_market_plot_job, trigger='cron', hour='0')
-        self._scheduler.add_job(self._predictions_job, trigger='cron', hour='*')
-        self._scheduler.add_job(self._bot_job, trigger='cron', minute='*')
-        self._markets = dict()
-        self._message_queue = queue.Queue()
+        if not streaming:
+            self._scheduler.add_job(self._predictions_job, trigger='cron', hour='*')
+        self._scheduler.add_job(self._training_job, trigger='cron', hour='*', minute='30')
+        self._scheduler.add_job(self._purge_outbox_job, trigger='cron', hour='1')
+        # Bitfinex rate limiter is shared with market processes
+        self._shared = SharedStateManager()
+        self._shared.start()
+        # Markets and jobs put messages to the outbox, they survive restarts
+        self._outbox = Outbox()
+        # Claimed prediction messages merged into the current digest
+        self._digest_ids = []
+        # Digest texts waiting to be enqueued with completion of _digest_ids
+        self._digest_texts = []
+        # Close time of the newest candle in the current digest, and of
+        # digest messages waiting for delivery: message id -> time
+        self._digest_close_ts = None
+        self._delivery_close_ts = dict()
+        limiter = self._shared.TokenBucket(*bitfinex_api.limiter_settings())
+        bitfinex_api.configure_fetcher(limiter=limiter)
+        # Market processes flush their metrics here after every job
+        self._job_metrics = self._shared.Metrics()
+        self._jobs = JobScheduler(initializer=market.init_worker, initargs=(limiter, self._job_metrics))
+        self._digest = PredictionDigest()
+        self._plot_provider = PlotProvider()
+        self._evaluator = evaluation.Evaluator(self._db)
+        self._candle_stores = dict()
+        self._stream = None
+        if streaming:
+            self._stream = CandleStream(self._db.get_markets, self._last_candle_time, self._on_closed_candles)
 
     def process_market_message(self):
+        # Merges market predictions into digest, prediction messages are
+        # done in the same transaction as digest text is enqueued. After a
+        # restart unfinished predictions are claimed and merged again.
         try:
-            db = DatabaseManager()
-            bot = Bot(self._bot_token)
-            message = self._message_queue.get()
-            chats = db.get_chat_list()
-            if message["type"] == "text":
-                bot.send_text_message(message["data"], chats)
-            elif message["type"] == "image":
-                bot.send_image(message["data"], chats)
-            self._message_queue.task_done()
+            messages = self._outbox.claim([PREDICTIONS], PREDICTIONS_BATCH)
+            for message_id, _, payload, _ in messages:
+                if message_id in self._digest_ids:
+                    # Claim taken back after a long outage, merged already
+                    continue
+                message = decode_predictions(payload)
+                self._digest.add(message["market"], message["data"], message.get("final", True))
+                self._digest_ids.append(message_id)
+                for p in message["data"]:
+                    self._digest_close_ts = max(self._digest_close_ts or 0, p[0])
+            # Texts are kept until they are enqueued, a failed completion
+            # is repeated with them
+            self._digest_texts.extend(self._digest.flush_ready())
+            if len(self._digest_ids) > 0 and self._digest.idle:
+                self._complete_digest()
+                self._digest_ids = []
+                self._digest_texts = []
+                self._digest_close_ts = None
+            if len(messages) == 0:
+                time.sleep(OUTBOX_POLL_INTERVAL)
         except Exception:
             self._logger.exception(f"Failed to process market message.")
+            time.sleep(OUTBOX_POLL_INTERVAL)
+
+    def _complete_digest(self):
+        # Close time is known for digest messages before they are committed,
+        # so a consumer finishing one at once finds it
+        close_ts = self._digest_close_ts
+        enqueued = []
+
+        def on_enqueued(ids):
+            enqueued.extend(ids)
+            if close_ts is not None:
+                self._delivery_close_ts.update((i, close_ts) for i in ids)
+
+        try:
+            self._outbox.complete(self._digest_ids, [(TEXT, text.encode()) for text in self._digest_texts],
+                                  on_enqueued)
+        except Exception:
+            for i in enqueued:
+                self._delivery_close_ts.pop(i, None)
+            raise
+
+    def _consume_messages(self):
+        while True:
+            try:
+                messages = self._outbox.claim([TEXT, IMAGE])
+                for message in messages:
+                    self._send_message(*message)
+                if len(messages) == 0:
+                    time.sleep(OUTBOX_POLL_INTERVAL)
+            except Exception:
+                self._logger.exception("Failed to deliver outbox message.")
+                time.sleep(OUTBOX_POLL_INTERVAL)
+
+    def _send_message(self, message_id, kind, payload, attempts):
+        # Retried message goes only to chats which did not get it yet. If
+        # even finish() fails, the claim is taken back after CLAIM_TIMEOUT.
+        error = None
+        started = time.perf_counter()
+        try:
+            delivered = self._outbox.delivered_chats(message_id)
+            chats = [c for c in self._db.get_chat_list() if str(c) not in delivered]
+            if len(chats) > 0:
+                if kind == TEXT:
+                    result = self._bot.send_text_message(payload.decode(), chats)
+                else:
+                    result = self._bot.send_image(BytesIO(payload), chats)
+                self._outbox.record_deliveries(message_id, result)
+                self._handle_broadcast_result(result)
+                if len(result.failed) > 0:
+                    error = f"Failed to deliver to {len(result.failed)} chats."
+        except Exception as e:
+            error = str(e)
+        metrics.observe("outbox_send_seconds", time.perf_counter() - started, kind=kind)
+        status = self._outbox.finish(message_id, attempts, error)
+        metrics.inc("outbox_messages_total", kind=kind, status=status)
+        if status == 'pending':
+            return
+        close_ts = self._delivery_close_ts.pop(message_id, None)
+        if status == 'dead':
+            self._logger.error(f"Outbox message {message_id} is dead after {attempts} attempts: {error}")
+        elif close_ts is not None:
+            # From the close of the predicted candle to the digest in chats
+            metrics.observe("candle_to_delivery_seconds", time.time() - close_ts)
+
+    def _handle_broadcast_result(self, result):
+        for chat_id, description in result.failed.items():
+            self._logger.error(f"Failed to send message to chat {chat_id}: {description}")
+        if len(result.blocked) > 0:
+            self._logger.error(f"Removing {len(result.blocked)} blocked chats.")
+            self._db.remove_chats(result.blocked)
 
     def _predictions_job(self):
         try:
-            db = DatabaseManager()
+            db = self._db
             markets_list = db.get_markets()
-            # Create thread for each market
             for m in markets_list:
-                if m in self._markets and self._markets[m].is_alive():
-                    self._logger.error(f"Thread for market {m} is still alive.")
-                    continue
+                # Market with the previous job still queued or running is
+                # not waited for, it would not report this hour
+                if self._jobs.submit(f"predict:{m}", PREDICTION, market.run_prediction_job, self._path, m,
+                                     memory_mb=self._jvm_memory_mb(m)):
+                    self._digest.expect([m])
                 else:
-                    t = threading.Thread(target=market_thread_func, args=(m, self._path, self._message_queue))
-                    t.start()
-                    self._markets[m] = t
+                    self._logger.error(f"Prediction for market {m} is still queued or running.")
         except Exception:
             self._logger.exception("Failed to start predictions job.")
 
-    def _bot_job(self):
+    def _jvm_memory_mb(self, market_symbol):
+        # Memory the market's genotick JVM may take, None for default
         try:
-            db = DatabaseManager()
-            bot = Bot(self._bot_token)
-            chats = bot.get_chat_list()
-            for c in chats:
-                db.add_chat(c)
+            return JvmProfile.load(f"{self._path}/{market_symbol}").memory_mb
+        except (OSError, ValueError, TypeError):
+            self._logger.exception(f"Failed to read JVM profile of market {market_symbol}.")
+            return None
+
+    def _candle_store(self, market_symbol):
+        if market_symbol not in self._candle_stores:
+            self._candle_stores[market_symbol] = CandleStore(f"{self._path}/{market_symbol}/candles")
+        return self._candle_stores[market_symbol]
+
+    def _last_candle_time(self, market_symbol):
+        return self._candle_store(market_symbol).last_time()
+
+    def _on_closed_candles(self, market_symbol, df):
+        # Candles are stored before the job starts, so it does not poll
+        # Bitfinex for them
+        self._candle_store(market_symbol).append(df)
+        self._db.append_market_history(df, market_symbol)
+        if self._jobs.submit(f"predict:{market_symbol}", PREDICTION, market.run_prediction_job,
+                             self._path, market_symbol, False, memory_mb=self._jvm_memory_mb(market_symbol)):
+            self._digest.expect([market_symbol])
+        else:
+            self._logger.error(f"Prediction for market {market_symbol} is still queued or running.")
+
+    def _training_job(self):
+        # Training runs in background behind predictions, market trains only
+        # when it collected enough new candles and previous training is done
+        try:
+            for m in self._db.get_markets():
+                self._jobs.submit(f"train:{m}", TRAINING, market.run_training_job, self._path, m,
+                                  memory_mb=self._jvm_memory_mb(m))
+        except Exception:
+            self._logger.exception("Failed to start training job.")
+
+    def _discover_chats(self):
+        # Long polls Telegram for updates after the stored offset, new
+        # subscribers are added seconds after their first message
+        bot = Bot(self._bot_token)
+        offset = None
+        while True:
+            try:
+                if offset is None:
+                    offset = self._db.get_update_offset()
+                chats, commands, next_offset = bot.get_updates(offset, LONG_POLL_TIMEOUT)
+                if next_offset != offset:
+                    self._db.add_chats(chats, next_offset)
+                    offset = next_offset
+                for chat_id, text in commands:
+                    self._handle_command(bot, chat_id, text)
+            except Exception:
+                self._logger.exception("Failed to collect bot chats.")
+                time.sleep(CHAT_DISCOVERY_RETRY)
+
+    def _handle_command(self, bot, chat_id, text):
+        # /accuracy [market ...] - prediction accuracy of markets, answered
+        # to the asking chat only
+        words = text.split()
+        command = words[0].split("@")[0].lower()
+        if command != "/accuracy":
+            return
+        try:
+            markets = self._db.get_markets()
+            # Markets are asked without "t" prefix, f.e. /accuracy BTCUSD
+            wanted = set(f"t{w.upper()}" for w in words[1:])
+            if len(wanted) > 0:
+                markets = [m for m in markets if m in wanted]
+            lines = [evaluation.format_summary(m, self._evaluator.update(m)) for m in sorted(markets)]
+            reply = "\n".join(lines) if lines else "No such markets."
         except Exception:
-            self._logger.exception("Failed to collect bot chats.")
+            self._logger.exception("Failed to evaluate markets.")
+            reply = "Failed to evaluate markets."
+        bot.send_text_message(reply, [chat_id])
 
     def _daily_market_plot_job(self):
         try:
-            db = DatabaseManager()
-            pp = PlotProvider()
-            markets = db.get_markets()
-            for m in markets:
-                data = db.get_24h_plot_data(m)
-                image = pp.get_market_24plot(data, m[1:])
-                self._message_queue.put({'type': 'image', 'data': image})
+            # One query and one dashboard image for all markets
+            data = self._db.get_24h_plot_data_all()
+            items = [(data[m], m[1:]) for m in sorted(data)]
+            images = self._plot_provider.get_market_dashboards(items)
+            self._outbox.enqueue([(IMAGE, image.getvalue()) for image in images])
         except Exception:
             self._logger.exception("Failed to push daily market plots.")
 
+    def _purge_outbox_job(self):
+        try:
+            self._outbox.purge()
+        except Exception:
+            self._logger.exception("Failed to purge outbox.")
+
+    def _start_metrics_server(self):
+        # Connection pool of the bot process is read on every scrape
+        metrics.add_collector(lambda: pool_gauges(self._db.pool_stats()))
+        try:
+            server = metrics.MetricsServer([metrics.get_metrics(), self._job_metrics])
+            server.start()
+        except OSError:
+            self._logger.exception("Failed to start metrics server.")
+
+    def _start_read_api(self):
+        try:
+            read_api.start_read_api(self._db)
+        except OSError:
+            self._logger.exception("Failed to start read API.")
+
     def start(self):
+        self._start_metrics_server()
+        self._start_read_api()
+        # Messages claimed before restart were not finished
+        self._outbox.release_claims()
+        for i in range(OUTBOX_CONSUMERS):
+            threading.Thread(target=self._consume_messages, name=f"outbox_{i}", daemon=True).start()
+        threading.Thread(target=self._discover_chats, name="chat_discovery", daemon=True).start()
+        if self._stream is not None:
+            self._stream.start()
         self._scheduler.start()
 
+    def stop(self):
+        # Waits for running market jobs, queued ones are dropped
+        if self._stream is not None:
+            self._stream.stop()
+        self._scheduler.shutdown(wait=False)
+        self._jobs.shutdown()
+        self._shared.shutdown()
 
-def market_thread_func(market_symbol, path, queue):
-    m = Market(path, market_symbol, queue)
-    m.genotick_predict_and_train()
+    def job_stats(self):
+        return self._jobs.stats()
 
 
 def main(argv):
-    usage = "usage: {} path bot_token".format(argv[0])
-    if len(argv) != 3:
+    usage = "usage: {} path bot_token [stream]".format(argv[0])
+    if len(argv) not in (3, 4) or (len(argv) == 4 and argv[3] != "stream"):
         print(usage)
         sys.exit(1)
 
-    manager = MarketManager(argv[1], argv[2])
+    manager = MarketManager(argv[1], argv[2], streaming=len(argv) == 4)
     manager.start()
     while True:
         manager.process_market_message()
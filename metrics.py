@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Address of the local metrics endpoint, host:port
+METRICS_ADDRESS = os.environ.get("METRICS_ADDRESS", "127.0.0.1:9108")
+# Histogram buckets in seconds, from a Telegram send to a training run
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metrics:
+    """Counters, latency histograms, maximums and gauges labelled by market,
+    stage, etc.
+
+    Market jobs run in worker processes, each of them collects metrics
+    locally and flush() merges them into the parent registry, which lives
+    in the shared state manager of the bot.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = dict()
+        # key -> [bucket counts..., +Inf count], sum
+        self._histograms = dict()
+        # key -> largest value seen, f.e. peak memory of genotick runs
+        self._maximums = dict()
+        # key -> current value, f.e. connections of the database pool
+        self._gauges = dict()
+        # Callables returning [(name, labels, value)...] of gauges, read
+        # when metrics are exported
+        self._collectors = []
+        self._parent = None
+
+    def set_parent(self, parent):
+        self._parent = parent
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            counts, total = self._histograms.get(key, ([0] * (len(self._buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._histograms[key] = (counts, total + value)
+
+    def maximum(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._maximums[key] = max(self._maximums.get(key, value), value)
+
+    def gauge(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def add_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+
+    def _collect(self):
+        with self._lock:
+            collectors = list(self._collectors)
+        for collect in collectors:
+            try:
+                items = collect()
+            except Exception:
+                # Export the rest, gauges of a failed collector keep
+                # their last values
+                continue
+            for name, labels, value in items:
+                self.gauge(name, value, **labels)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        # Observes run time of the block in seconds, failed runs get
+        # status="error" label
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, status=status, **labels)
+
+    def _snapshot(self):
+        return {
+            'buckets': list(self._buckets),
+            'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+            'histograms': [[name, dict(labels), list(counts), total]
+                           for (name, labels), (counts, total) in self._histograms.items()],
+            'maximums': [[name, dict(labels), value] for (name, labels), value in self._maximums.items()],
+            'gauges': [[name, dict(labels), value] for (name, labels), value in self._gauges.items()],
+        }
+
+    def snapshot(self):
+        self._collect()
+        with self._lock:
+            return self._snapshot()
+
+    def merge(self, snapshot):
+        if list(snapshot['buckets']) != list(self._buckets):
+            raise ValueError("Histogram buckets do not match.")
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                key = _key(name, labels)
+                self._counters[key] = self._counters.get(key, 0) + value
+            for name, labels, counts, total in snapshot['histograms']:
+                key = _key(name, labels)
+                own_counts, own_total = self._histograms.get(key, ([0] * (len(self._buckets) + 1), 0.0))
+                self._histograms[key] = ([a + b for a, b in zip(own_counts, counts)], own_total + total)
+            for name, labels, value in snapshot.get('maximums', []):
+                key = _key(name, labels)
+                self._maximums[key] = max(self._maximums.get(key, value), value)
+            for name, labels, value in snapshot.get('gauges', []):
+                self._gauges[_key(name, labels)] = value
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict()
+            self._histograms = dict()
+            self._maximums = dict()
+            self._gauges = dict()
+
+    def flush(self):
+        # Moves collected metrics to the parent registry, if there is one
+        if self._parent is None:
+            return
+        with self._lock:
+            if len(self._counters) == 0 and len(self._histograms) == 0 and len(self._maximums) == 0 \
+                    and len(self._gauges) == 0:
+                return
+            snapshot = self._snapshot()
+            self._counters = dict()
+            self._histograms = dict()
+            self._maximums = dict()
+            self._gauges = dict()
+        self._parent.merge(snapshot)
+
+    def to_prometheus(self):
+        # Prometheus text exposition format
+        lines = []
+        self._collect()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            gauges = sorted(list(self._maximums.items()) + list(self._gauges.items()))
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append(f"# TYPE {name} counter")
+                last_name = name
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), (counts, total) in histograms:
+            if name != last_name:
+                lines.append(f"# TYPE {name} histogram")
+                last_name = name
+            cumulative = 0
+            for bound, count in zip(self._buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        for (name, labels), value in gauges:
+            if name != last_name:
+                lines.append(f"# TYPE {name} gauge")
+                last_name = name
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        # Counters, histograms with count, sum and mean, maximums and gauges,
+        # for JSON dumps
+        result = {'counters': [], 'histograms': [], 'maximums': [], 'gauges': []}
+        self._collect()
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                result['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), (counts, total) in sorted(self._histograms.items()):
+                count = sum(counts)
+                result['histograms'].append({
+                    'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                    'mean': total / count if count else 0.0,
+                    'buckets': {str(b): c for b, c in zip(self._buckets + ('+Inf',), counts)}})
+            for (name, labels), value in sorted(self._maximums.items()):
+                result['maximums'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), value in sorted(self._gauges.items()):
+                result['gauges'].append({'name': name, 'labels': dict(labels), 'value': value})
+        return result
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def configure_metrics(parent=None):
+    # Market worker processes send metrics to the registry of the bot
+    _metrics.set_parent(parent)
+    return _metrics
+
+
+def inc(name, value=1, **labels):
+    _metrics.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _metrics.observe(name, value, **labels)
+
+
+def maximum(name, value, **labels):
+    _metrics.maximum(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    _metrics.gauge(name, value, **labels)
+
+
+def add_collector(collect):
+    _metrics.add_collector(collect)
+
+
+def timer(name, **labels):
+    return _metrics.timer(name, **labels)
+
+
+def flush():
+    _metrics.flush()
+
+
+def combine(*sources):
+    # sources - registries or their proxies, returns one registry with sum
+    result = Metrics()
+    for source in sources:
+        result.merge(source.snapshot())
+    return result
+
+
+class MetricsServer:
+    """Serves /metrics (Prometheus text) and /metrics.json on a local port."""
+
+    def __init__(self, sources, address=METRICS_ADDRESS):
+        host, port = address.rsplit(":", 1)
+        sources = list(sources)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = combine(*sources).to_prometheus().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(combine(*sources).to_dict()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, int(port)), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(argv):
+    usage = "usage: {} [host:port]".format(argv[0])
+    if len(argv) > 2:
+        print(usage)
+        sys.exit(1)
+    # Prints JSON dump of running bot metrics
+    import requests
+    address = argv[1] if len(argv) == 2 else METRICS_ADDRESS
+    print(json.dumps(requests.get(f"http://{address}/metrics.json", timeout=10).json(), indent=2))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,311 @@
+import sys
+import psycopg2
+from dbmanager import DMError, configure_pool
+
+# Schema created by the first version of setup script
+INITIAL_SCHEMA = """
+CREATE TABLE public.market_info (
+    id integer NOT NULL,
+    name character varying NOT NULL,
+    bitfinex_api_symbol character varying
+);
+
+CREATE SEQUENCE public.market_info_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+ALTER SEQUENCE public.market_info_id_seq OWNED BY public.market_info.id;
+ALTER TABLE ONLY public.market_info ALTER COLUMN id SET DEFAULT nextval('public.market_info_id_seq'::regclass);
+ALTER TABLE ONLY public.market_info ADD CONSTRAINT market_info_pkey PRIMARY KEY (id);
+ALTER TABLE public.market_info ADD UNIQUE (bitfinex_api_symbol);
+
+CREATE TABLE public.market_history (
+    id integer NOT NULL,
+    market_id integer NOT NULL,
+    open double precision NOT NULL,
+    high double precision NOT NULL,
+    low double precision NOT NULL,
+    close double precision NOT NULL,
+    time_stamp timestamp without time zone NOT NULL
+);
+
+CREATE SEQUENCE public.market_history_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+ALTER SEQUENCE public.market_history_id_seq OWNED BY public.market_history.id;
+ALTER TABLE ONLY public.market_history ALTER COLUMN id SET DEFAULT nextval('public.market_history_id_seq'::regclass);
+ALTER TABLE ONLY public.market_history
+    ADD CONSTRAINT market_history_pkey PRIMARY KEY (id);
+ALTER TABLE ONLY public.market_history
+    ADD CONSTRAINT market_history_market_id_fkey FOREIGN KEY (market_id) REFERENCES public.market_info(id) MATCH FULL ON UPDATE RESTRICT ON DELETE RESTRICT;
+ALTER TABLE public.market_history
+  ADD CONSTRAINT market_history_market_id_time_stamp_key UNIQUE(market_id, time_stamp);
+
+CREATE TABLE public.market_predictions (
+    id integer NOT NULL,
+    time_stamp timestamp without time zone NOT NULL,
+    market_id integer NOT NULL,
+    genotick_prediction integer
+);
+
+CREATE SEQUENCE public.market_predictions_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+ALTER SEQUENCE public.market_predictions_id_seq OWNED BY public.market_predictions.id;
+ALTER TABLE ONLY public.market_predictions ALTER COLUMN id SET DEFAULT nextval('public.market_predictions_id_seq'::regclass);
+ALTER TABLE ONLY public.market_predictions
+    ADD CONSTRAINT market_predictions_pkey PRIMARY KEY (id);
+ALTER TABLE ONLY public.market_predictions
+    ADD CONSTRAINT market_predictions_time_stamp_market_id_key UNIQUE (time_stamp, market_id);
+ALTER TABLE public.market_predictions
+  ADD FOREIGN KEY (market_id) REFERENCES public.market_info (id) MATCH FULL
+   ON UPDATE RESTRICT ON DELETE RESTRICT;
+
+CREATE TABLE public.chats (
+    id VARCHAR NOT NULL
+);
+
+ALTER TABLE ONLY public.chats
+    ADD CONSTRAINT chats_pkey PRIMARY KEY (id);
+"""
+
+# Both history tables become range partitioned per month. Primary key
+# (market_id, time_stamp) includes the value column, so latest/24h queries
+# are index only scans, BRIN index serves time range scans over all
+# markets. market_last_ts keeps latest timestamps per market, it is
+# updated by DatabaseManager on ingest.
+TIME_SERIES_SCHEMA = """
+CREATE OR REPLACE FUNCTION public.create_monthly_partitions(parent text, from_ts timestamp, to_ts timestamp)
+RETURNS void AS $$
+DECLARE
+    month timestamp := date_trunc('month', from_ts);
+    partition text;
+BEGIN
+    -- Serialize concurrent ingests creating the same partition
+    PERFORM pg_advisory_xact_lock(hashtext(parent));
+    WHILE month <= to_ts LOOP
+        partition := format('%s_%s', parent, to_char(month, 'YYYY_MM'));
+        IF to_regclass(format('public.%I', partition)) IS NULL THEN
+            EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)',
+                partition, parent, month, month + interval '1 month');
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE public.market_history RENAME TO market_history_legacy;
+ALTER TABLE public.market_history_legacy
+    DROP CONSTRAINT market_history_pkey,
+    DROP CONSTRAINT market_history_market_id_time_stamp_key;
+
+CREATE TABLE public.market_history (
+    id integer NOT NULL DEFAULT nextval('public.market_history_id_seq'::regclass),
+    market_id integer NOT NULL,
+    open double precision NOT NULL,
+    high double precision NOT NULL,
+    low double precision NOT NULL,
+    close double precision NOT NULL,
+    time_stamp timestamp without time zone NOT NULL,
+    CONSTRAINT market_history_pkey PRIMARY KEY (market_id, time_stamp) INCLUDE (close),
+    CONSTRAINT market_history_market_id_fkey FOREIGN KEY (market_id) REFERENCES public.market_info(id) MATCH FULL ON UPDATE RESTRICT ON DELETE RESTRICT
+) PARTITION BY RANGE (time_stamp);
+ALTER SEQUENCE public.market_history_id_seq OWNED BY public.market_history.id;
+CREATE TABLE public.market_history_default PARTITION OF public.market_history DEFAULT;
+CREATE INDEX market_history_time_stamp_brin ON public.market_history USING brin (time_stamp);
+
+SELECT public.create_monthly_partitions('market_history', min(time_stamp), max(time_stamp))
+FROM public.market_history_legacy;
+SELECT public.create_monthly_partitions('market_history',
+    now() at time zone 'utc', (now() at time zone 'utc') + interval '3 months');
+INSERT INTO public.market_history(id, market_id, open, high, low, close, time_stamp)
+SELECT id, market_id, open, high, low, close, time_stamp FROM public.market_history_legacy;
+DROP TABLE public.market_history_legacy;
+
+ALTER TABLE public.market_predictions RENAME TO market_predictions_legacy;
+ALTER TABLE public.market_predictions_legacy
+    DROP CONSTRAINT market_predictions_pkey,
+    DROP CONSTRAINT market_predictions_time_stamp_market_id_key;
+
+CREATE TABLE public.market_predictions (
+    id integer NOT NULL DEFAULT nextval('public.market_predictions_id_seq'::regclass),
+    time_stamp timestamp without time zone NOT NULL,
+    market_id integer NOT NULL,
+    genotick_prediction integer,
+    CONSTRAINT market_predictions_pkey PRIMARY KEY (market_id, time_stamp) INCLUDE (genotick_prediction),
+    CONSTRAINT market_predictions_market_id_fkey FOREIGN KEY (market_id) REFERENCES public.market_info(id) MATCH FULL ON UPDATE RESTRICT ON DELETE RESTRICT
+) PARTITION BY RANGE (time_stamp);
+ALTER SEQUENCE public.market_predictions_id_seq OWNED BY public.market_predictions.id;
+CREATE TABLE public.market_predictions_default PARTITION OF public.market_predictions DEFAULT;
+CREATE INDEX market_predictions_time_stamp_brin ON public.market_predictions USING brin (time_stamp);
+
+SELECT public.create_monthly_partitions('market_predictions', min(time_stamp), max(time_stamp))
+FROM public.market_predictions_legacy;
+SELECT public.create_monthly_partitions('market_predictions',
+    now() at time zone 'utc', (now() at time zone 'utc') + interval '3 months');
+INSERT INTO public.market_predictions(id, time_stamp, market_id, genotick_prediction)
+SELECT id, time_stamp, market_id, genotick_prediction FROM public.market_predictions_legacy;
+DROP TABLE public.market_predictions_legacy;
+
+CREATE TABLE public.market_last_ts (
+    market_id integer NOT NULL,
+    history_ts timestamp without time zone,
+    predictions_ts timestamp without time zone,
+    CONSTRAINT market_last_ts_pkey PRIMARY KEY (market_id),
+    CONSTRAINT market_last_ts_market_id_fkey FOREIGN KEY (market_id) REFERENCES public.market_info(id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+INSERT INTO public.market_last_ts(market_id, history_ts, predictions_ts)
+SELECT i.id,
+    (SELECT max(h.time_stamp) FROM public.market_history h WHERE h.market_id = i.id),
+    (SELECT max(p.time_stamp) FROM public.market_predictions p WHERE p.market_id = i.id)
+FROM public.market_info i;
+
+ANALYZE public.market_history;
+ANALYZE public.market_predictions;
+"""
+
+# Messages waiting for the bot, see outbox.py
+OUTBOX_SCHEMA = """
+CREATE TABLE public.outbox (
+    id bigserial NOT NULL,
+    kind character varying NOT NULL,
+    payload bytea NOT NULL,
+    status character varying NOT NULL DEFAULT 'pending',
+    attempts integer NOT NULL DEFAULT 0,
+    available_at timestamp without time zone NOT NULL DEFAULT (now() at time zone 'utc'),
+    claimed_at timestamp without time zone,
+    created_at timestamp without time zone NOT NULL DEFAULT (now() at time zone 'utc'),
+    finished_at timestamp without time zone,
+    last_error character varying,
+    CONSTRAINT outbox_pkey PRIMARY KEY (id),
+    CONSTRAINT outbox_status_check CHECK (status IN ('pending', 'claimed', 'done', 'dead'))
+);
+CREATE INDEX outbox_pending_idx ON public.outbox (kind, id) WHERE status = 'pending';
+CREATE INDEX outbox_claimed_idx ON public.outbox (id) WHERE status = 'claimed';
+
+CREATE TABLE public.outbox_deliveries (
+    message_id bigint NOT NULL,
+    chat_id character varying NOT NULL,
+    status character varying NOT NULL,
+    attempts integer NOT NULL DEFAULT 1,
+    last_error character varying,
+    updated_at timestamp without time zone NOT NULL DEFAULT (now() at time zone 'utc'),
+    CONSTRAINT outbox_deliveries_pkey PRIMARY KEY (message_id, chat_id),
+    CONSTRAINT outbox_deliveries_message_id_fkey FOREIGN KEY (message_id) REFERENCES public.outbox(id) ON DELETE CASCADE
+);
+"""
+
+# Small values the bot keeps between restarts, f.e. Telegram updates offset
+BOT_STATE_SCHEMA = """
+CREATE TABLE public.bot_state (
+    name character varying NOT NULL,
+    value bigint NOT NULL,
+    CONSTRAINT bot_state_pkey PRIMARY KEY (name)
+);
+"""
+
+# Running accuracy of predictions, see evaluation.py
+ACCURACY_SCHEMA = """
+CREATE TABLE public.market_accuracy (
+    market_id integer NOT NULL,
+    evaluated_ts timestamp without time zone,
+    predictions integer NOT NULL DEFAULT 0,
+    directional integer NOT NULL DEFAULT 0,
+    hits integer NOT NULL DEFAULT 0,
+    pnl double precision NOT NULL DEFAULT 0,
+    equity double precision NOT NULL DEFAULT 1,
+    peak_equity double precision NOT NULL DEFAULT 1,
+    max_drawdown double precision NOT NULL DEFAULT 0,
+    recent_hits smallint[] NOT NULL DEFAULT '{}',
+    CONSTRAINT market_accuracy_pkey PRIMARY KEY (market_id),
+    CONSTRAINT market_accuracy_market_id_fkey FOREIGN KEY (market_id) REFERENCES public.market_info(id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+"""
+
+# (version, description, sql)
+MIGRATIONS = [
+    (1, "initial schema", INITIAL_SCHEMA),
+    (2, "monthly partitions, covering indexes and latest timestamps", TIME_SERIES_SCHEMA),
+    (3, "outbox of bot messages with per chat deliveries", OUTBOX_SCHEMA),
+    (4, "bot state", BOT_STATE_SCHEMA),
+    (5, "prediction accuracy", ACCURACY_SCHEMA),
+]
+
+
+def get_version(connection):
+    with connection.cursor() as c:
+        c.execute("""CREATE TABLE IF NOT EXISTS public.schema_migrations (
+            version integer NOT NULL PRIMARY KEY,
+            description character varying NOT NULL,
+            applied_at timestamp without time zone NOT NULL DEFAULT (now() at time zone 'utc'));""")
+        c.execute("SELECT max(version) FROM public.schema_migrations;")
+        version = c.fetchone()[0]
+        if version is None:
+            # Databases created by setup script before migrations were
+            # introduced already have the initial schema
+            c.execute("SELECT to_regclass('public.market_info') IS NOT NULL;")
+            if c.fetchone()[0]:
+                c.execute("INSERT INTO public.schema_migrations(version, description) VALUES(%s, %s);",
+                          MIGRATIONS[0][:2])
+                version = MIGRATIONS[0][0]
+            else:
+                version = 0
+        return version
+
+
+def migrate(pool, target=None):
+    # Applies every migration above current version up to target (all by
+    # default), each one in its own transaction. Returns applied versions.
+    applied = []
+    try:
+        with pool.connection() as connection, connection:
+            version = get_version(connection)
+        for (number, description, sql) in MIGRATIONS:
+            if number <= version or (target is not None and number > target):
+                continue
+            print(f"Applying migration {number}: {description}...")
+            with pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(sql)
+                    c.execute("INSERT INTO public.schema_migrations(version, description) VALUES(%s, %s);",
+                              (number, description))
+            applied.append(number)
+    except (Exception, psycopg2.Error) as error :
+        raise DMError("Failed to migrate database schema. ", error)
+    return applied
+
+
+def main(argv):
+    usage = "usage: {} [database] [target_version]".format(argv[0])
+    if len(argv) > 3:
+        print(usage)
+        sys.exit(1)
+    database = argv[1] if len(argv) > 1 else "markets"
+    target = int(argv[2]) if len(argv) > 2 else None
+    pool = configure_pool(database=database)
+    try:
+        applied = migrate(pool, target)
+    except DMError as error:
+        print(error)
+        sys.exit(1)
+    if len(applied) == 0:
+        print("Database schema is up to date.")
+    else:
+        print(f"Applied migrations: {', '.join(str(v) for v in applied)}")
+
+if __name__ == "__main__":
+    main(sys.argv)
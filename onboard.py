@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import shutil
+import calendar
+import datetime
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import bitfinex_api
+import market
+from candle_store import CandleStore, HOUR_MS
+from dbmanager import DatabaseManager
+from population import PopulationStore, render_config
+
+# Hours of history downloaded by one request
+CHUNK_HOURS = 5000
+# Chunks downloaded at once over all markets, pace is set by rate limiter
+MAX_DOWNLOADS = 8
+# Template config of a new market, same values genotick_learn used
+CONFIG_SETTINGS = {
+    'performTraining': 'true',
+    'populationDesiredSize': 20000,
+    'requireSymmetricalRobots': 'true',
+    'resultThreshold': 1.5,
+    'protectBestRobots': 0.15,
+    'maximumDeathByAge': 0.2,
+    'maximumDeathByWeight': 0.2,
+    'dataMaximumOffset': 24,
+}
+
+
+def parse_date(value):
+    return calendar.timegm(datetime.datetime.strptime(value, "%Y-%m-%d").timetuple()) * 1000
+
+
+def chunks(start, end, hours=CHUNK_HOURS):
+    # Fixed grid of (start, end) ms ranges, same for every resumed run
+    step = hours * HOUR_MS
+    return [(s, min(s + step, end)) for s in range(start, end, step)]
+
+
+def candles_frame(candles):
+    # Store records -> data frame with bitfinex_api.CANDLE_COLUMNS
+    return pd.DataFrame({name: np.asarray(candles[name]) for name in bitfinex_api.CANDLE_COLUMNS})
+
+
+class Backfill:
+    """Downloads history of several markets at once into their candle stores.
+
+    Downloaded ranges are recorded in backfill.json of every market, so an
+    interrupted run continues with missing chunks only.
+    """
+
+    def __init__(self, path, max_downloads=MAX_DOWNLOADS):
+        self._path = os.path.abspath(path)
+        self._max_downloads = max_downloads
+        self._stores = dict()
+        self._checkpoints = dict()
+
+    def store(self, market_symbol):
+        if market_symbol not in self._stores:
+            self._stores[market_symbol] = CandleStore(os.path.join(self._path, market_symbol, "candles"))
+        return self._stores[market_symbol]
+
+    def _checkpoint_path(self, market_symbol):
+        return os.path.join(self._path, market_symbol, "backfill.json")
+
+    def _read_checkpoint(self, market_symbol):
+        try:
+            with open(self._checkpoint_path(market_symbol)) as f:
+                return set(tuple(r) for r in json.load(f)['done'])
+        except FileNotFoundError:
+            return set()
+
+    def _write_checkpoint(self, market_symbol, done):
+        path = self._checkpoint_path(market_symbol)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump({'done': sorted(done)}, f)
+        os.replace(f"{path}.tmp", path)
+
+    def download(self, ranges):
+        # ranges - list of (market symbol, start, end) in ms. Chunks of all
+        # markets are fetched concurrently, every finished chunk is stored
+        # and checkpointed here, in one thread. Failed chunks are left for
+        # the next run. Returns dict: market symbol -> number of candles
+        # stored.
+        jobs = []
+        for market_symbol, start, end in ranges:
+            done = self._checkpoints.setdefault(market_symbol, self._read_checkpoint(market_symbol))
+            jobs.extend((market_symbol, s, e) for s, e in chunks(start, end) if (s, e) not in done)
+        stored = {market_symbol: 0 for market_symbol, _, _ in ranges}
+        if len(jobs) == 0:
+            return stored
+        fetcher = bitfinex_api.get_fetcher()
+        errors = []
+        with ThreadPoolExecutor(max_workers=self._max_downloads) as executor:
+            futures = {executor.submit(fetcher.fetch, m, s, e, '1h', CHUNK_HOURS): (m, s, e) for m, s, e in jobs}
+            for future in as_completed(futures):
+                market_symbol, s, e = futures[future]
+                try:
+                    candles = future.result()
+                except bitfinex_api.BitfinexError as error:
+                    errors.append(error)
+                    continue
+                if len(candles) > 0:
+                    stored[market_symbol] += self.store(market_symbol).append(bitfinex_api.candles_to_frame(candles))
+                self._checkpoints[market_symbol].add((s, e))
+                self._write_checkpoint(market_symbol, self._checkpoints[market_symbol])
+        if len(errors) > 0:
+            raise bitfinex_api.BitfinexError(f"Failed to download {len(errors)} of {len(jobs)} chunks, run again to resume",
+                                             errors[0])
+        return stored
+
+    def fill_gaps(self, market_symbols):
+        # Downloads missing hours inside stored history. Exchange has no
+        # candles for hours without trades, those gaps stay. Failed gaps are
+        # left for the next run, the rest are stored. Returns dict: market
+        # symbol -> number of candles stored.
+        fetcher = bitfinex_api.get_fetcher()
+        jobs = [(m, s, e + HOUR_MS) for m in market_symbols for s, e in self.store(m).gaps()]
+        before = {m: len(self.store(m)) for m in market_symbols}
+        errors = []
+        with ThreadPoolExecutor(max_workers=self._max_downloads) as executor:
+            futures = {executor.submit(fetcher.fetch, m, s, e): m for m, s, e in jobs}
+            for future in as_completed(futures):
+                try:
+                    candles = future.result()
+                except bitfinex_api.BitfinexError as error:
+                    errors.append(error)
+                    continue
+                if len(candles) > 0:
+                    self.store(futures[future]).append(bitfinex_api.candles_to_frame(candles))
+        if len(errors) > 0:
+            raise bitfinex_api.BitfinexError(f"Failed to download {len(errors)} of {len(jobs)} gaps, run again to resume",
+                                             errors[0])
+        return {m: len(self.store(m)) - before[m] for m in market_symbols}
+
+    def load_database(self, market_symbols, db, add_markets=False):
+        # Full stored history of every market goes in with one bulk upsert,
+        # add_markets - markets are added with their history
+        frames = {m: candles_frame(self.store(m).candles()) for m in market_symbols}
+        return db.bulk_upsert_history(frames, add_markets)
+
+
+def prepare_market(path, market_symbol):
+    # Creates market directory and its genotick config template
+    market_path = os.path.join(path, market_symbol)
+    config_path = os.path.join(market_path, "config.txt")
+    os.makedirs(os.path.join(market_path, "data"), exist_ok=True)
+    if not os.path.exists(config_path):
+        render_config(os.path.join(path, "genotick", "exampleConfigFile.txt"), config_path, CONFIG_SETTINGS)
+
+
+def onboard(path, start, end, market_symbols, db):
+    # Downloads histories, trains first population of markets which do not
+    # have one yet and adds markets with full history to the database, bot
+    # starts predictions for them only then
+    path = os.path.abspath(path)
+    for m in market_symbols:
+        prepare_market(path, m)
+    backfill = Backfill(path)
+    stored = backfill.download([(m, start, end) for m in market_symbols])
+    for m in market_symbols:
+        print(f"Stored {stored[m]} candles of {m}, {len(backfill.store(m))} in total.")
+        if len(backfill.store(m)) == 0:
+            raise RuntimeError(f"No history downloaded for market {m}.")
+    for m in market_symbols:
+        if PopulationStore(os.path.join(path, m)).current() is None:
+            print(f"Training genotick for market {m}...")
+            market.Market(path, m).genotick_initial_train(start)
+            shutil.rmtree(os.path.join(path, m, "runs"), ignore_errors=True)
+    print(f"Loaded {backfill.load_database(market_symbols, db, add_markets=True)} candles into database.")
+
+
+def fill_gaps(path, market_symbols, db):
+    backfill = Backfill(path)
+    try:
+        stored = backfill.fill_gaps(market_symbols)
+        for m in market_symbols:
+            print(f"Stored {stored[m]} missing candles of {m}, {len(backfill.store(m).gaps())} gaps left.")
+    finally:
+        # Gaps filled before a failure go to the database too
+        print(f"Loaded {backfill.load_database(market_symbols, db)} candles into database.")
+
+
+def main(argv):
+    usage = ("usage: {} path start_date end_date market_symbol [market_symbol ...] | "
+             "{} path gaps [market_symbol ...]").format(argv[0], argv[0])
+    if len(argv) >= 3 and argv[2] == "gaps":
+        db = DatabaseManager()
+        fill_gaps(argv[1], argv[3:] or db.get_markets(), db)
+    elif len(argv) >= 5:
+        start, end = parse_date(argv[2]), parse_date(argv[3])
+        if start >= end:
+            print("Error: start date should be less than end date!")
+            sys.exit(1)
+        onboard(argv[1], start, end, argv[4:], DatabaseManager())
+    else:
+        print(usage)
+        sys.exit(1)
+    bitfinex_api.get_fetcher().close()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,227 @@
+import sys
+import json
+import psycopg2
+import psycopg2.extras
+from dbmanager import DMError, get_pool
+
+# Message kinds: predictions of one market (JSON), digest text and PNG image
+PREDICTIONS = 'predictions'
+TEXT = 'text'
+IMAGE = 'image'
+# Deliveries after which a message goes to dead letters
+MAX_ATTEMPTS = 5
+# Seconds before first retry, doubled on every next one
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+# Seconds after which a message claimed by a consumer that did not finish
+# it, f.e. its database connection failed, is claimed again. Much longer
+# than digest window and a broadcast to all chats.
+CLAIM_TIMEOUT = 30 * 60
+# Days done and dead messages are kept with their deliveries
+RETENTION_DAYS = 7
+
+
+def encode_predictions(market_symbol, predictions, final):
+    return json.dumps({'market': market_symbol, 'data': predictions, 'final': final}).encode()
+
+
+def decode_predictions(payload):
+    return json.loads(bytes(payload).decode())
+
+
+def retry_delay(attempts):
+    return min(RETRY_DELAY * 2 ** max(0, attempts - 1), MAX_RETRY_DELAY)
+
+
+class Outbox:
+    """Bot messages stored in the database until every chat got them.
+
+    Producers enqueue messages in batches, any number of consumers claim
+    them with SELECT ... FOR UPDATE SKIP LOCKED, so one message goes to one
+    consumer only. A claim not finished in CLAIM_TIMEOUT is taken back.
+    Failed messages are retried later and marked dead after
+    MAX_ATTEMPTS. Deliveries are recorded per chat, a retried message goes
+    only to chats which did not get it yet.
+    """
+
+    def __init__(self, pool=None):
+        self._pool = pool if pool is not None else get_pool()
+
+    def enqueue(self, messages):
+        # messages - list of (kind, payload bytes). Returns new message ids.
+        if len(messages) == 0:
+            return []
+        try:
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    return self._insert(c, messages)
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to enqueue bot messages. ", error)
+
+    def _insert(self, cursor, messages):
+        rows = psycopg2.extras.execute_values(cursor,
+            "INSERT INTO \"public\".outbox(kind, payload) VALUES %s RETURNING id;",
+            [(kind, psycopg2.Binary(payload)) for kind, payload in messages], fetch=True)
+        return [row[0] for row in rows]
+
+    def claim(self, kinds, limit=1, timeout=CLAIM_TIMEOUT):
+        # Returns list of (id, kind, payload, attempts) claimed by the caller
+        try:
+            query = """UPDATE "public".outbox
+            SET status = 'claimed', claimed_at = now() at time zone 'utc', attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM "public".outbox
+                WHERE kind = ANY(%s)
+                AND (status = 'pending' AND available_at <= now() at time zone 'utc'
+                    OR status = 'claimed' AND claimed_at <= (now() at time zone 'utc') - %s * interval '1 second')
+                ORDER BY id LIMIT %s
+                FOR UPDATE SKIP LOCKED)
+            RETURNING id, kind, payload, attempts;"""
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query, (list(kinds), timeout, limit))
+                    return sorted((row[0], row[1], bytes(row[2]), row[3]) for row in c.fetchall())
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to claim bot messages. ", error)
+
+    def complete(self, ids, messages=(), on_enqueued=None):
+        # Marks claimed messages done and enqueues messages made of them in
+        # the same transaction, f.e. digest text made of predictions.
+        # on_enqueued gets ids of new messages before they can be claimed.
+        try:
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    if len(ids) > 0:
+                        c.execute("""UPDATE "public".outbox
+                        SET status = 'done', finished_at = now() at time zone 'utc', last_error = NULL
+                        WHERE id = ANY(%s);""", (list(ids),))
+                    new_ids = self._insert(c, messages) if len(messages) > 0 else []
+                    if on_enqueued is not None:
+                        on_enqueued(new_ids)
+                    return new_ids
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to complete bot messages. ", error)
+
+    def delivered_chats(self, message_id):
+        # Chats which already got the message or blocked the bot
+        try:
+            query = """SELECT chat_id FROM "public".outbox_deliveries
+            WHERE message_id = %s AND status IN ('sent', 'blocked');"""
+            with self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query, (message_id,))
+                return set(item[0] for item in c.fetchall())
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to get deliveries of message {message_id}. ", error)
+
+    def record_deliveries(self, message_id, result):
+        # result - tgbot.BroadcastResult of one delivery attempt
+        rows = [(message_id, str(chat_id), 'sent', None) for chat_id in result.succeeded]
+        rows.extend((message_id, str(chat_id), 'blocked', None) for chat_id in result.blocked)
+        rows.extend((message_id, str(chat_id), 'failed', description)
+                    for chat_id, description in result.failed.items())
+        if len(rows) == 0:
+            return
+        try:
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    psycopg2.extras.execute_values(c, """INSERT INTO "public".outbox_deliveries
+                    (message_id, chat_id, status, last_error) VALUES %s
+                    ON CONFLICT (message_id, chat_id) DO UPDATE
+                    SET status = EXCLUDED.status, last_error = EXCLUDED.last_error,
+                    attempts = outbox_deliveries.attempts + 1, updated_at = now() at time zone 'utc';""", rows)
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to record deliveries of message {message_id}. ", error)
+
+    def finish(self, message_id, attempts, error=None):
+        # Message is done without error, otherwise it is retried later or
+        # goes to dead letters after MAX_ATTEMPTS. Returns new status.
+        if error is None:
+            status = 'done'
+        elif attempts >= MAX_ATTEMPTS:
+            status = 'dead'
+        else:
+            status = 'pending'
+        try:
+            query = """UPDATE "public".outbox
+            SET status = %s, last_error = %s, claimed_at = NULL,
+            available_at = (now() at time zone 'utc') + %s * interval '1 second',
+            finished_at = CASE WHEN %s = 'pending' THEN NULL ELSE now() at time zone 'utc' END
+            WHERE id = %s;"""
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query, (status, error, retry_delay(attempts) if status == 'pending' else 0,
+                                      status, message_id))
+            return status
+        except (Exception, psycopg2.Error) as error :
+            raise DMError(f"Failed to finish message {message_id}. ", error)
+
+    def release_claims(self, kinds=None):
+        # Messages claimed by a consumer which did not finish them, f.e. bot
+        # was restarted, go back to pending. Returns number of messages.
+        try:
+            query = """UPDATE "public".outbox SET status = 'pending', claimed_at = NULL
+            WHERE status = 'claimed' AND (%s::varchar[] IS NULL OR kind = ANY(%s));"""
+            kinds = None if kinds is None else list(kinds)
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query, (kinds, kinds))
+                    return c.rowcount
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to release claimed bot messages. ", error)
+
+    def retry_dead(self):
+        # Returns dead messages to pending with a fresh number of attempts
+        try:
+            query = """UPDATE "public".outbox
+            SET status = 'pending', attempts = 0, finished_at = NULL, available_at = now() at time zone 'utc'
+            WHERE status = 'dead';"""
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query)
+                    return c.rowcount
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to retry dead bot messages. ", error)
+
+    def purge(self, older_than=RETENTION_DAYS):
+        # Deletes messages finished more than older_than days ago, their
+        # deliveries go with them. Returns number of messages.
+        try:
+            query = """DELETE FROM "public".outbox
+            WHERE status IN ('done', 'dead') AND finished_at <= (now() at time zone 'utc') - %s * interval '1 day';"""
+            with self._pool.connection() as connection, connection:
+                with connection.cursor() as c:
+                    c.execute(query, (older_than,))
+                    return c.rowcount
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to purge finished bot messages. ", error)
+
+    def stats(self):
+        # Returns dict: (kind, status) -> number of messages
+        try:
+            query = "SELECT kind, status, count(*) FROM \"public\".outbox GROUP BY kind, status;"
+            with self._pool.connection() as connection, connection.cursor() as c:
+                c.execute(query)
+                return {(kind, status): count for kind, status, count in c.fetchall()}
+        except (Exception, psycopg2.Error) as error :
+            raise DMError("Failed to get outbox stats. ", error)
+
+
+def main(argv):
+    usage = "usage: {} [stats|retry_dead|purge [days]]".format(argv[0])
+    if len(argv) > 3 or (len(argv) >= 2 and argv[1] not in ("stats", "retry_dead", "purge")) \
+            or (len(argv) == 3 and (argv[1] != "purge" or not argv[2].isdigit())):
+        print(usage)
+        sys.exit(1)
+    outbox = Outbox()
+    if len(argv) == 2 and argv[1] == "retry_dead":
+        print(f"Returned {outbox.retry_dead()} dead messages to pending.")
+        return
+    if len(argv) >= 2 and argv[1] == "purge":
+        days = int(argv[2]) if len(argv) == 3 else RETENTION_DAYS
+        print(f"Deleted {outbox.purge(days)} finished messages.")
+        return
+    for (kind, status), count in sorted(outbox.stats().items()):
+        print(f"{kind:>12} {status:>8} {count:8}")
+
+if __name__ == "__main__":
+    main(sys.argv)
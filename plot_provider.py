@@ -1,60 +1,173 @@
-import matplotlib.pyplot as plt
-from io import BytesIO
-from dbmanager import DatabaseManager
 import sys
-from pandas.plotting import register_matplotlib_converters
+import time
+import hashlib
+import threading
+import multiprocessing
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
 import matplotlib.dates as mdates
-from tgbot import Bot
+from dbmanager import DatabaseManager
+import metrics
+
+# Rendered PNGs kept in memory
+CACHE_SIZE = 256
+# Change when chart look changes, so cached images are rendered again
+RENDER_VERSION = 1
+
+# Markets on one dashboard image and columns of its grid
+DASHBOARD_PAGE_SIZE = 12
+DASHBOARD_COLUMNS = 3
+
+BACKGROUND = 'black'
+FOREGROUND = 'white'
+
+
+def _data_key(kind, *items):
+    # kind - "market" or "dashboard", items - (data, market_name) pairs
+    # drawn on one image
+    key = [(name, data.tolist()) for data, name in items]
+    return hashlib.sha256(repr((RENDER_VERSION, kind, key)).encode()).hexdigest()
+
+
+def _draw_market(ax, data, market_name, date_format):
+    # data[0] - datetime
+    # data[1] - close
+    # data[2] - predictions: -1, 0, 1
+    data = data.reshape(-1, 3)
+    ax.set_facecolor(BACKGROUND)
+    for spine in ax.spines.values():
+        spine.set_color(FOREGROUND)
+    ax.tick_params(colors=FOREGROUND, labelrotation=45, axis='x')
+    ax.tick_params(colors=FOREGROUND, axis='y')
+    ax.plot(data[:, 0], data[:, 1], lw=2, ls='-', c='blue')
+    ax.grid(True, color=FOREGROUND)
+    ax.set_title(market_name, color=FOREGROUND)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
+
+    # Draw market down
+    filtered = data[data[:, 2] == -1]
+    if(len(filtered) > 0):
+        ax.plot(filtered[:, 0], filtered[:, 1], marker='v',
+        linestyle = 'None', color='red', mew=1, mec='lightgray', ms=10)
+    # Draw market out
+    filtered = data[data[:, 2] == 0]
+    if(len(filtered) > 0):
+        ax.plot(filtered[:, 0], filtered[:, 1], marker='s',
+        linestyle = 'None', color='gray', mew=1, mec='lightgray', ms=10)
+    # Draw market up
+    filtered = data[data[:, 2] == 1]
+    if(len(filtered) > 0):
+        ax.plot(filtered[:, 0], filtered[:, 1], marker='^',
+        linestyle = 'None', color='black', mew=1, mec='lightgray', ms=10)
+
+
+def _to_png(fig):
+    bio = BytesIO()
+    fig.savefig(bio, bbox_inches='tight', format='png', facecolor=fig.get_facecolor())
+    return bio.getvalue()
+
+
+def render_market_24plot(data, market_name):
+    # Uses Figure directly, no pyplot global state, so it is safe in threads
+    # and the figure is released with the last reference. Returns PNG bytes.
+    fig = Figure(facecolor=BACKGROUND)
+    _draw_market(fig.subplots(), data, market_name, '%b %d %H:%M')
+    return _to_png(fig)
+
+
+def render_dashboard(items, columns=DASHBOARD_COLUMNS):
+    # items - list of (data, market_name), all markets go to one grid
+    # image. Returns PNG bytes.
+    columns = max(1, min(columns, len(items)))
+    rows = -(-len(items) // columns)
+    fig = Figure(facecolor=BACKGROUND, figsize=(4 * columns, 3 * rows))
+    axes = fig.subplots(rows, columns, squeeze=False)
+    for ax, (data, market_name) in zip(axes.flat, items):
+        _draw_market(ax, data, market_name, '%H:%M')
+    for ax in axes.flat[len(items):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    return _to_png(fig)
+
 
 class PlotProvider:
+    """Renders market charts, PNGs are cached by plotted data."""
+
+    def __init__(self, cache_size=CACHE_SIZE, max_workers=None):
+        self._cache_size = cache_size
+        self._max_workers = max_workers
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_cached(self, key):
+        with self._lock:
+            image = self._cache.get(key)
+            if image is not None:
+                self._cache.move_to_end(key)
+            return image
 
-    def __init__(self):
-        register_matplotlib_converters()
-        plt.style.use('dark_background')
+    def _put_cached(self, key, image):
+        with self._lock:
+            self._cache[key] = image
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
 
     def get_market_24plot(self, data, market_name):
-        # data[0] - datetime
-        # data[1] - close
-        # data[2] - predictions: -1, 0, 1 
-        fig, ax = plt.subplots()      
-        plt.plot(data[:, 0], data[:, 1], lw=2, ls='-', c='blue')
-        plt.grid(True)
-        plt.title(market_name)
-        plt.xticks(rotation=45)
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d %H:%M'))
-
-        # Draw market down
-        filtered = data[data[:, 2] == -1]
-        if(len(filtered) > 0):
-            plt.plot(filtered[:, 0], filtered[:, 1], marker='v', 
-            linestyle = 'None', color='red', mew=1, mec='lightgray', ms=10)
-        # # Draw market out
-        filtered = data[data[:, 2] == 0]
-        if(len(filtered) > 0):
-            plt.plot(filtered[:, 0], filtered[:, 1], marker='s', 
-            linestyle = 'None', color='gray', mew=1, mec='lightgray', ms=10)
-        # # Draw market up
-        filtered = data[data[:, 2] == 1]
-        if(len(filtered) > 0):
-            plt.plot(filtered[:, 0], filtered[:, 1], marker='^', 
-            linestyle = 'None', color='black', mew=1, mec='lightgray', ms=10)
-       
-        # Save to buffer
-        bio = BytesIO()
-        fig.savefig(bio, bbox_inches='tight', format='png')                
-        return bio
+        return self.get_market_24plots([(data, market_name)])[0]
+
+    def get_market_24plots(self, items):
+        # items - list of (data, market_name). Returns list of BytesIO with
+        # PNG images, only charts with changed data are rendered, several
+        # of them in a process pool.
+        keys = [_data_key("market", item) for item in items]
+        images = [self._get_cached(key) for key in keys]
+        missing = [i for i, image in enumerate(images) if image is None]
+        metrics.inc("plot_cache_total", len(items) - len(missing), kind="market", result="hit")
+        metrics.inc("plot_cache_total", len(missing), kind="market", result="miss")
+        started = time.perf_counter()
+        if len(missing) > 1:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=self._max_workers, mp_context=context) as executor:
+                rendered = list(executor.map(render_market_24plot,
+                                             [items[i][0] for i in missing], [items[i][1] for i in missing]))
+        else:
+            rendered = [render_market_24plot(*items[i]) for i in missing]
+        if len(missing) > 0:
+            metrics.observe("plot_render_seconds", time.perf_counter() - started, kind="market")
+        for i, image in zip(missing, rendered):
+            self._put_cached(keys[i], image)
+            images[i] = image
+        return [BytesIO(image) for image in images]
+
+    def get_market_dashboards(self, items, page_size=DASHBOARD_PAGE_SIZE):
+        # items - list of (data, market_name). Returns list of BytesIO, one
+        # grid image per page_size markets, unchanged pages come from cache
+        pages = [items[i:i + page_size] for i in range(0, len(items), page_size)]
+        result = []
+        for page in pages:
+            key = _data_key("dashboard", *page)
+            image = self._get_cached(key)
+            metrics.inc("plot_cache_total", kind="dashboard", result="miss" if image is None else "hit")
+            if image is None:
+                with metrics.timer("plot_render_seconds", kind="dashboard"):
+                    image = render_dashboard(page)
+                self._put_cached(key, image)
+            result.append(BytesIO(image))
+        return result
+
 
 def main(argv):
-    usage = "usage: {} market_symbol".format(argv[0])
-    if len(argv) != 2:
+    usage = "usage: {} market_symbol output_png".format(argv[0])
+    if len(argv) != 3:
         print(usage)
         sys.exit(1)
-    db = DatabaseManager()                  
-    pp = PlotProvider()
-    image = pp.get_market_24plot(db.get_24h_plot_data(argv[1]), argv[1][1:])   
-    
-if __name__ == "__main__":
-    main(sys.argv)            
-
-        
+    db = DatabaseManager()
+    image = render_market_24plot(db.get_24h_plot_data(argv[1]), argv[1][1:])
+    with open(argv[2], 'wb') as f:
+        f.write(image)
 
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,122 @@
+import os
+import re
+import shutil
+import time
+
+# Number of previous populations kept for rollback
+GENERATIONS_TO_KEEP = 3
+
+
+def render_config(template_path, output_path, settings):
+    # Writes genotick config built from template. settings - dict: key ->
+    # value, None comments the key out. Template itself is never changed.
+    with open(template_path) as f:
+        lines = f.read().splitlines()
+    pending = dict(settings)
+    result = []
+    for line in lines:
+        match = re.match(r"^[#\s]*(\w+)\s+\S", line)
+        if match is None or match.group(1) not in settings:
+            result.append(line)
+            continue
+        key = match.group(1)
+        value = settings[key]
+        pending.pop(key, None)
+        if value is None:
+            result.append(line if line.lstrip().startswith('#') else f"#{line}")
+        else:
+            result.append(f"{key}\t{value}")
+    for key, value in pending.items():
+        if value is not None:
+            result.append(f"{key}\t{value}")
+    with open(output_path, 'w') as f:
+        f.write("\n".join(result) + "\n")
+
+
+def read_config(path):
+    # Returns dict: key -> value of keys that are not commented out
+    result = dict()
+    with open(path) as f:
+        for line in f:
+            match = re.match(r"^(\w+)\s+(\S.*?)\s*$", line)
+            if match is not None:
+                result[match.group(1)] = match.group(2)
+    return result
+
+
+class PopulationStore:
+    """Versioned genotick populations of one market.
+
+    Every training run produces a new generation directory, robots/ is a
+    symlink to the current one and is swapped atomically on promotion.
+    """
+
+    def __init__(self, market_path, keep=GENERATIONS_TO_KEEP):
+        # Path structure:
+        # market_path
+        #  - robots -> populations/<generation>
+        #  - populations/
+        #    - <generation>/
+        #      - robot files
+        # Resolved, so generations compare equal to current()
+        market_path = os.path.realpath(market_path)
+        self._link_path = os.path.join(market_path, "robots")
+        self._generations_path = os.path.join(market_path, "populations")
+        self._keep = keep
+        os.makedirs(self._generations_path, exist_ok=True)
+        self._adopt_legacy_directory()
+
+    def _adopt_legacy_directory(self):
+        # Markets created before versioning have plain robots/ directory
+        if os.path.isdir(self._link_path) and not os.path.islink(self._link_path):
+            target = os.path.join(self._generations_path, self._new_generation_name())
+            os.rename(self._link_path, target)
+            self._point_to(target)
+
+    def _new_generation_name(self):
+        return time.strftime("%Y%m%d%H%M%S", time.gmtime()) + f"_{os.getpid()}"
+
+    def _point_to(self, target):
+        tmp_link = f"{self._link_path}.{os.getpid()}.tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(target, os.path.dirname(self._link_path)), tmp_link)
+        # rename over existing symlink is atomic, readers see old or new one
+        os.replace(tmp_link, self._link_path)
+
+    def current(self):
+        # Resolved path of current generation, runs should use this path
+        # instead of robots/ so a swap does not affect them
+        if not os.path.lexists(self._link_path):
+            return None
+        return os.path.realpath(self._link_path)
+
+    def generations(self):
+        return sorted(os.path.join(self._generations_path, name)
+                      for name in os.listdir(self._generations_path))
+
+    def promote(self, population_path):
+        # Moves trained population into a new generation and makes it current
+        target = os.path.join(self._generations_path, self._new_generation_name())
+        shutil.move(population_path, target)
+        self._point_to(target)
+        self._prune()
+        return target
+
+    def rollback(self):
+        # Makes previous generation current again, returns its path
+        current = self.current()
+        if current is None:
+            raise RuntimeError("No current population to roll back from.")
+        previous = [g for g in self.generations() if g < current]
+        if len(previous) == 0:
+            raise RuntimeError(f"No population to roll back to from {current}.")
+        self._point_to(previous[-1])
+        return previous[-1]
+
+    def _prune(self):
+        current = self.current()
+        generations = self.generations()
+        for path in generations[:-(self._keep + 1)]:
+            if path != current:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,79 @@
+import datetime
+import threading
+import time
+
+# Telegram limit for message text length
+MAX_MESSAGE_LENGTH = 4096
+# Seconds to wait for the rest of markets after the first one reported
+DEFAULT_WINDOW = 120
+
+
+class PredictionDigest:
+    """Collects predictions of all markets for one hour into a single message."""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self._window = window
+        self._lock = threading.Lock()
+        self._expected = set()
+        self._reported = set()
+        # (timestamp, market name, prediction)
+        self._predictions = []
+        self._started = None
+
+    def expect(self, market_symbols):
+        # Markets scheduled for this hour, digest is ready once all reported
+        with self._lock:
+            self._expected.update(market_symbols)
+
+    def add(self, market_symbol, predictions, final=True):
+        # Market may send its predictions in several messages, the last
+        # one is final
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            if final:
+                self._reported.add(market_symbol)
+            for p in predictions:
+                self._predictions.append((int(p[0]), market_symbol[1:], p[1]))
+
+    @property
+    def idle(self):
+        # True if nothing was added since the last flush
+        with self._lock:
+            return self._started is None
+
+    def flush_ready(self):
+        # Returns list of digest messages, empty if digest is not ready yet
+        with self._lock:
+            if self._started is None:
+                return []
+            complete = self._expected.issubset(self._reported)
+            expired = time.monotonic() - self._started >= self._window
+            if not (complete or expired):
+                return []
+            predictions = self._predictions
+            self._predictions = []
+            self._expected = set()
+            self._reported = set()
+            self._started = None
+        return self._format(predictions)
+
+    def _format(self, predictions):
+        lines = []
+        last_ts = None
+        for ts, market, prediction in sorted(predictions):
+            if ts != last_ts:
+                lines.append(datetime.datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'))
+                last_ts = ts
+            lines.append(f"{market} {prediction}")
+        # Split digest on line boundaries to fit into Telegram messages
+        messages = []
+        current = ""
+        for line in lines:
+            if len(current) + len(line) + 1 > MAX_MESSAGE_LENGTH and len(current) > 0:
+                messages.append(current)
+                current = ""
+            current = f"{current}\n{line}" if current else line
+        if current:
+            messages.append(current)
+        return messages
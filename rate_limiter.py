@@ -0,0 +1,46 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every caller of one API."""
+
+    def __init__(self, rate, capacity):
+        # rate - tokens added per second, capacity - maximal burst
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now <= self._last:
+            return
+        self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = max(self._last - time.monotonic(), 0) + (tokens - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Empty the bucket and stop refilling for given time, f.e. after
+        # the server answered with a rate limit error
+        with self._lock:
+            self._tokens = 0.0
+            self._last = max(self._last, time.monotonic() + seconds)
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import time
+import select
+import hashlib
+import calendar
+import threading
+import logging
+import logging.handlers
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import psycopg2
+import psycopg2.extensions
+import metrics
+from dbmanager import DatabaseManager, DMError, MARKET_DATA_CHANNEL, PREDICTION_NAMES, get_pool
+
+# Address of the read API, host:port
+READ_API_ADDRESS = os.environ.get("READ_API_ADDRESS", "127.0.0.1:9109")
+# Responses kept in memory
+CACHE_SIZE = 1024
+# Seconds between attempts to listen for notifications again
+LISTEN_RETRY = 5
+# Seconds without notifications after which listening connection is checked
+LISTEN_CHECK = 60
+HOUR = 60 * 60
+# Predictions range returned when request does not give start
+DEFAULT_RANGE = 24 * HOUR
+
+_logger = logging.getLogger('ReadApiLogger')
+_logger.setLevel(logging.ERROR)
+_logger.addHandler(logging.handlers.SysLogHandler(address='/dev/log'))
+
+
+class ResponseCache:
+    """Rendered responses by request, an entry is dropped as soon as data of
+    its market is committed.
+
+    Nothing is cached while notifications are not listened to, a commit
+    missed then would leave stale entries.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self._size = size
+        self._lock = threading.Lock()
+        # key -> (market symbols or None for all markets, body, etag)
+        self._entries = OrderedDict()
+        # Changed by every invalidation, responses rendered from older data
+        # are not stored
+        self._generation = 0
+        self._enabled = False
+
+    @property
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, key):
+        # Returns (body, etag), None if not cached
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+
+    def put(self, key, market_symbols, body, etag, generation):
+        with self._lock:
+            if not self._enabled or generation != self._generation:
+                return
+            self._entries[key] = (market_symbols, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, market_symbol):
+        with self._lock:
+            self._generation += 1
+            for key in [k for k, e in self._entries.items() if e[0] is None or market_symbol in e[0]]:
+                del self._entries[key]
+
+    def set_enabled(self, enabled):
+        with self._lock:
+            self._generation += 1
+            self._enabled = enabled
+            self._entries.clear()
+
+
+class MarketDataListener:
+    """Invalidates cached responses of markets whose history or predictions
+    were committed. Notifications come from every process through
+    PostgreSQL LISTEN on MARKET_DATA_CHANNEL.
+    """
+
+    def __init__(self, cache, pool=None):
+        self._cache = cache
+        self._pool = pool if pool is not None else get_pool()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="market_data_listener", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                connection = self._pool.dedicated_connection()
+                connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with connection.cursor() as c:
+                    c.execute(f"LISTEN {MARKET_DATA_CHANNEL};")
+                self._cache.set_enabled(True)
+                self._listen(connection)
+            except (Exception, psycopg2.Error):
+                _logger.exception("Failed to listen for market data notifications.")
+            finally:
+                self._cache.set_enabled(False)
+                if connection is not None:
+                    connection.close()
+            self._stopped.wait(LISTEN_RETRY)
+
+    def _listen(self, connection):
+        last_message = time.monotonic()
+        while not self._stopped.is_set():
+            if select.select([connection], [], [], 1)[0]:
+                connection.poll()
+                while connection.notifies:
+                    self._cache.invalidate(connection.notifies.pop(0).payload)
+                last_message = time.monotonic()
+            elif time.monotonic() - last_message > LISTEN_CHECK:
+                # Connection lost without a word is found by a query
+                with connection.cursor() as c:
+                    c.execute("SELECT 1;")
+                last_message = time.monotonic()
+
+
+def _epoch(value):
+    # Naive UTC datetime from database -> seconds
+    return calendar.timegm(value.timetuple())
+
+
+def _time_param(query, name, default):
+    values = query.get(name)
+    if values is None:
+        return default
+    try:
+        return int(values[0])
+    except ValueError:
+        raise ValueError(f"{name} should be unix time in seconds")
+
+
+def _etag_matches(etag, if_none_match):
+    if if_none_match is None:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in (t[2:] if t.startswith("W/") else t for t in tags)
+
+
+class ReadApi:
+    """Latest predictions, prediction ranges and 24h plot data as JSON.
+
+    GET /predictions/latest[/<market>]
+    GET /predictions/<market>[?start=<unix time>&end=<unix time>]
+    GET /plot/<market>
+    Responses come from the cache while their markets do not change, so
+    polling clients cost nothing on the database. Every response has an
+    ETag, a request with a matching If-None-Match gets 304 Not Modified.
+    """
+
+    def __init__(self, db=None, cache=None):
+        self._db = db if db is not None else DatabaseManager()
+        self._cache = cache if cache is not None else ResponseCache()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _route(self, path, query):
+        # Returns (route name, cache key, market symbols or None, loader),
+        # None if there is no such resource
+        parts = [unquote(p) for p in path.strip("/").split("/")]
+        current_hour = int(time.time()) // HOUR * HOUR
+        if parts == ["predictions", "latest"]:
+            return ("latest", ("latest",), None, self._latest)
+        if len(parts) == 3 and parts[:2] == ["predictions", "latest"]:
+            m = parts[2]
+            return ("latest", ("latest", m), {m}, lambda: self._latest([m]))
+        if len(parts) == 2 and parts[0] == "predictions":
+            m = parts[1]
+            # Default range moves every hour, so does the key
+            start = _time_param(query, "start", current_hour - DEFAULT_RANGE)
+            end = _time_param(query, "end", None)
+            return ("range", ("range", m, start, end), {m}, lambda: self._range(m, start, end))
+        if len(parts) == 2 and parts[0] == "plot":
+            m = parts[1]
+            return ("plot", ("plot", m, current_hour), {m}, lambda: self._plot(m))
+        return None
+
+    def _latest(self, market_symbols=None):
+        return {'predictions': [{'market': m, 'time': ts, 'prediction': p}
+                                for m, ts, p in self._db.get_latest_predictions(market_symbols)]}
+
+    def _range(self, market_symbol, start, end):
+        return {'market': market_symbol,
+                'predictions': [{'time': ts, 'prediction': p, 'close': close}
+                                for ts, p, close in self._db.get_predictions_range(market_symbol, start, end)]}
+
+    def _plot(self, market_symbol):
+        # Hours with history but no prediction yet have NULL prediction
+        return {'market': market_symbol,
+                'data': [{'time': _epoch(row[0]), 'close': float(row[1]),
+                          'prediction': None if row[2] is None else PREDICTION_NAMES.get(int(row[2]))}
+                         for row in self._db.get_24h_plot_data(market_symbol)]}
+
+    def handle(self, path, query, if_none_match=None):
+        # Returns (HTTP status, body, etag)
+        try:
+            route = self._route(path, query)
+        except ValueError as error:
+            return (400, json.dumps({'error': str(error)}).encode(), None)
+        if route is None:
+            return (404, json.dumps({'error': "not found"}).encode(), None)
+        name, key, market_symbols, load = route
+        cached = self._cache.get(key)
+        if cached is not None:
+            body, etag = cached
+            result = 'hit'
+        else:
+            generation = self._cache.generation
+            try:
+                body = json.dumps(load()).encode()
+            except DMError:
+                _logger.exception(f"Failed to answer {path}.")
+                return (500, json.dumps({'error': "database error"}).encode(), None)
+            except Exception:
+                _logger.exception(f"Failed to answer {path}.")
+                return (500, json.dumps({'error': "internal error"}).encode(), None)
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            self._cache.put(key, market_symbols, body, etag, generation)
+            result = 'miss'
+        if _etag_matches(etag, if_none_match):
+            metrics.inc("read_api_requests_total", route=name, result='not_modified')
+            return (304, b"", etag)
+        metrics.inc("read_api_requests_total", route=name, result=result)
+        return (200, body, etag)
+
+
+class ReadApiServer:
+    """Serves ReadApi over HTTP on a local port."""
+
+    def __init__(self, api, address=READ_API_ADDRESS):
+        host, port = address.rsplit(":", 1)
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive saves a connection per request of polling clients
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                status, body, etag = api.handle(url.path, parse_qs(url.query), self.headers.get("If-None-Match"))
+                self.send_response(status)
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", "no-cache")
+                if status != 304:
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if status != 304:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, int(port)), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="read_api", daemon=True)
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def start_read_api(db=None, address=READ_API_ADDRESS):
+    # Starts cache invalidation and the server, returns (listener, server)
+    api = ReadApi(db)
+    server = ReadApiServer(api, address)
+    listener = MarketDataListener(api.cache)
+    listener.start()
+    server.start()
+    return listener, server
+
+
+def main(argv):
+    usage = "usage: {} [host:port]".format(argv[0])
+    if len(argv) > 2:
+        print(usage)
+        sys.exit(1)
+    # Read API without the bot
+    listener, server = start_read_api(address=argv[1] if len(argv) == 2 else READ_API_ADDRESS)
+    print(f"Serving on {server.address}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.close()
+        listener.stop()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import filecmp
+from decimal import Decimal
+import numpy as np
+
+
+class ReverseDataError(Exception):
+    pass
+
+
+def java_double_str(value):
+    # Double.toString() of Java 19 and newer: shortest repr digits, plain
+    # notation for 1e-3 <= |value| < 1e7, computerized scientific one
+    # otherwise. Java 11 (what setup installs) sometimes prints more digits
+    # than needed, f.e. 2.0E-3 as "0.0020", the text differs then but
+    # parses to the same double, which is all genotick reads.
+    if value != value:
+        return "NaN"
+    if value in (float('inf'), float('-inf')):
+        return "Infinity" if value > 0 else "-Infinity"
+    if value == 0:
+        return "-0.0" if np.copysign(1.0, value) < 0 else "0.0"
+    sign, digits, exponent = Decimal(repr(float(value))).as_tuple()
+    digits = "".join(str(d) for d in digits)
+    # Power of ten of the first digit
+    point = len(digits) + exponent - 1
+    digits = digits.rstrip("0")
+    prefix = "-" if sign else ""
+    if 1e-3 <= abs(value) < 1e7:
+        if point >= 0:
+            integer = digits[:point + 1].ljust(point + 1, "0")
+            fraction = digits[point + 1:] or "0"
+            return f"{prefix}{integer}.{fraction}"
+        return f"{prefix}0.{'0' * (-point - 1)}{digits}"
+    return f"{prefix}{digits[0]}.{digits[1:] or '0'}E{point}"
+
+
+def _parse_line(line):
+    # Same as genotick data loader: time is a long, "-" removed (dates
+    # like 2019-08-17), other columns are doubles
+    fields = line.split(",")
+    return [int(fields[0].replace("-", ""))] + [float(f) for f in fields[1:]]
+
+
+def _read_rows(lines, first_file_line):
+    rows = []
+    for number, line in enumerate(lines):
+        line = line.rstrip("\r\n")
+        if len(line) == 0:
+            continue
+        try:
+            rows.append(_parse_line(line))
+        except ValueError:
+            # Genotick skips unparsable header of the file only
+            if first_file_line and number == 0:
+                continue
+            raise ReverseDataError(f"Failed to parse data line: {line!r}")
+    return rows
+
+
+def reverse_values(values, last_open=None, last_reverse_open=None):
+    # values - 2d array of candle columns without time. Returns reversed
+    # array, same math as genotick Reversal.reverseLineOHLCV(): open is
+    # chained through previous rows, high/low are swapped and reflected
+    # around open. Columns genotick leaves unset are NaN.
+    opens = values[:, 0]
+    if last_open is None:
+        # First row of the file keeps its original open
+        factors = np.abs(opens[1:] / opens[:-1] - 2.0)
+        start = opens[0]
+    else:
+        factors = np.abs(opens / np.concatenate(([last_open], opens[:-1])) - 2.0)
+        start = last_reverse_open
+    # Sequential products, multiplication order is the same as in genotick
+    reverse_opens = np.cumprod(np.concatenate(([start], factors)))
+    if last_open is not None:
+        reverse_opens = reverse_opens[1:]
+    result = np.full_like(values, np.nan)
+    result[:, 0] = reverse_opens
+    if values.shape[1] >= 3:
+        result[:, 2] = np.abs(values[:, 1] / opens - 2.0) * reverse_opens
+        result[:, 1] = np.abs(values[:, 2] / opens - 2.0) * reverse_opens
+    if values.shape[1] >= 4:
+        result[:, 3] = np.abs(values[:, 3] / opens - 2.0) * reverse_opens
+        result[:, 4:] = values[:, 4:]
+    return result
+
+
+def format_rows(times, values):
+    # Rows as genotick writes them, unset columns are printed as null
+    lines = []
+    for time, row in zip(times, values):
+        lines.append([str(int(time))] + ["null" if v != v else java_double_str(v) for v in row])
+    return lines
+
+
+def reverse_rows(rows, last_open=None, last_reverse_open=None):
+    # Returns reversed rows as lists of strings. All rows must have the
+    # same number of columns.
+    if len(rows) == 0:
+        return []
+    values = np.array([r[1:] for r in rows], dtype=np.float64)
+    return format_rows([r[0] for r in rows], reverse_values(values, last_open, last_reverse_open))
+
+
+def default_reverse_path(data_path):
+    return os.path.join(os.path.dirname(data_path), f"reverse_{os.path.basename(data_path)}")
+
+
+class ReverseDataFile:
+    """Keeps genotick reverse data file in sync with the data file.
+
+    Only rows appended to the data file since last update are reversed and
+    appended. Checkpoint must not be stored in genotick data directory.
+    """
+
+    def __init__(self, data_path, checkpoint_path, reverse_path=None):
+        self._data_path = data_path
+        self._checkpoint_path = checkpoint_path
+        self._reverse_path = reverse_path or default_reverse_path(data_path)
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            if os.path.getsize(self._reverse_path) != checkpoint['reverse_size']:
+                return None
+            # Data file must still start with the rows that were reversed
+            last_line = checkpoint['last_line'].encode()
+            with open(self._data_path, 'rb') as f:
+                f.seek(checkpoint['data_size'] - len(last_line))
+                if f.read(len(last_line)) != last_line:
+                    return None
+        except (OSError, ValueError):
+            return None
+        return checkpoint
+
+    def _write_checkpoint(self, checkpoint):
+        tmp_path = f"{self._checkpoint_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def update(self, rebuild=False):
+        # Returns number of rows appended to reverse file
+        checkpoint = None if rebuild else self._read_checkpoint()
+        offset = 0 if checkpoint is None else checkpoint['data_size']
+        with open(self._data_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # Incomplete last line is left for the next update
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].decode().splitlines(keepends=True)
+        rows = _read_rows(lines, checkpoint is None)
+        if checkpoint is None:
+            reversed_lines = reverse_rows(rows)
+        else:
+            reversed_lines = reverse_rows(rows, checkpoint['last_open'], checkpoint['last_reverse_open'])
+        mode = 'w' if checkpoint is None else 'a'
+        with open(self._reverse_path, mode) as f:
+            for line in reversed_lines:
+                f.write(",".join(line) + "\n")
+        if len(rows) == 0:
+            if checkpoint is None:
+                self._write_checkpoint({'data_size': 0, 'last_line': "", 'reverse_size': 0,
+                                        'last_time': None, 'last_open': None, 'last_reverse_open': None})
+            return 0
+        last_line = lines[-1]
+        self._write_checkpoint({
+            'data_size': offset + end,
+            'last_line': last_line,
+            'reverse_size': os.path.getsize(self._reverse_path),
+            'last_time': rows[-1][0],
+            'last_open': rows[-1][1],
+            'last_reverse_open': float(reversed_lines[-1][1]),
+        })
+        return len(rows)
+
+
+def _same_values(expected, actual):
+    # Lines of reverse files hold the same numbers, whatever their digits
+    expected, actual = expected.rstrip("\n").split(","), actual.rstrip("\n").split(",")
+    if len(expected) != len(actual) or expected[0] != actual[0]:
+        return False
+    return all(e == a or (e != "null" and a != "null" and float(e) == float(a))
+               for e, a in zip(expected[1:], actual[1:]))
+
+
+def verify(data_path, genotick_path):
+    # Compares reverse file made here with the one made by genotick.
+    # Returns (difference, formatted differently), difference is None if
+    # all values are the same, otherwise first differing line. Formatted
+    # differently - number of lines with the same values printed with
+    # other digits, expected before Java 19, see java_double_str().
+    from genotick_worker import run_genotick
+    tmp_path = tempfile.mkdtemp(prefix="reverse_verify_")
+    try:
+        java_path = os.path.join(tmp_path, "java")
+        os.makedirs(java_path)
+        java_data_path = os.path.join(java_path, os.path.basename(data_path))
+        shutil.copyfile(data_path, java_data_path)
+        returncode, stdout, stderr = run_genotick(genotick_path, [f"reverse={java_data_path}"],
+                                                  cwd=java_path, use_worker=False)
+        if returncode != 0:
+            raise ReverseDataError("Genotick failed to reverse data.", stdout, stderr)
+        python_reverse_path = os.path.join(tmp_path, "reverse.csv")
+        ReverseDataFile(data_path, os.path.join(tmp_path, "checkpoint.json"), python_reverse_path).update()
+        java_reverse_path = default_reverse_path(java_data_path)
+        if filecmp.cmp(java_reverse_path, python_reverse_path, shallow=False):
+            return (None, 0)
+        formatted = 0
+        with open(java_reverse_path) as java, open(python_reverse_path) as python:
+            java_lines, python_lines = java.readlines(), python.readlines()
+        for number, (expected, actual) in enumerate(zip(java_lines, python_lines), 1):
+            if expected == actual:
+                continue
+            if not _same_values(expected, actual):
+                return ((number, expected.rstrip("\n"), actual.rstrip("\n")), formatted)
+            formatted += 1
+        if len(java_lines) != len(python_lines):
+            return (("lines", len(java_lines), len(python_lines)), formatted)
+        return (None, formatted)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def main(argv):
+    usage = "usage: {} data_csv checkpoint_json | {} data_csv verify genotick_jar".format(argv[0], argv[0])
+    if len(argv) == 4 and argv[2] == "verify":
+        difference, formatted = verify(argv[1], argv[3])
+        if difference is None and formatted == 0:
+            print("Reverse data is identical to genotick output.")
+            return
+        if difference is None:
+            print(f"Reverse data has the same values as genotick output, {formatted} lines have other digits "
+                  f"(Java before 19 does not print shortest digits).")
+            return
+        print(f"Reverse data differs from genotick output: {difference}")
+        sys.exit(1)
+    if len(argv) != 3:
+        print(usage)
+        sys.exit(1)
+    rows = ReverseDataFile(argv[1], argv[2]).update()
+    print(f"Reversed {rows} new rows.")
+
+if __name__ == "__main__":
+    main(sys.argv)
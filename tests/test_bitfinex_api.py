@@ -0,0 +1,27 @@
+import time
+import bitfinex_api
+from bitfinex_api import HOUR_MS
+
+
+def test_history_drops_open_candle(monkeypatch):
+    open_hour = int(time.time() * 1000) // HOUR_MS * HOUR_MS
+    candles = [[open_hour - 2 * HOUR_MS, 1.0, 2.0, 2.5, 0.5, 10.0],
+               [open_hour - HOUR_MS, 2.0, 3.0, 3.5, 1.5, 10.0],
+               [open_hour, 3.0, 3.1, 3.2, 2.9, 0.1]]
+    requests = []
+
+    def fetch_data(start, stop, symbol, interval, tick_limit):
+        requests.append((start, symbol, interval))
+        return candles
+
+    monkeypatch.setattr(bitfinex_api, "fetch_data", fetch_data)
+    df = bitfinex_api.get_1h_history(open_hour - 2 * HOUR_MS, "tBTCUSD")
+    assert list(df['time']) == [open_hour - 2 * HOUR_MS, open_hour - HOUR_MS]
+    assert requests == [(open_hour - 2 * HOUR_MS, "tBTCUSD", '1h')]
+
+
+def test_candles_to_frame_keeps_last_duplicate():
+    df = bitfinex_api.candles_to_frame([[2, 1.0, 1.0, 1.0, 1.0, 1.0], [1, 1.0, 1.0, 1.0, 1.0, 1.0],
+                                        [2, 5.0, 5.0, 5.0, 5.0, 5.0]])
+    assert list(df['time']) == [1, 2]
+    assert df['open'].iloc[-1] == 5.0
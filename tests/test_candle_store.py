@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from bitfinex_api import CANDLE_COLUMNS
+from candle_store import CandleStore, HOUR_MS
+
+
+def make_candles(hours, seed=1):
+    rng = np.random.default_rng(seed)
+    hours = np.asarray(hours)
+    opens = 100 * np.cumprod(1 + rng.normal(0, 0.01, len(hours)))
+    closes = opens * (1 + rng.normal(0, 0.01, len(hours)))
+    return pd.DataFrame({'time': hours * HOUR_MS, 'open': opens, 'close': closes,
+                         'high': np.maximum(opens, closes) * 1.01, 'low': np.minimum(opens, closes) * 0.99,
+                         'volume': rng.uniform(1, 10, len(hours))}, columns=CANDLE_COLUMNS)
+
+
+def test_appends_match_one_rewrite(tmp_path):
+    df = make_candles(range(100))
+    whole = CandleStore(str(tmp_path / "whole"))
+    whole.append(df)
+    store = CandleStore(str(tmp_path / "store"))
+    for start in range(0, 100, 13):
+        assert store.append(df.iloc[start:start + 13]) == len(df.iloc[start:start + 13])
+    assert len(store) == 100
+    assert store.last_time() == 99 * HOUR_MS
+    np.testing.assert_array_equal(store.candles(), whole.candles())
+    np.testing.assert_array_equal(store.reverse(), whole.reverse())
+
+
+def test_update_inside_history_rewrites(tmp_path):
+    df = make_candles(range(50))
+    store = CandleStore(str(tmp_path))
+    store.append(df)
+    update = make_candles([20, 20, 49], seed=2)
+    store.append(update)
+    candles = store.candles()
+    assert len(candles) == 50
+    # Last of duplicated candles wins
+    assert candles['close'][20] == update['close'].iloc[1]
+    assert candles['close'][49] == update['close'].iloc[2]
+    assert candles['close'][19] == df['close'].iloc[19]
+    expected = CandleStore(str(tmp_path / "expected"))
+    expected.append(pd.DataFrame(candles.tolist(), columns=CANDLE_COLUMNS))
+    np.testing.assert_array_equal(store.reverse(), expected.reverse())
+
+
+def test_missing_candles_fill_gaps(tmp_path):
+    store = CandleStore(str(tmp_path))
+    store.append(make_candles([0, 1, 5, 6, 9]))
+    assert store.gaps() == [(2 * HOUR_MS, 4 * HOUR_MS), (7 * HOUR_MS, 8 * HOUR_MS)]
+    store.append(make_candles([2, 3, 4, 7, 8], seed=2))
+    assert store.gaps() == []
+    assert list(store.candles()['time']) == [h * HOUR_MS for h in range(10)]
+
+
+def test_interrupted_append_rebuilds_reverse_data(tmp_path):
+    store = CandleStore(str(tmp_path))
+    store.append(make_candles(range(10)))
+    with open(tmp_path / "reverse.bin", 'r+b') as f:
+        f.truncate(5 * store.reverse().itemsize)
+    reopened = CandleStore(str(tmp_path))
+    assert len(reopened.reverse()) == 10
+    np.testing.assert_array_equal(reopened.reverse()['time'], reopened.candles()['time'])
+
+
+def test_empty_append(tmp_path):
+    store = CandleStore(str(tmp_path))
+    assert store.append(make_candles([])) == 0
+    assert len(store) == 0
+    assert store.last_time() is None
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import evaluation
+
+
+def make_series(opens, closes, predictions, start=0):
+    n = len(opens)
+    return {'time': np.arange(start, start + n * 3600, 3600, dtype=np.int64)[:n],
+            'open': np.asarray(opens, dtype=np.float64),
+            'close': np.asarray(closes, dtype=np.float64),
+            'prediction': np.asarray(predictions, dtype=np.int8)}
+
+
+def random_series(n, seed=1):
+    rng = np.random.default_rng(seed)
+    opens = 100 * np.cumprod(1 + rng.normal(0, 0.01, n))
+    closes = opens * (1 + rng.normal(0, 0.01, n))
+    return make_series(opens, closes, rng.integers(-1, 2, n))
+
+
+def split(series, start, end):
+    return {name: values[start:end] for name, values in series.items()}
+
+
+def test_update_state_counts_hits_and_pnl():
+    # UP right, DOWN right, OUT, UP wrong
+    series = make_series([100, 110, 99, 99], [110, 99, 120, 90], [1, -1, 0, 1])
+    state = evaluation.update_state(evaluation.empty_state(), series)
+    assert state['predictions'] == 4
+    assert state['directional'] == 3
+    assert state['hits'] == 2
+    assert state['recent_hits'] == [1, 1, 0]
+    returns = [0.1, 0.1, 0.0, -9 / 99]
+    assert state['pnl'] == pytest.approx(sum(returns))
+    assert state['equity'] == pytest.approx(np.prod([1 + r for r in returns]))
+    assert state['max_drawdown'] == pytest.approx(9 / 99)
+    assert state['evaluated_ts'] == int(series['time'][-1])
+
+
+def test_update_state_is_incremental():
+    series = random_series(500)
+    whole = evaluation.update_state(evaluation.empty_state(), series)
+    state = evaluation.empty_state()
+    for start in range(0, 500, 37):
+        state = evaluation.update_state(state, split(series, start, start + 37))
+    for name in ('evaluated_ts', 'predictions', 'directional', 'hits', 'recent_hits'):
+        assert state[name] == whole[name]
+    for name in ('pnl', 'equity', 'peak_equity', 'max_drawdown'):
+        assert state[name] == pytest.approx(whole[name])
+    assert len(state['recent_hits']) == evaluation.ROLLING_WINDOW
+
+
+def test_update_state_without_candles_keeps_state():
+    state = evaluation.empty_state()
+    assert evaluation.update_state(state, make_series([], [], [])) is state
+
+
+def test_backtest_matches_loop():
+    series = random_series(300, seed=7)
+    window = 20
+    result = evaluation.backtest(series, window)
+    equity, peak, calls = 1.0, 1.0, []
+    for i in range(300):
+        step = series['close'][i] / series['open'][i] - 1.0
+        equity *= 1.0 + series['prediction'][i] * step
+        peak = max(peak, equity)
+        assert result['equity'][i] == pytest.approx(equity)
+        assert result['drawdown'][i] == pytest.approx(1.0 - equity / peak)
+        if series['prediction'][i] != 0:
+            calls.append(np.sign(series['close'][i] - series['open'][i]) == series['prediction'][i])
+        recent = calls[-window:]
+        if len(recent) == 0:
+            assert np.isnan(result['rolling_accuracy_series'][i])
+        else:
+            assert result['rolling_accuracy_series'][i] == pytest.approx(sum(recent) / len(recent))
+    assert result['return'] == pytest.approx(equity - 1.0)
+
+
+class FakeDb:
+
+    def __init__(self, series):
+        self.series = series
+        self.state = None
+        self.saves = 0
+
+    def get_accuracy_state(self, market_symbol):
+        return self.state
+
+    def get_prediction_series(self, market_symbol, after_ts=None):
+        keep = self.series['time'] > (-1 if after_ts is None else after_ts)
+        return {name: values[keep] for name, values in self.series.items()}
+
+    def save_accuracy_state(self, market_symbol, state):
+        self.state = state
+        self.saves += 1
+
+
+def test_evaluator_update_saves_new_candles_only():
+    db = FakeDb(random_series(100, seed=3))
+    evaluator = evaluation.Evaluator(db)
+    first = evaluator.update("tBTCUSD")
+    second = evaluator.update("tBTCUSD")
+    assert db.saves == 1
+    assert first == second
+    assert first['predictions'] == 100
@@ -0,0 +1,51 @@
+import sys
+import json
+import pytest
+import jvm_profile
+from jvm_profile import JvmProfile, parse_cpus, run_jvm
+
+
+def test_parse_cpus():
+    assert parse_cpus("0-3,6") == [0, 1, 2, 3, 6]
+    assert parse_cpus(2) == [2]
+
+
+def test_market_profile_overrides_defaults(tmp_path):
+    assert JvmProfile.load(str(tmp_path)).to_dict() == jvm_profile.DEFAULTS
+    (tmp_path / jvm_profile.PROFILE_FILE).write_text(json.dumps({'heap_mb': 3072, 'cpus': "2-3"}))
+    profile = JvmProfile.load(str(tmp_path))
+    assert profile.memory_mb == 3072 + jvm_profile.JVM_OVERHEAD_MB
+    assert profile.java_options() == ["-Xmx3072m", "-XX:+UseParallelGC", "-XX:ActiveProcessorCount=2"]
+    assert profile.predict_timeout == jvm_profile.PREDICT_TIMEOUT
+
+
+def test_unknown_setting():
+    with pytest.raises(ValueError):
+        JvmProfile(heap=1024)
+
+
+def test_command_ends_with_java(monkeypatch):
+    monkeypatch.setattr(jvm_profile, "JAVA_COMMAND", ["java"])
+    monkeypatch.setattr(jvm_profile.shutil, "which", lambda name: f"/usr/bin/{name}")
+    profile = JvmProfile(heap_mb=1024, gc=None)
+    assert profile.command(["-jar", "genotick.jar"], jvm_profile.PREDICT) == \
+        ["java", "-Xmx1024m", "-jar", "genotick.jar"]
+    assert profile.command(["-jar", "genotick.jar"], jvm_profile.TRAIN) == \
+        ["ionice", "-c", "2", "-n", "7", "nice", "-n", "10", "java", "-Xmx1024m", "-jar", "genotick.jar"]
+
+
+def test_run_jvm_passes_lines():
+    lines = []
+    returncode, usage = run_jvm([sys.executable, "-c", "print('a'); print('b'); exit(3)"], lines.append, 30)
+    assert returncode == 3
+    assert lines == ["a", "b"]
+    assert not usage['timed_out']
+
+
+def test_run_jvm_kills_hung_process():
+    # Closes its output and hangs, as a JVM stuck in shutdown hooks
+    script = "import os, time; os.close(1); time.sleep(30)"
+    returncode, usage = run_jvm([sys.executable, "-c", script], lambda line: None, 0.5)
+    assert returncode == -9
+    assert usage['timed_out']
+    assert usage['wall_seconds'] < 10
@@ -0,0 +1,44 @@
+import pytest
+from market_manager import MarketManager
+
+
+class FakeOutbox:
+
+    def __init__(self, manager, fail=False):
+        self._manager = manager
+        self._fail = fail
+        self.visible = dict()
+
+    def complete(self, ids, messages=(), on_enqueued=None):
+        new_ids = [100 + i for i in range(len(messages))]
+        if on_enqueued is not None:
+            on_enqueued(new_ids)
+        if self._fail:
+            raise RuntimeError("commit failed")
+        # Committed, consumers may claim and finish the messages right away
+        self.visible = dict((i, dict(self._manager._delivery_close_ts)) for i in new_ids)
+        return new_ids
+
+
+def make_manager(fail=False):
+    # Digest state only, without database, bot and schedulers
+    manager = MarketManager.__new__(MarketManager)
+    manager._digest_ids = [1, 2]
+    manager._digest_texts = ["2020-01-01 00:00:00\nBTCUSD UP"]
+    manager._digest_close_ts = 1577836800
+    manager._delivery_close_ts = dict()
+    manager._outbox = FakeOutbox(manager, fail)
+    return manager
+
+
+def test_delivery_close_time_is_known_before_commit():
+    manager = make_manager()
+    manager._complete_digest()
+    assert manager._outbox.visible == {100: {100: 1577836800}}
+
+
+def test_failed_completion_drops_close_times():
+    manager = make_manager(fail=True)
+    with pytest.raises(RuntimeError):
+        manager._complete_digest()
+    assert manager._delivery_close_ts == {}
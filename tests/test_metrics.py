@@ -0,0 +1,116 @@
+import pytest
+import metrics
+
+
+def test_merge_adds_counters_histograms_and_keeps_maximums():
+    parent = metrics.Metrics(buckets=(1, 10))
+    parent.inc("runs_total", market="tBTCUSD")
+    parent.observe("run_seconds", 0.5, market="tBTCUSD")
+    parent.maximum("peak_rss_mb", 300, market="tBTCUSD")
+    child = metrics.Metrics(buckets=(1, 10))
+    child.inc("runs_total", 2, market="tBTCUSD")
+    child.inc("runs_total", market="tETHUSD")
+    child.observe("run_seconds", 5, market="tBTCUSD")
+    child.observe("run_seconds", 50, market="tBTCUSD")
+    child.maximum("peak_rss_mb", 200, market="tBTCUSD")
+    parent.merge(child.snapshot())
+    result = parent.to_dict()
+    assert [(c['labels']['market'], c['value']) for c in result['counters']] == [("tBTCUSD", 3), ("tETHUSD", 1)]
+    histogram, = result['histograms']
+    assert histogram['count'] == 3
+    assert histogram['sum'] == pytest.approx(55.5)
+    assert histogram['buckets'] == {'1': 1, '10': 1, '+Inf': 1}
+    assert result['maximums'][0]['value'] == 300
+
+
+def test_merge_rejects_other_buckets():
+    with pytest.raises(ValueError):
+        metrics.Metrics(buckets=(1, 10)).merge(metrics.Metrics(buckets=(1, 5)).snapshot())
+
+
+def test_merge_accepts_snapshot_without_maximums():
+    # Snapshots of workers started before maximums were added
+    parent = metrics.Metrics(buckets=(1,))
+    parent.merge({'buckets': [1], 'counters': [["runs_total", {}, 4]], 'histograms': []})
+    assert parent.to_dict()['counters'][0]['value'] == 4
+
+
+def test_flush_moves_metrics_to_parent():
+    parent = metrics.Metrics()
+    child = metrics.Metrics()
+    child.set_parent(parent)
+    child.inc("runs_total", market="tBTCUSD")
+    child.flush()
+    child.flush()
+    assert child.to_dict() == {'counters': [], 'histograms': [], 'maximums': [], 'gauges': []}
+    assert parent.to_dict()['counters'][0]['value'] == 1
+
+
+def test_prometheus_format():
+    registry = metrics.Metrics(buckets=(0.5, 2))
+    registry.inc("deliveries_total", 2, status="ok")
+    registry.observe("run_seconds", 0.5, market="tBTCUSD")
+    registry.observe("run_seconds", 1.25, market="tBTCUSD")
+    registry.observe("run_seconds", 3, market="tBTCUSD")
+    registry.maximum("peak_rss_mb", 512.5)
+    assert registry.to_prometheus() == "\n".join([
+        '# TYPE deliveries_total counter',
+        'deliveries_total{status="ok"} 2',
+        '# TYPE run_seconds histogram',
+        'run_seconds_bucket{market="tBTCUSD",le="0.5"} 1',
+        'run_seconds_bucket{market="tBTCUSD",le="2"} 2',
+        'run_seconds_bucket{market="tBTCUSD",le="+Inf"} 3',
+        'run_seconds_sum{market="tBTCUSD"} 4.75',
+        'run_seconds_count{market="tBTCUSD"} 3',
+        '# TYPE peak_rss_mb gauge',
+        'peak_rss_mb 512.5',
+    ]) + "\n"
+
+
+def test_timer_labels_failed_runs():
+    registry = metrics.Metrics()
+    with registry.timer("run_seconds"):
+        pass
+    with pytest.raises(RuntimeError):
+        with registry.timer("run_seconds"):
+            raise RuntimeError()
+    statuses = [h['labels']['status'] for h in registry.to_dict()['histograms']]
+    assert statuses == ['error', 'ok']
+
+
+def test_collectors_are_read_on_export():
+    registry = metrics.Metrics()
+    state = {'in_use': 1}
+    registry.add_collector(lambda: [("pool_connections", {'state': 'in_use'}, state['in_use'])])
+    assert 'pool_connections{state="in_use"} 1' in registry.to_prometheus()
+    state['in_use'] = 3
+    # Metrics server exports a combination of registries
+    combined = metrics.combine(registry, metrics.Metrics())
+    assert combined.to_dict()['gauges'] == [{'name': "pool_connections", 'labels': {'state': "in_use"}, 'value': 3}]
+    assert '# TYPE pool_connections gauge' in combined.to_prometheus()
+
+
+def test_failed_collector_keeps_last_values():
+    registry = metrics.Metrics()
+    values = [[("queue_size", {}, 5)]]
+
+    def collect():
+        if len(values) == 0:
+            raise RuntimeError("pool is closed")
+        return values.pop()
+
+    registry.add_collector(collect)
+    registry.add_collector(lambda: [("workers", {}, 2)])
+    registry.to_prometheus()
+    assert registry.to_prometheus().endswith("queue_size 5\n# TYPE workers gauge\nworkers 2\n")
+
+
+def test_pool_gauges():
+    from dbmanager import ConnectionPool, pool_gauges
+    pool = ConnectionPool(minconn=0, maxconn=4)
+    registry = metrics.Metrics()
+    registry.add_collector(lambda: pool_gauges(pool.stats()))
+    text = registry.to_prometheus()
+    assert 'db_pool_connections{state="idle"} 0' in text
+    assert 'db_pool_connections{state="in_use"} 0' in text
+    assert 'db_pool_max_size 4' in text
@@ -0,0 +1,89 @@
+import contextlib
+import pytest
+import outbox
+from dbmanager import DMError
+
+
+class FakeCursor:
+
+    def __init__(self, rowcount, error):
+        self.queries = []
+        self.rowcount = rowcount
+        self._error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, params=None):
+        if self._error is not None:
+            raise self._error
+        self.queries.append((" ".join(query.split()), params))
+
+
+class FakeConnection:
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # Transaction ends with the with block
+        self._cursor.queries.append(("COMMIT" if exc_type is None else "ROLLBACK", None))
+        return False
+
+    def cursor(self):
+        return self._cursor
+
+
+class FakePool:
+
+    def __init__(self, rowcount=0, error=None):
+        self.cursor = FakeCursor(rowcount, error)
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield FakeConnection(self.cursor)
+
+
+def test_purge_deletes_finished_messages_only():
+    pool = FakePool(rowcount=42)
+    assert outbox.Outbox(pool).purge() == 42
+    (query, params), commit = pool.cursor.queries
+    assert commit == ("COMMIT", None)
+    assert query.startswith('DELETE FROM "public".outbox WHERE')
+    assert "status IN ('done', 'dead')" in query
+    assert "finished_at <=" in query
+    assert params == (outbox.RETENTION_DAYS,)
+
+
+def test_purge_with_other_retention():
+    pool = FakePool()
+    outbox.Outbox(pool).purge(30)
+    assert pool.cursor.queries[0][1] == (30,)
+
+
+def test_purge_error():
+    with pytest.raises(DMError):
+        outbox.Outbox(FakePool(error=RuntimeError("connection lost"))).purge()
+
+
+def test_retry_delay_grows_to_limit():
+    assert [outbox.retry_delay(a) for a in (0, 1, 2, 3)] == [30, 30, 60, 120]
+    assert outbox.retry_delay(100) == outbox.MAX_RETRY_DELAY
+
+
+def test_complete_reports_new_ids_before_commit(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(outbox.Outbox, "_insert", lambda self, cursor, messages: [7, 8][:len(messages)])
+    seen = []
+    ids = outbox.Outbox(pool).complete([1, 2], [(outbox.TEXT, b"a"), (outbox.TEXT, b"b")],
+                                      lambda new_ids: seen.append((new_ids, len(pool.cursor.queries))))
+    assert ids == [7, 8]
+    # Messages were marked done, transaction was not committed yet
+    assert seen == [([7, 8], 1)]
+    assert pool.cursor.queries[-1] == ("COMMIT", None)
@@ -0,0 +1,38 @@
+import os
+import pytest
+from population import PopulationStore
+
+GENERATIONS = ["20200101000000_1", "20200102000000_1", "20200103000000_1"]
+
+
+def make_store(market_path, keep=3):
+    store = PopulationStore(market_path, keep)
+    for name in GENERATIONS:
+        os.makedirs(os.path.join(market_path, "populations", name))
+        with open(os.path.join(market_path, "populations", name, "robot.prg"), 'w') as f:
+            f.write(name)
+    return store
+
+
+def test_rollback_with_relative_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = make_store("m")
+    store._point_to(os.path.join("m", "populations", GENERATIONS[-1]))
+    assert store.rollback() == str(tmp_path / "m" / "populations" / GENERATIONS[-2])
+    with open(os.path.join("m", "robots", "robot.prg")) as f:
+        assert f.read() == GENERATIONS[-2]
+
+
+def test_rollback_without_population(tmp_path):
+    with pytest.raises(RuntimeError):
+        PopulationStore(str(tmp_path)).rollback()
+
+
+def test_current_generation_is_never_pruned(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = make_store("m", keep=1)
+    # Rolled back to the oldest generation
+    store._point_to(os.path.join("m", "populations", GENERATIONS[0]))
+    store._prune()
+    assert sorted(os.listdir(os.path.join("m", "populations"))) == GENERATIONS
+    assert store.current() == str(tmp_path / "m" / "populations" / GENERATIONS[0])
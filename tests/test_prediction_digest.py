@@ -0,0 +1,36 @@
+import prediction_digest
+from prediction_digest import PredictionDigest
+
+
+def test_digest_waits_for_expected_markets():
+    digest = PredictionDigest(window=3600)
+    digest.expect(["tBTCUSD", "tETHUSD"])
+    assert digest.idle
+    digest.add("tBTCUSD", [(7200, "UP")])
+    assert not digest.idle
+    assert digest.flush_ready() == []
+    digest.add("tETHUSD", [(3600, "DOWN")], final=False)
+    assert digest.flush_ready() == []
+    digest.add("tETHUSD", [(7200, "OUT")])
+    assert digest.flush_ready() == [
+        "1970-01-01 01:00:00\nETHUSD DOWN\n1970-01-01 02:00:00\nBTCUSD UP\nETHUSD OUT"]
+    assert digest.idle
+    assert digest.flush_ready() == []
+
+
+def test_digest_is_sent_when_window_expires():
+    digest = PredictionDigest(window=0)
+    digest.expect(["tBTCUSD", "tETHUSD"])
+    digest.add("tBTCUSD", [(0, "UP")])
+    assert digest.flush_ready() == ["1970-01-01 00:00:00\nBTCUSD UP"]
+
+
+def test_long_digest_is_split_on_lines(monkeypatch):
+    monkeypatch.setattr(prediction_digest, "MAX_MESSAGE_LENGTH", 41)
+    digest = PredictionDigest()
+    digest.add("tBTCUSD", [(0, "UP")])
+    digest.add("tETHUSD", [(0, "DOWN")])
+    digest.add("tXRPUSD", [(0, "OUT")])
+    messages = digest.flush_ready()
+    assert messages == ["1970-01-01 00:00:00\nBTCUSD UP\nETHUSD DOWN", "XRPUSD OUT"]
+    assert all(len(m) <= 41 for m in messages)
@@ -0,0 +1,26 @@
+import time
+from rate_limiter import TokenBucket
+
+
+def test_burst_up_to_capacity():
+    bucket = TokenBucket(rate=1, capacity=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_acquire_waits_for_refill():
+    bucket = TokenBucket(rate=20, capacity=1)
+    bucket.acquire()
+    started = time.monotonic()
+    bucket.acquire()
+    assert 0.03 <= time.monotonic() - started < 0.5
+
+
+def test_pause_stops_refill():
+    bucket = TokenBucket(rate=1000, capacity=5)
+    bucket.pause(0.1)
+    assert not bucket.try_acquire()
+    time.sleep(0.05)
+    assert not bucket.try_acquire()
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.02
@@ -0,0 +1,97 @@
+import json
+import datetime
+from dbmanager import PREDICTION_NAMES
+from read_api import ReadApi, ResponseCache
+
+
+def enabled_cache(size=10):
+    cache = ResponseCache(size)
+    cache.set_enabled(True)
+    return cache
+
+
+def test_nothing_cached_while_disabled():
+    cache = ResponseCache(10)
+    cache.put("/predictions/latest", None, b"[]", "e1", cache.generation)
+    assert cache.get("/predictions/latest") is None
+
+
+def test_put_and_get():
+    cache = enabled_cache()
+    cache.put("/plot/tBTCUSD", ("tBTCUSD",), b"{}", "e1", cache.generation)
+    assert cache.get("/plot/tBTCUSD") == (b"{}", "e1")
+
+
+def test_response_rendered_before_invalidation_is_not_stored():
+    cache = enabled_cache()
+    generation = cache.generation
+    cache.invalidate("tETHUSD")
+    cache.put("/plot/tBTCUSD", ("tBTCUSD",), b"{}", "e1", generation)
+    assert cache.get("/plot/tBTCUSD") is None
+
+
+def test_invalidate_drops_market_and_all_market_entries():
+    cache = enabled_cache()
+    cache.put("/plot/tBTCUSD", ("tBTCUSD",), b"btc", "e1", cache.generation)
+    cache.put("/plot/tETHUSD", ("tETHUSD",), b"eth", "e2", cache.generation)
+    cache.put("/predictions/latest", None, b"all", "e3", cache.generation)
+    cache.invalidate("tBTCUSD")
+    assert cache.get("/plot/tBTCUSD") is None
+    assert cache.get("/predictions/latest") is None
+    assert cache.get("/plot/tETHUSD") == (b"eth", "e2")
+
+
+def test_disable_clears_entries():
+    cache = enabled_cache()
+    generation = cache.generation
+    cache.put("/plot/tBTCUSD", ("tBTCUSD",), b"btc", "e1", generation)
+    cache.set_enabled(False)
+    cache.set_enabled(True)
+    assert cache.get("/plot/tBTCUSD") is None
+    cache.put("/plot/tBTCUSD", ("tBTCUSD",), b"btc", "e1", generation)
+    assert cache.get("/plot/tBTCUSD") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = enabled_cache(size=2)
+    cache.put("a", ("tA",), b"a", "ea", cache.generation)
+    cache.put("b", ("tB",), b"b", "eb", cache.generation)
+    cache.get("a")
+    cache.put("c", ("tC",), b"c", "ec", cache.generation)
+    assert cache.get("b") is None
+    assert cache.get("a") == (b"a", "ea")
+    assert cache.get("c") == (b"c", "ec")
+
+
+class FakeDb:
+
+    def __init__(self, plot_rows=(), error=None):
+        self._plot_rows = plot_rows
+        self._error = error
+
+    def get_24h_plot_data(self, market_symbol):
+        if self._error is not None:
+            raise self._error
+        return self._plot_rows
+
+
+def test_plot_with_missing_prediction():
+    rows = [(datetime.datetime(2020, 1, 1, 0), 100.5, 1), (datetime.datetime(2020, 1, 1, 1), 101.0, None)]
+    status, body, etag = ReadApi(FakeDb(rows), enabled_cache()).handle("/plot/tBTCUSD", {})
+    assert status == 200
+    data = json.loads(body)['data']
+    assert data[0] == {'time': 1577836800, 'close': 100.5, 'prediction': PREDICTION_NAMES[1]}
+    assert data[1] == {'time': 1577840400, 'close': 101.0, 'prediction': None}
+    assert ReadApi(FakeDb(rows), enabled_cache()).handle("/plot/tBTCUSD", {}, etag)[0] == 304
+
+
+def test_unexpected_error_is_internal_error():
+    api = ReadApi(FakeDb(error=KeyError("close")), enabled_cache())
+    status, body, etag = api.handle("/plot/tBTCUSD", {})
+    assert status == 500
+    assert json.loads(body) == {'error': "internal error"}
+    assert etag is None
+
+
+def test_unknown_resource():
+    assert ReadApi(FakeDb(), enabled_cache()).handle("/plots", {})[0] == 404
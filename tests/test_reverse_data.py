@@ -0,0 +1,63 @@
+import pytest
+import reverse_data
+from reverse_data import java_double_str, ReverseDataFile, ReverseDataError
+
+
+@pytest.mark.parametrize("value, text", [
+    (0.0, "0.0"), (-0.0, "-0.0"), (1.0, "1.0"), (100.0, "100.0"), (-2.5, "-2.5"),
+    (0.001, "0.001"), (0.002, "0.002"), (1234567.0, "1234567.0"), (1e7, "1.0E7"),
+    (0.0001234, "1.234E-4"), (123456789.5, "1.234567895E8"), (0.1 + 0.2, "0.30000000000000004"),
+    (float('nan'), "NaN"), (float('inf'), "Infinity"),
+])
+def test_java_double_str(value, text):
+    assert java_double_str(value) == text
+
+
+def test_same_values_ignores_digits_only():
+    assert reverse_data._same_values("1,0.0020,null\n", "1,0.002,null")
+    assert not reverse_data._same_values("1,0.002,null", "1,0.003,null")
+    assert not reverse_data._same_values("1,0.002,null", "2,0.002,null")
+    assert not reverse_data._same_values("1,0.002,null", "1,0.002,0.0")
+
+
+def write(path, lines):
+    with open(path, 'a') as f:
+        f.write("".join(line + "\n" for line in lines))
+
+
+def test_incremental_update_matches_rebuild(tmp_path):
+    data_path = str(tmp_path / "tBTCUSD.csv")
+    lines = [f"{i * 3600000},{100 + i * 0.7},{101 + i * 0.3},{102 + i},{99 + i * 0.1},{i + 0.5}" for i in range(30)]
+    write(data_path, ["time,open,close,high,low,volume"] + lines[:10])
+    reverse = ReverseDataFile(data_path, str(tmp_path / "checkpoint.json"), str(tmp_path / "incremental.csv"))
+    assert reverse.update() == 10
+    assert reverse.update() == 0
+    # Incomplete line is left for the next update
+    with open(data_path, 'a') as f:
+        f.write("\n".join(lines[10:]))
+    assert reverse.update() == 19
+    write(data_path, [""])
+    assert reverse.update() == 1
+    rebuilt = ReverseDataFile(data_path, str(tmp_path / "rebuilt.json"), str(tmp_path / "rebuilt.csv"))
+    assert rebuilt.update() == 30
+    assert (tmp_path / "incremental.csv").read_text() == (tmp_path / "rebuilt.csv").read_text()
+
+
+def test_changed_data_file_is_rebuilt(tmp_path):
+    data_path = str(tmp_path / "tBTCUSD.csv")
+    write(data_path, ["0,100.0,101.0,102.0,99.0,1.0", "3600000,101.0,100.0,103.0,98.0,2.0"])
+    reverse = ReverseDataFile(data_path, str(tmp_path / "checkpoint.json"))
+    reverse.update()
+    with open(data_path, 'w') as f:
+        f.write("0,200.0,201.0,202.0,199.0,1.0\n")
+    assert reverse.update() == 1
+    rebuilt = ReverseDataFile(data_path, str(tmp_path / "rebuilt.json"), str(tmp_path / "rebuilt.csv"))
+    rebuilt.update()
+    assert (tmp_path / "reverse_tBTCUSD.csv").read_text() == (tmp_path / "rebuilt.csv").read_text()
+
+
+def test_unparsable_line_inside_file(tmp_path):
+    data_path = str(tmp_path / "tBTCUSD.csv")
+    write(data_path, ["0,100.0,101.0,102.0,99.0,1.0", "oops"])
+    with pytest.raises(ReverseDataError):
+        ReverseDataFile(data_path, str(tmp_path / "checkpoint.json")).update()
@@ -0,0 +1,86 @@
+import time
+from io import BytesIO
+from tgbot import Bot, Broadcaster
+
+
+def fast_broadcaster(max_retries=0):
+    return Broadcaster(max_workers=4, global_rate=1000, chat_rate=1000, max_retries=max_retries)
+
+
+def test_flood_wait_pauses_all_chats():
+    broadcaster = fast_broadcaster()
+    flood = {'ok': False, 'error_code': 429, 'description': "Too Many Requests",
+             'parameters': {'retry_after': 0.3}}
+    assert broadcaster.deliver(lambda chat_id: flood, 1)[0] == "failed"
+    started = time.monotonic()
+    assert broadcaster.deliver(lambda chat_id: {'ok': True}, 2) == ("ok", {'ok': True})
+    assert time.monotonic() - started >= 0.25
+    broadcaster.close()
+
+
+def test_broadcast_statuses():
+    broadcaster = fast_broadcaster(max_retries=1)
+    responses = {
+        1: {'ok': True},
+        2: {'ok': False, 'error_code': 403, 'description': "Forbidden: bot was blocked by the user"},
+        3: {'ok': False, 'error_code': 400, 'description': "Bad Request: chat not found"},
+        4: {'ok': False, 'error_code': 400, 'description': "Bad Request: message is too long"},
+    }
+    result = broadcaster.broadcast(lambda chat_id: responses[chat_id], [1, 2, 3, 4])
+    assert result.succeeded == [1]
+    assert sorted(result.blocked) == [2, 3]
+    assert result.failed == {4: "Bad Request: message is too long"}
+    broadcaster.close()
+
+
+class FakeBot(Bot):
+
+    def __init__(self, stale_file_ids=()):
+        super().__init__("token", fast_broadcaster())
+        self.uploads = []
+        self.by_file_id = []
+        self._stale_file_ids = set(stale_file_ids)
+
+    def _send_image_to_chat(self, image, chat_id):
+        self.uploads.append(chat_id)
+        file_id = f"file_{len(self.uploads)}"
+        return {'ok': True, 'result': {'photo': [{'file_id': "thumbnail"}, {'file_id': file_id}]}}
+
+    def _send_file_id_to_chat(self, file_id, chat_id):
+        self.by_file_id.append((file_id, chat_id))
+        if file_id in self._stale_file_ids:
+            return {'ok': False, 'error_code': 400, 'description': "Bad Request: wrong file identifier"}
+        return {'ok': True}
+
+
+def test_image_is_uploaded_once():
+    bot = FakeBot()
+    result = bot.send_image(BytesIO(b"png"), [1, 2, 3])
+    assert sorted(result.succeeded) == [1, 2, 3]
+    assert bot.uploads == [1]
+    assert sorted(bot.by_file_id) == [("file_1", 2), ("file_1", 3)]
+    bot.send_image(BytesIO(b"png"), [4])
+    assert bot.uploads == [1]
+
+
+def test_rejected_file_id_is_uploaded_again():
+    bot = FakeBot(stale_file_ids={"file_1"})
+    bot.send_image(BytesIO(b"png"), [1])
+    result = bot.send_image(BytesIO(b"png"), [2, 3])
+    assert sorted(result.succeeded) == [2, 3]
+    assert result.failed == {}
+    assert bot.uploads == [1, 2]
+    assert bot.by_file_id[-1] == ("file_2", 3)
+    # Fresh file_id is cached instead of the stale one
+    bot.send_image(BytesIO(b"png"), [4])
+    assert bot.uploads == [1, 2]
+    assert bot.by_file_id[-1] == ("file_2", 4)
+
+
+def test_image_is_uploaded_again_once_only():
+    bot = FakeBot(stale_file_ids={"file_1", "file_2"})
+    bot.send_image(BytesIO(b"png"), [1])
+    result = bot.send_image(BytesIO(b"png"), [2, 3])
+    assert result.succeeded == [2]
+    assert result.failed == {3: "Bad Request: wrong file identifier"}
+    assert bot.uploads == [1, 2]
@@ -1,14 +1,138 @@
+import os
 import requests
+import requests.adapters
 import json
 import sys
+from io import BytesIO
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import TokenBucket
+import metrics
+
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+# Telegram allows about 30 messages per second overall and 1 message per
+# second to the same chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+MAX_WORKERS = 16
+MAX_RETRIES = 3
+# Seconds Telegram holds getUpdates request, less than request timeout
+LONG_POLL_TIMEOUT = 50
+# Updates which carry chats of new subscribers
+CHAT_UPDATES = ['message', 'edited_message']
+# Number of uploaded images whose file_id is remembered
+FILE_ID_CACHE_SIZE = 32
+
+
+class BroadcastResult:
+
+    def __init__(self):
+        self.succeeded = []
+        # chat id -> error description
+        self.failed = dict()
+        # Chats which blocked the bot or do not exist anymore
+        self.blocked = []
+
+    def add(self, chat_id, status, response):
+        if status == "ok":
+            self.succeeded.append(chat_id)
+        elif status == "blocked":
+            self.blocked.append(chat_id)
+        else:
+            self.failed[chat_id] = response.get('description')
+
+    def __repr__(self):
+        return (f"BroadcastResult(succeeded={len(self.succeeded)}, "
+                f"failed={len(self.failed)}, blocked={len(self.blocked)})")
+
+
+class Broadcaster:
+
+    def __init__(self, max_workers=MAX_WORKERS, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, max_retries=MAX_RETRIES):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="broadcast")
+        self._global_limiter = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_limiters = dict()
+        self._lock = threading.Lock()
+        self._max_retries = max_retries
+
+    def _chat_limiter(self, chat_id):
+        with self._lock:
+            limiter = self._chat_limiters.get(chat_id)
+            if limiter is None:
+                limiter = TokenBucket(self._chat_rate, 1)
+                self._chat_limiters[chat_id] = limiter
+            return limiter
+
+    def deliver(self, send, chat_id):
+        # Returns (status, response), status is one of: ok, failed, blocked
+        started = time.perf_counter()
+        status, response = self._deliver(send, chat_id)
+        metrics.observe("telegram_delivery_seconds", time.perf_counter() - started, status=status)
+        metrics.inc("telegram_deliveries_total", status=status)
+        return (status, response)
+
+    def _deliver(self, send, chat_id):
+        limiter = self._chat_limiter(chat_id)
+        response = dict()
+        for _ in range(self._max_retries + 1):
+            limiter.acquire()
+            self._global_limiter.acquire()
+            try:
+                response = send(chat_id)
+            except (ValueError, requests.RequestException) as error:
+                response = {'ok': False, 'description': str(error)}
+                time.sleep(1)
+                continue
+            if response.get('ok'):
+                return ("ok", response)
+            description = response.get('description')
+            code = response.get('error_code')
+            if code == 429:
+                # Flood wait applies to the whole bot, not only to this chat
+                retry_after = response.get('parameters', dict()).get('retry_after', 1)
+                limiter.pause(retry_after)
+                self._global_limiter.pause(retry_after)
+            elif code == 403 or (code == 400 and "chat not found" in str(description)):
+                return ("blocked", response)
+            elif code is not None and code < 500:
+                return ("failed", response)
+            else:
+                time.sleep(1)
+        return ("failed", response)
+
+    def broadcast(self, send, chats, result=None):
+        # send - callable(chat_id) returning decoded Telegram API response
+        futures = [(c, self._executor.submit(self.deliver, send, c)) for c in chats]
+        if result is None:
+            result = BroadcastResult()
+        for chat_id, future in futures:
+            status, response = future.result()
+            result.add(chat_id, status, response)
+        return result
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
 
 class Bot:
 
-    def __init__(self, token):
-        self._api_url = fr"https://api.telegram.org/bot{token}/"
-    
+    def __init__(self, token, broadcaster=None):
+        self._api_url = f"{TELEGRAM_API_URL.rstrip('/')}/bot{token}/"
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._broadcaster = broadcaster if broadcaster is not None else Broadcaster()
+        # sha256 of image content -> Telegram file_id of the uploaded photo
+        self._file_ids = OrderedDict()
+        self._file_ids_lock = threading.Lock()
+
     def _get_url(self, url, data):
-        response = requests.get(url, params=data)
+        response = self._session.get(url, params=data, timeout=60)
         #print("Response:", response)
         content = response.content.decode("utf8")
         return content
@@ -18,48 +142,117 @@ class Bot:
         js = json.loads(content)        
         return js
 
-    def get_chat_list(self):   
-        chat_list = []
-        url = f"{self._api_url}getUpdates"
-        data = dict()
+    def get_updates(self, offset=None, timeout=0):
+        # One getUpdates call, with timeout > 0 Telegram holds the request
+        # until an update comes. Returns (set of chat ids, list of (chat id,
+        # command text) for messages starting with "/", next offset).
+        data = {'timeout': timeout, 'allowed_updates': json.dumps(CHAT_UPDATES)}
+        if offset is not None:
+            data['offset'] = offset
+        updates = self._get_json_from_url(f"{self._api_url}getUpdates", data)
+        chats = set()
+        commands = []
+        if updates['ok'] != True:
+            raise RuntimeError(f"Failed to get bot updates: {updates.get('description')}")
+        for update in updates['result']:
+            for kind in CHAT_UPDATES:
+                if kind in update:
+                    chats.add(update[kind]['chat']['id'])
+                    break
+            text = update.get('message', dict()).get('text', "")
+            if text.startswith("/"):
+                commands.append((update['message']['chat']['id'], text))
+            offset = int(update['update_id']) + 1
+        return chats, commands, offset
+
+    def get_chat_list(self):
+        # Pages through all pending updates
+        chats = set()
         offset = None
-        while True:     
-            if offset:
-                data['offset'] = offset
-            updates = self._get_json_from_url(url, data)
-            if(updates['ok'] == True and len(updates['result']) > 0):                                
-                for i in updates['result']:
-                    if 'message' in i:
-                        if i['message']['chat']['id'] not in chat_list:
-                            chat_list.append(i['message']['chat']['id'])
-                    elif 'edited_message' in i:
-                        if i['edited_message']['chat']['id'] not in chat_list:
-                            chat_list.append(i['message']['chat']['id'])
-                    offset = int(i['update_id']) + 1
-            else:
-                break                       
-            
-        return chat_list
+        while True:
+            new_chats, _, next_offset = self.get_updates(offset)
+            chats.update(new_chats)
+            if next_offset == offset:
+                break
+            offset = next_offset
+        return list(chats)
 
     def _send_message_to_chat(self, message, chat_id):
         data = {'chat_id': chat_id, 'text': message}
         url = fr"{self._api_url}sendMessage"
-        self._get_url(url, data)
+        return self._get_json_from_url(url, data)
 
     def _send_image_to_chat(self, image, chat_id):
         url = fr"{self._api_url}sendPhoto"
         image.seek(0)
         files = {'photo': image}    
         data = {'chat_id' : chat_id}
-        requests.post(url, files=files, data=data)  
+        return self._session.post(url, files=files, data=data, timeout=60).json()
+
+    def _send_file_id_to_chat(self, file_id, chat_id):
+        data = {'chat_id': chat_id, 'photo': file_id}
+        url = fr"{self._api_url}sendPhoto"
+        return self._get_json_from_url(url, data)
+
+    def _get_cached_file_id(self, digest):
+        with self._file_ids_lock:
+            file_id = self._file_ids.get(digest)
+            if file_id is not None:
+                self._file_ids.move_to_end(digest)
+            return file_id
+
+    def _cache_file_id(self, digest, file_id):
+        with self._file_ids_lock:
+            self._file_ids[digest] = file_id
+            self._file_ids.move_to_end(digest)
+            while len(self._file_ids) > FILE_ID_CACHE_SIZE:
+                self._file_ids.popitem(last=False)
+
+    def _evict_file_id(self, digest, file_id):
+        # Another thread may have uploaded the image again meanwhile
+        with self._file_ids_lock:
+            if self._file_ids.get(digest) == file_id:
+                del self._file_ids[digest]
 
     def send_text_message(self, message, chats):        
-        for id in chats:
-            self._send_message_to_chat(message, id)
+        return self._broadcaster.broadcast(lambda id: self._send_message_to_chat(message, id), chats)
 
     def send_image(self, image, chats):
-        for id in chats:
-            self._send_image_to_chat(image, id)
+        # Image is uploaded once, every other chat gets it by file_id
+        content = image.getvalue()
+        return self._send_image(content, hashlib.sha256(content).hexdigest(), list(chats), BroadcastResult(), True)
+
+    def _send_image(self, content, digest, chats, result, reupload):
+        file_id = self._get_cached_file_id(digest)
+        while file_id is None and len(chats) > 0:
+            chat_id = chats.pop(0)
+            status, response = self._broadcaster.deliver(
+                lambda id: self._send_image_to_chat(BytesIO(content), id), chat_id)
+            result.add(chat_id, status, response)
+            if status == "ok":
+                # Last photo size is the original image
+                file_id = response['result']['photo'][-1]['file_id']
+                self._cache_file_id(digest, file_id)
+        if len(chats) == 0:
+            return result
+        rejected = []
+
+        def send_file_id(chat_id):
+            response = self._send_file_id_to_chat(file_id, chat_id)
+            if response.get('error_code') == 400 and "chat not found" not in str(response.get('description')):
+                # F.e. "wrong file identifier", Telegram forgot the upload
+                rejected.append(chat_id)
+            return response
+
+        self._broadcaster.broadcast(send_file_id, chats, result)
+        if len(rejected) == 0 or not reupload:
+            return result
+        # Upload the image again, once, for chats which rejected file_id
+        self._evict_file_id(digest, file_id)
+        rejected = [c for c in chats if c in rejected]
+        for chat_id in rejected:
+            result.failed.pop(chat_id, None)
+        return self._send_image(content, digest, rejected, result, False)
 
 def main(argv):
     usage = "usage: {} bot_token".format(argv[0])
@@ -70,4 +263,4 @@ def main(argv):
     print(bot.get_chat_list())                       
     
 if __name__ == "__main__":
-    main(sys.argv)            
+    main(sys.argv)